@@ -1,5 +1,16 @@
 from .greypatch import *
+from .hsvhistogram import *
+from .regionfilter import *
 from .filtersettings import *
 from .subimage import *
 from .imagearea import *
+from .results import *
+from .scalecache import *
+from .stagecache import *
+from .output import *
+from .calibration import *
+from .batch import *
+from .timeseries import *
+from .stream import *
+from .worker import *
 
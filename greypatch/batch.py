@@ -0,0 +1,798 @@
+"""
+batch
+
+A module for running the greypatch pipeline over folders of images and writing the results files.
+Used by the greypatch-batch-process script and the greypatch-worker service.
+
+
+Workflow Overview
+-----------------
+
+1. Read a FilterSettings file
+2. Find the scale of each image, from a scale card or a known value
+3. Extract and segment the sub-images of each image, writing sub-image and annotated sub-image files
+4. Write raw and matched results tables for all images
+
+Alternatively watch a folder, processing each image as it arrives and appending to the results tables.
+
+Basic Usage
+-----------
+
+1. Process a folder
+
+    .. highlight:: python
+    .. code-block:: python
+
+        import greypatch as rp
+        rp.batch_process(folder="~/Desktop/single_image", settings="~/Desktop/default_filter.yml",
+                         destination_folder="~/Desktop/test_out", pixels_per_cm=412, min_lesion_area=0.001)
+
+2. Process one image, collecting its results tables
+
+    .. highlight:: python
+    .. code-block:: python
+
+        fs = rp.FilterSettings().read("~/Desktop/default_filter.yml")
+        raw_dfs, match_dfs = rp.process_image("~/Desktop/single_image/leaf.jpg", fs, "~/Desktop/test_out",
+                                              pixels_per_cm=412, min_lesion_area=0.001)
+
+3. Process one shard of a folder on each node of a cluster, then merge the shards' results
+
+    .. highlight:: python
+    .. code-block:: python
+
+        rp.batch_process(folder="~/Desktop/big_folder", settings="~/Desktop/default_filter.yml",
+                         destination_folder="~/Desktop/test_out", pixels_per_cm=412, shard=(0, 10))
+        rp.merge_shards("~/Desktop/test_out")
+
+4. Watch a folder that images are added to
+
+    .. highlight:: python
+    .. code-block:: python
+
+        rp.watch_folder(folder="~/Desktop/cabinet", settings="~/Desktop/default_filter.yml",
+                        destination_folder="~/Desktop/test_out", pixels_per_cm=412, settle_delay=10)
+
+"""
+
+import greypatch as rp
+import os
+import re
+import sys
+import time
+import hashlib
+import resource
+import multiprocessing
+import numpy as np
+import pandas as pd
+from PIL import Image
+from pathlib import Path
+from typing import List, Tuple, Union
+
+
+def _get_scale_card(imfile, fs, side_length):
+    # only the parts of the image searched are converted to HSV
+    return rp.griffin_scale_card(None, h=fs['scale_card']['h'],
+                                 s=fs['scale_card']['s'],
+                                 v=fs['scale_card']['v'],
+                                 side_length=side_length, rgb_img=rp.load_rgb(imfile))
+
+
+def _write_out(file, df, index=False):
+    with open(file, "w") as out:
+        out.write(df.to_csv(index=index))
+
+
+def _write_summary(dfs, destination_folder, scale = None):
+    df = pd.concat(dfs, sort=True)
+    cols = ['image_file', 'sub_image_index', 'area_type']
+
+    summarised = (df.drop(['label'], axis=1)
+              .groupby(cols)
+              .sum())
+    if scale:
+        l = len(summarised)
+        summarised.insert(0, "scale", [scale] * l, True) #always 4 rows [
+
+    _write_out(os.path.join(destination_folder, "summary_results.csv"), summarised, index=False)
+
+
+def _write_tidy(dfs, destination_folder, name="raw_results.csv"):
+    df = pd.concat(dfs, sort = True)
+    _write_out(os.path.join(destination_folder, name), df, index=False)
+
+
+def find_scale(imfile: str, fs: rp.FilterSettings, side_length=False, pixels_per_cm=False,
+               scale_cache: rp.ScaleCache = None) -> Union[float, None]:
+    """
+    Work out the scale of an image in pixels per cm.
+
+    Uses the scale card if side_length is given, re-using a validated value from scale_cache when there is one,
+    else the known pixels_per_cm.
+
+    :param: imfile str -- path to the image
+    :param: fs FilterSettings -- settings with a 'scale_card' setting, needed if side_length is given
+    :param: side_length float -- side length of the scale card in cm
+    :param: pixels_per_cm float -- a previously known scale
+    :param: scale_cache ScaleCache -- optional cache of validated scales per camera rig
+    :return: float or None if neither side_length nor pixels_per_cm is given
+    """
+    if side_length:
+        if scale_cache is not None:
+            scale = scale_cache.lookup(imfile)
+            if scale:
+                return scale
+        scale = _get_scale_card(imfile, fs, side_length)
+        if not scale:
+            raise ValueError("No scale card pixel value returned; likely scale card not found in image.")
+        if scale_cache is not None:
+            scale_cache.record(imfile, scale)
+        return scale
+    elif pixels_per_cm:
+        return pixels_per_cm
+    else:
+        return None
+
+
+def list_image_files(folder: str) -> List[str]:
+    """
+    List the image files in a folder, ignoring hidden files and sub-folders.
+
+    :param: folder str -- the folder to list
+    :return: List of absolute paths
+    """
+    return [str(file.resolve()) for file in Path(folder).iterdir() if
+            file.is_file() and not file.name.startswith(".")]
+
+
+def process_image(imfile: str, fs: rp.FilterSettings, destination_folder: str,
+                  scale_card_side_length=False, pixels_per_cm=False, min_lesion_area=False,
+                  passed_only: bool = True, scale_cache: rp.ScaleCache = None, n_jobs: int = 1,
+                  low_memory: bool = False, save_masks: str = None, region_dfs: List[pd.DataFrame] = None,
+                  stage_cache: rp.StageCache = None, output: rp.OutputProfile = None) \
+        -> Tuple[List[pd.DataFrame], List[pd.DataFrame]]:
+    """
+    Run the pipeline on one image.
+
+    Writes the sub-image and annotated sub-image files, or those the output profile asks for, to destination_folder
+    and returns the raw and matched results tables of the image's sub-images. The results are collected in
+    ResultRecords and each table is made once, so the lists hold at most one DataFrame each.
+
+    :param: imfile str -- path to the image
+    :param: fs FilterSettings -- the image segmentation settings
+    :param: destination_folder str -- folder in which to place results files
+    :param: scale_card_side_length float -- side length of the scale card in cm, if the image has one
+    :param: pixels_per_cm float -- a previously known scale
+    :param: min_lesion_area float -- minimum area for a lesion to pass filter
+    :param: passed_only bool -- only return objects that pass the filter
+    :param: scale_cache ScaleCache -- optional cache of validated scales per camera rig
+    :param: n_jobs int -- number of threads to segment the image's leaves with
+    :param: low_memory bool -- use the lower memory path, which never holds the whole image in HSV and segments
+        the leaves one at a time, see get_sub_images and LOW_MEMORY_BYTES_PER_PIXEL
+    :param: save_masks str -- also write each sub-image's label images in this format, "npz" or "npy", see
+        SubImage.write_label_masks. None writes no label images
+    :param: region_dfs List -- if given, the region table of each sub-image is appended to it, see
+        SubImage.region_table
+    :param: stage_cache StageCache -- optional cache of the leaf and band label images of earlier runs
+    :param: output OutputProfile -- the images to write for each sub-image, by default the full profile
+    :return: list of raw results DataFrames, list of matched results DataFrames
+    """
+    print("...doing image {}".format(imfile), file=sys.stderr)
+    scale = find_scale(imfile, fs, scale_card_side_length, pixels_per_cm, scale_cache=scale_cache)
+    pixel_length = 1 / scale
+    sub_ims = rp.subimage.get_sub_images(imfile, file_settings = fs, dest_folder = destination_folder,
+                                         min_lesion_area = min_lesion_area, scale = scale,
+                                         pixel_length = pixel_length, n_jobs = n_jobs,
+                                         stage_cache = stage_cache, low_memory = low_memory)
+    skipped = sum(len(s.skipped_bands) for s in sub_ims)
+    if skipped > 0:
+        print("...skipped {} of {} band segmentations with no passing pixels".format(
+            skipped, len(sub_ims) * len(rp.BAND_STAGES)), file=sys.stderr)
+    (output or rp.OutputProfile()).write(sub_ims, imfile, destination_folder)
+    records = rp.ResultRecords()
+    for s in sub_ims:
+        if save_masks:
+            s.write_label_masks(fmt=save_masks)
+        if region_dfs is not None:
+            region_dfs.append(s.region_table())
+        records.add_sub_image(s.inner_lesion_area_props, s.outer_lesion_area_props, image_file=s.parent_image_file,
+                              sub_image_index=s.index, passed_only=passed_only)
+    return records.results_dataframes()
+
+
+def write_results(raw_dfs: List[pd.DataFrame], match_dfs: List[pd.DataFrame], destination_folder: str,
+                  shard: Tuple[int, int] = None) -> None:
+    """
+    Write the raw_results.csv and matched_results.csv files for a run.
+
+    :param: raw_dfs List -- raw results DataFrames, as returned by process_image
+    :param: match_dfs List -- matched results DataFrames, as returned by process_image
+    :param: destination_folder str -- folder in which to place results files
+    :param: shard Tuple -- (shard index, number of shards) of a sharded run, the files are named for the shard
+    :return: None
+    """
+    if len(raw_dfs) > 0:
+        _write_tidy(raw_dfs, destination_folder, name=shard_file_name("raw_results.csv", shard))
+    if len(match_dfs) > 0:
+        _write_tidy(match_dfs, destination_folder, name=shard_file_name("matched_results.csv", shard))
+    else:
+        sys.stderr.write("...no matches found. skipping matched_results.csv\n")
+
+
+#: every region found by a run, passed or not, with the centroids needed to match lesions. Read by refilter
+REGION_TABLE = "region_table.csv"
+
+
+class _StoredRegion(object):
+    """a lesion read back from a region table, with the attributes results and matching use"""
+
+    def __init__(self, row, min_lesion_area):
+        self.label = row['label']
+        self.area = row['pixels_in_area']
+        self.scale = row['scale']
+        self.size = row['size']
+        self.centroid = (row['centroid_row'], row['centroid_col'])
+        self.passed = rp.lesion_passes(self.area, self.size, self.scale, min_lesion_area)
+        self.matches_with = None
+
+
+def read_region_table(file: str) -> pd.DataFrame:
+    """
+    Read a region table, keeping values exactly as they were written and NA scales and sizes as "NA".
+
+    :param: file str -- the region table file
+    :return: DataFrame
+    """
+    return pd.read_csv(file, keep_default_na=False, float_precision="round_trip",
+                       converters={'scale': _na_or_number, 'size': _na_or_number,
+                                   'circular_area': _na_or_number})
+
+
+def _na_or_number(text):
+    """parses a scale, size or circular area as written, an int, a float or NA"""
+    if text == "NA":
+        return text
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def refilter_regions(regions: pd.DataFrame, min_lesion_area=False, passed_only: bool = True) \
+        -> Tuple[List[pd.DataFrame], List[pd.DataFrame]]:
+    """
+    Apply the lesion filter and match inner and outer lesions again on a region table, without re-segmenting.
+
+    :param: regions DataFrame -- a region table, see read_region_table
+    :param: min_lesion_area float -- minimum area for a lesion to pass filter
+    :param: passed_only bool -- only return objects that pass the filter
+    :return: list of raw results DataFrames, list of matched results DataFrames, as process_image returns them
+    """
+    records = rp.ResultRecords()
+    for (image_file, sub_image_index), sub_image in regions.groupby(['image_file', 'sub_image_index'], sort=False):
+        outers = [_StoredRegion(row, min_lesion_area) for _, row in
+                  sub_image[sub_image.area_type == "outer_lesion_area"].iterrows()]
+        inners = [_StoredRegion(row, min_lesion_area) for _, row in
+                  sub_image[sub_image.area_type == "inner_lesion_area"].iterrows()]
+        rp.match_inner_outer(inners, outers)
+        records.add_sub_image(inners, outers, image_file=image_file, sub_image_index=sub_image_index,
+                              passed_only=passed_only)
+    return records.results_dataframes()
+
+
+def refilter(destination_folder: str, min_lesion_area=False, passed_only: bool = True,
+             output_folder: str = None) -> None:
+    """
+    Rewrite the raw_results.csv and matched_results.csv files of a finished run for new filter options, from its
+    REGION_TABLE rather than by running the pipeline again.
+
+    :param: destination_folder str -- the folder a run wrote its results to
+    :param: min_lesion_area float -- minimum area for a lesion to pass filter
+    :param: passed_only bool -- only output objects that pass the filter
+    :param: output_folder str -- folder to write the results files to, defaults to destination_folder
+    :return: None
+    """
+    output_folder = output_folder or destination_folder
+    os.makedirs(output_folder, exist_ok=True)
+    regions = read_region_table(os.path.join(destination_folder, REGION_TABLE))
+    raw_dfs, match_dfs = refilter_regions(regions, min_lesion_area=min_lesion_area, passed_only=passed_only)
+    write_results(raw_dfs, match_dfs, output_folder)
+
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    """
+    Parse a shard given as 'i/N', shard i (counting from 0) of N.
+
+    :param: text str -- the shard
+    :return: Tuple (i, N)
+    """
+    try:
+        index, count = (int(i) for i in text.split("/"))
+    except ValueError:
+        raise ValueError("shard must be given as i/N, eg 0/10, not '{}'".format(text))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("shard index must be from 0 to N - 1, not '{}'".format(text))
+    return index, count
+
+
+def shard_image_files(image_files: List[str], shard: Tuple[int, int], by: str = "index") -> List[str]:
+    """
+    Take one shard of a list of image files.
+
+    The partition is stable between runs and nodes. With by = "index" the sorted paths are dealt out in turn, which
+    balances the shards. With by = "hash" each file goes to the shard given by a hash of its name, so a file stays
+    in the same shard when other files are added to or removed from the folder.
+
+    :param: image_files List -- paths of the images
+    :param: shard Tuple -- (shard index, number of shards)
+    :param: by str -- partition by "index" or "hash"
+    :return: List of the paths in the shard, sorted
+    """
+    index, count = shard
+    image_files = sorted(image_files)
+    if by == "index":
+        return image_files[index::count]
+    elif by == "hash":
+        return [f for f in image_files
+                if int(hashlib.md5(os.path.basename(f).encode("utf-8")).hexdigest(), 16) % count == index]
+    raise ValueError("unknown shard partition '{}', use one of 'index' or 'hash'".format(by))
+
+
+def shard_file_name(name: str, shard: Tuple[int, int] = None) -> str:
+    """
+    Name a results file for a shard, eg raw_results.csv becomes raw_results.shard_2_of_10.csv
+
+    :param: name str -- the unsharded file name
+    :param: shard Tuple -- (shard index, number of shards), None leaves the name unchanged
+    :return: str
+    """
+    if shard is None:
+        return name
+    stem, ext = os.path.splitext(name)
+    return "{}.shard_{}_of_{}{}".format(stem, shard[0], shard[1], ext)
+
+
+#: results files of sharded runs, combined by merge_shards
+SHARDED_RESULTS = ("raw_results.csv", "matched_results.csv", "summary_results.csv", "timing_results.csv",
+                   "memory_report.csv", "region_table.csv")
+
+
+def merge_shards(destination_folder: str, source_folders: List[str] = None) -> None:
+    """
+    Combine the results files of a sharded run into the standard layout.
+
+    The shard files of each of SHARDED_RESULTS are concatenated, in shard order, into a single file in
+    destination_folder. Every shard writes a timing_results file, even if it had no images, and the merge
+    refuses to run if any of them is missing.
+
+    :param: destination_folder str -- folder to write the merged files to
+    :param: source_folders List -- folders holding the shard files, defaults to destination_folder
+    :return: None
+    """
+    source_folders = source_folders or [destination_folder]
+    found = {}
+    pattern = re.compile(r"^(.+)\.shard_(\d+)_of_(\d+)(\.csv)$")
+    for folder in source_folders:
+        for file in os.listdir(folder):
+            m = pattern.match(file)
+            if m and m.group(1) + m.group(4) in SHARDED_RESULTS:
+                found.setdefault(m.group(1) + m.group(4), {})[(int(m.group(2)), int(m.group(3)))] = \
+                    os.path.join(folder, file)
+
+    timings = found.get("timing_results.csv", {})
+    counts = set(count for _, count in timings)
+    if len(counts) != 1:
+        raise ValueError("expected timing results for one sharded run in {}, found shard counts {}".format(
+            ", ".join(source_folders), sorted(counts)))
+    count = counts.pop()
+    missing = [i for i in range(count) if (i, count) not in timings]
+    if missing:
+        raise ValueError("timing results missing for shards {} of {}".format(missing, count))
+
+    for name in SHARDED_RESULTS:
+        shard_files = [found[name][k] for k in sorted(found.get(name, {})) if k[1] == count]
+        if len(shard_files) == 0:
+            continue
+        _concatenate_csv(shard_files, os.path.join(destination_folder, name))
+        print("...merged {} shard files into {}".format(len(shard_files), name), file=sys.stderr)
+
+
+def _concatenate_csv(files, outfile):
+    """concatenates csv files with the same header, keeping the rows exactly as written"""
+    header = None
+    with open(outfile, "w") as out:
+        for file in files:
+            with open(file) as f:
+                file_header = f.readline()
+                if header is None:
+                    header = file_header
+                    out.write(header)
+                elif file_header != header:
+                    raise ValueError("{} has different columns to the other shards".format(file))
+                for line in f:
+                    out.write(line)
+
+
+#: estimated peak bytes per image pixel when processing an image, from measured peaks of 44 to 79, the most for
+#: images whose leaves fill the frame
+IMAGE_BYTES_PER_PIXEL = 96
+#: estimated peak bytes per image pixel when processing an image on the lower memory path, from measured peaks of
+#: 23 to 54
+LOW_MEMORY_BYTES_PER_PIXEL = 64
+#: estimated bytes a worker process needs beyond those of the image it is processing
+WORKER_OVERHEAD_BYTES = 256 * 2 ** 20
+#: per image memory estimates and peaks of runs with a memory budget, in the destination folder
+MEMORY_REPORT = "memory_report.csv"
+
+_MEMORY_UNITS = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+
+
+def parse_memory(text: str) -> int:
+    """
+    Parse an amount of memory given as a number of bytes with an optional K, M, G or T suffix, eg 16G or 512M.
+    Suffixes are powers of 1024.
+
+    :param: text str -- the amount of memory
+    :return: int bytes
+    """
+    m = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$", str(text), re.IGNORECASE)
+    if not m:
+        raise ValueError("memory must be given as a number with an optional K, M, G or T suffix, not '{}'".format(text))
+    return int(float(m.group(1)) * _MEMORY_UNITS[m.group(2).upper()])
+
+
+def estimate_image_memory(imfile: str, low_memory: bool = False) -> int:
+    """
+    Estimate the peak memory needed to process an image, from its dimensions. Reads only the image header, the
+    pixels are not decoded.
+
+    :param: imfile str -- path to the image
+    :param: low_memory bool -- estimate for the lower memory path
+    :return: int bytes
+    """
+    with Image.open(imfile) as img:
+        width, height = img.size
+    per_pixel = LOW_MEMORY_BYTES_PER_PIXEL if low_memory else IMAGE_BYTES_PER_PIXEL
+    return WORKER_OVERHEAD_BYTES + width * height * per_pixel
+
+
+def _peak_rss():
+    """peak resident memory of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _warm_up_kernels():
+    """compile the numba kernels for the array layouts the pipeline uses"""
+    im = np.zeros((4, 4, 3), dtype=np.float64)
+    rp.threshold_hsv_img(im, mask=np.ones((4, 4), dtype=np.bool_))
+    rp.threshold_hsv_img(im[::2, ::2])
+    rp.threshold_hsv_img(im[1:3, 1:3])
+    rp.any_pixels_pass(im[1:3, 1:3], [((0, 1), (0, 1), (0, 1))], mask=np.ones((2, 2), dtype=np.bool_))
+    rp.any_pixels_pass(im[1:3, 1:3], [((0, 1), (0, 1), (0, 1))])
+    rgb = np.zeros((4, 4, 3), dtype=np.uint8)
+    rp.rgb_to_hsv(rgb, threshold=((0, 1), (0, 1), (0, 1)))
+    rp.rgb_to_hsv(rgb[1:3, 1:3], out=im[1:3, 1:3])
+
+
+def _process_image_task(imfile, fs, destination_folder, scale_card_side_length, pixels_per_cm, min_lesion_area,
+                        passed_only, scale_cache, n_jobs, low_memory, save_masks, stage_cache, output):
+    """
+    runs process_image in a worker process, returning its results and region tables, any newly detected scale, the
+    seconds taken, the resident memory of the worker at the start and its peak
+    """
+    start = time.time()
+    start_rss = _peak_rss()
+    cached = None
+    if scale_card_side_length and scale_cache is not None:
+        cached = scale_cache.lookup(imfile)
+    scale = cached or find_scale(imfile, fs, scale_card_side_length, pixels_per_cm)
+    region_dfs = []
+    raw_dfs, match_dfs = process_image(imfile, fs, destination_folder, pixels_per_cm=scale,
+                                       min_lesion_area=min_lesion_area, passed_only=passed_only, n_jobs=n_jobs,
+                                       low_memory=low_memory, save_masks=save_masks, region_dfs=region_dfs,
+                                       stage_cache=stage_cache, output=output)
+    detected = scale if scale_card_side_length and cached is None else None
+    return raw_dfs, match_dfs, region_dfs, detected, time.time() - start, start_rss, _peak_rss()
+
+
+def _process_within_memory(image_files, fs, destination_folder, scale_card_side_length, pixels_per_cm,
+                           min_lesion_area, passed_only, scale_cache, n_jobs, max_memory, max_workers, save_masks,
+                           stage_cache, output, run_over_budget):
+    """
+    processes images in worker processes, starting each only when the estimated memory of all running images fits
+    within max_memory. Images too big for the budget on their own use the lower memory path, and those still too
+    big are skipped, or with run_over_budget run alone. Each image gets a fresh worker process, so its peak
+    resident memory is measured alone. Returns per image (raw_dfs, match_dfs, region_dfs, seconds), or None if it
+    was skipped, in image order and the memory report rows.
+    """
+    _warm_up_kernels()
+    budget = max_memory - _peak_rss()
+    plans = []
+    for imfile in image_files:
+        estimate = estimate_image_memory(imfile)
+        low_memory = estimate > budget
+        status = "processed"
+        if low_memory:
+            estimate = estimate_image_memory(imfile, low_memory=True)
+            if estimate > budget:
+                status = "over_budget" if run_over_budget else "skipped"
+                print("...image {} is estimated to need {:.0f} MB, over the memory budget, {}".format(
+                    imfile, estimate / 2 ** 20, "running it alone" if run_over_budget else "skipping it"),
+                    file=sys.stderr)
+        plans.append((imfile, estimate, low_memory, status))
+
+    results = {}
+    running = {}  # index -> (AsyncResult, estimate)
+    next_image = 0
+    # fork so workers share the compiled kernels, and replace each worker after one image to measure its peak
+    with multiprocessing.get_context("fork").Pool(processes=max_workers, maxtasksperchild=1) as pool:
+        while next_image < len(plans) or running:
+            for i, (result, _) in list(running.items()):
+                if result.ready():
+                    results[i] = result.get()
+                    del running[i]
+            while next_image < len(plans) and len(running) < max_workers:
+                imfile, estimate, low_memory, status = plans[next_image]
+                if status == "skipped":
+                    next_image += 1
+                    continue
+                if running and sum(e for _, e in running.values()) + estimate > budget:
+                    break
+                result = pool.apply_async(_process_image_task, (imfile, fs, destination_folder,
+                                                                scale_card_side_length, pixels_per_cm,
+                                                                min_lesion_area, passed_only, scale_cache, n_jobs,
+                                                                low_memory, save_masks, stage_cache, output))
+                running[next_image] = (result, estimate)
+                next_image += 1
+            time.sleep(0.05)
+
+    processed = []
+    report = []
+    for i, (imfile, estimate, low_memory, status) in enumerate(plans):
+        if status == "skipped":
+            processed.append(None)
+            report.append((imfile, estimate, low_memory, status, None, None, None, None))
+            continue
+        raw_dfs, match_dfs, region_dfs, detected, seconds, start_rss, peak = results[i]
+        if detected is not None and scale_cache is not None:
+            scale_cache.record(imfile, detected)
+        processed.append((raw_dfs, match_dfs, region_dfs, seconds))
+        report.append((imfile, estimate, low_memory, status, start_rss, peak, peak - start_rss, seconds))
+    if results:
+        print("...largest image peak {:.0f} MB above its worker's start, {:.0f} MB budget".format(
+            max(r[6] for r in report if r[6] is not None) / 2 ** 20, max_memory / 2 ** 20), file=sys.stderr)
+    return processed, report
+
+
+def _prepare_run(settings, destination_folder, scale_card_side_length, scale_cache):
+    """reads settings and scale cache if given as files, checks they are usable and creates destination_folder"""
+    if isinstance(settings, rp.FilterSettings):
+        fs = settings
+    else:
+        fs = rp.FilterSettings()
+        fs.read(settings)
+
+    if scale_card_side_length and not "scale_card" in fs:
+        raise ValueError("scale card side length provided but no scale card image options present in FilterSettings")
+
+    if isinstance(scale_cache, str):
+        scale_cache = rp.ScaleCache(scale_cache)
+
+    os.makedirs(destination_folder, exist_ok=True)
+    return fs, scale_cache
+
+
+def _append_tidy(dfs, destination_folder, name="raw_results.csv"):
+    """appends the rows in dfs to a results file, writing the header only if the file is new"""
+    file = os.path.join(destination_folder, name)
+    df = pd.concat(dfs, sort = True)
+    new_file = not os.path.exists(file) or os.path.getsize(file) == 0
+    with open(file, "a") as out:
+        out.write(df.to_csv(index=False, header=new_file))
+
+
+def batch_process(folder: str = ".", settings: Union[str, rp.FilterSettings] = "settings.yml",
+                  destination_folder: str = ".", scale_card_side_length=False, pixels_per_cm=False,
+                  min_lesion_area=False, passed_only: bool = True, scale_cache: Union[str, rp.ScaleCache] = None,
+                  shard: Tuple[int, int] = None, shard_by: str = "index", n_jobs: int = 1,
+                  max_memory: int = None, max_workers: int = None, save_masks: str = None,
+                  stage_cache: Union[str, rp.StageCache] = None, output: rp.OutputProfile = None,
+                  run_over_budget: bool = False) -> None:
+    """
+    Run the pipeline on every image in a folder and write the results files.
+
+    With max_memory the images are processed in worker processes, up to max_workers at once. Each image's peak
+    memory is estimated from its dimensions before it is decoded and an image is only started when the estimates of
+    all running images fit within max_memory. Images too big to fit on their own use the lower memory path of
+    process_image. Images too big to fit even on that path are skipped, unless run_over_budget is set, when they
+    are run alone. The estimates and the measured peak of each image, and the images skipped, are written to
+    MEMORY_REPORT.
+
+    With shard = (i, N) only shard i of N of the images is processed (see shard_image_files) and the results files,
+    plus a timing_results file of seconds per image, are named for the shard so that the shards of a cluster array
+    job can share a destination folder. Combine them with merge_shards.
+
+    :param: folder str -- folder containing images to analyse
+    :param: settings str or FilterSettings -- file of filter settings, or the settings object, to use
+    :param: destination_folder str -- folder to write output. Created if does not exist
+    :param: scale_card_side_length float -- find a scale card of this side length in cm in each image
+    :param: pixels_per_cm float -- use a previously known value for pixels per centimetre
+    :param: min_lesion_area float -- the minimum area a lesion can be to be retained
+    :param: passed_only bool -- only output objects that pass the filter
+    :param: scale_cache str or ScaleCache -- file of, or the, scale card values per camera rig
+    :param: shard Tuple -- (shard index, number of shards) to process, None processes all images
+    :param: shard_by str -- partition images into shards by "index" or "hash"
+    :param: n_jobs int -- number of threads to segment each image's leaves with
+    :param: max_memory int -- memory budget in bytes for processing images, see parse_memory
+    :param: max_workers int -- with max_memory, the most images to process at once, defaults to the CPU count
+    :param: save_masks str -- also write each sub-image's label images in this format, "npz" or "npy"
+    :param: stage_cache str or StageCache -- folder of, or the, stored stage outputs of earlier runs. Stages whose
+        image and settings are unchanged are not run again, see StageCache
+    :param: output OutputProfile -- the images to write for each sub-image, by default the full profile
+    :param: run_over_budget bool -- with max_memory, run images estimated to need more than max_memory alone
+        rather than skipping them
+    :return: None
+    """
+    fs, scale_cache = _prepare_run(settings, destination_folder, scale_card_side_length, scale_cache)
+    if isinstance(stage_cache, str):
+        stage_cache = rp.StageCache(stage_cache)
+
+    image_files = list_image_files(folder)
+    if shard is not None:
+        image_files = shard_image_files(image_files, shard, by=shard_by)
+
+    if max_memory:
+        processed, report = _process_within_memory(image_files, fs, destination_folder, scale_card_side_length,
+                                                   pixels_per_cm, min_lesion_area, passed_only, scale_cache,
+                                                   n_jobs, max_memory, max_workers or os.cpu_count() or 1,
+                                                   save_masks, stage_cache, output, run_over_budget)
+        memory = pd.DataFrame(report, columns=['image_file', 'estimated_bytes', 'low_memory', 'status',
+                                               'start_rss_bytes', 'peak_rss_bytes', 'image_peak_bytes', 'seconds'])
+        _write_out(os.path.join(destination_folder, shard_file_name(MEMORY_REPORT, shard)), memory)
+        image_files = [imfile for imfile, p in zip(image_files, processed) if p is not None]
+        processed = [p for p in processed if p is not None]
+    else:
+        processed = []
+        for imfile in image_files:
+            start = time.time()
+            image_region_dfs = []
+            image_raw_dfs, image_match_dfs = process_image(imfile, fs, destination_folder,
+                                                           scale_card_side_length=scale_card_side_length,
+                                                           pixels_per_cm=pixels_per_cm,
+                                                           min_lesion_area=min_lesion_area, passed_only=passed_only,
+                                                           scale_cache=scale_cache, n_jobs=n_jobs,
+                                                           save_masks=save_masks, region_dfs=image_region_dfs,
+                                                           stage_cache=stage_cache, output=output)
+            processed.append((image_raw_dfs, image_match_dfs, image_region_dfs, time.time() - start))
+
+    raw_dfs = []
+    match_dfs = []
+    region_dfs = []
+    timings = []
+    for imfile, (image_raw_dfs, image_match_dfs, image_region_dfs, seconds) in zip(image_files, processed):
+        timings.append((imfile, seconds))
+        raw_dfs += image_raw_dfs
+        match_dfs += image_match_dfs
+        region_dfs += image_region_dfs
+
+    if scale_cache is not None and scale_cache.file:
+        scale_cache.write()
+    if stage_cache is not None and not max_memory:
+        print("...stage cache: {}".format(stage_cache.summary()), file=sys.stderr)
+
+    write_results(raw_dfs, match_dfs, destination_folder, shard=shard)
+    if len(region_dfs) > 0:
+        _write_tidy(region_dfs, destination_folder, name=shard_file_name(REGION_TABLE, shard))
+    if shard is not None:
+        timing = pd.DataFrame({'shard': [shard[0]] * len(timings), 'image_file': [t[0] for t in timings],
+                               'seconds': [t[1] for t in timings]}, columns=['shard', 'image_file', 'seconds'])
+        _write_out(os.path.join(destination_folder, shard_file_name("timing_results.csv", shard)), timing)
+
+
+#: file in the destination folder listing the images a watch_folder run has processed
+PROCESSED_LOG = "processed_images.txt"
+
+
+def watch_folder(folder: str = ".", settings: Union[str, rp.FilterSettings] = "settings.yml",
+                 destination_folder: str = ".", scale_card_side_length=False, pixels_per_cm=False,
+                 min_lesion_area=False, passed_only: bool = True, scale_cache: Union[str, rp.ScaleCache] = None,
+                 poll_interval: float = 5.0, settle_delay: float = 10.0, max_idle: float = None,
+                 n_jobs: int = 1, save_masks: str = None, stage_cache: Union[str, rp.StageCache] = None,
+                 output: rp.OutputProfile = None) -> None:
+    """
+    Watch a folder, running the pipeline on each image as it arrives and appending to the results files.
+
+    The folder is polled every poll_interval seconds. An image is processed once its size and modification time
+    have not changed for settle_delay seconds, so files still being written are left alone. Settings are read
+    once and the kernels stay compiled between images. Processed images are listed in PROCESSED_LOG in
+    destination_folder and are skipped if the watch is restarted. Images that fail are reported and not retried.
+    Images removed before they are processed are forgotten. The output is written beside the images it is made
+    from, so destination_folder must not be the watched folder.
+
+    :param: folder str -- folder to watch for images
+    :param: settings str or FilterSettings -- file of filter settings, or the settings object, to use
+    :param: destination_folder str -- folder to write output. Created if does not exist
+    :param: scale_card_side_length float -- find a scale card of this side length in cm in each image
+    :param: pixels_per_cm float -- use a previously known value for pixels per centimetre
+    :param: min_lesion_area float -- the minimum area a lesion can be to be retained
+    :param: passed_only bool -- only output objects that pass the filter
+    :param: scale_cache str or ScaleCache -- file of, or the, scale card values per camera rig
+    :param: poll_interval float -- seconds between looks at the folder
+    :param: settle_delay float -- seconds an image must be unchanged before it is processed
+    :param: max_idle float -- stop after this many seconds with nothing to process, None watches until interrupted
+    :param: n_jobs int -- number of threads to segment each image's leaves with
+    :param: save_masks str -- also write each sub-image's label images in this format, "npz" or "npy"
+    :param: stage_cache str or StageCache -- folder of, or the, stored stage outputs of earlier runs
+    :param: output OutputProfile -- the images to write for each sub-image, by default the full profile
+    :return: None
+    """
+    if os.path.realpath(folder) == os.path.realpath(destination_folder):
+        raise ValueError("destination folder {} is the watched folder, its output would be processed as images"
+                         .format(destination_folder))
+    fs, scale_cache = _prepare_run(settings, destination_folder, scale_card_side_length, scale_cache)
+    if isinstance(stage_cache, str):
+        stage_cache = rp.StageCache(stage_cache)
+    log = os.path.join(destination_folder, PROCESSED_LOG)
+    processed = set()
+    if os.path.exists(log):
+        with open(log) as file:
+            processed = set(line.rstrip("\n") for line in file)
+
+    pending = {}  # image file -> ((size, mtime), time first seen with that size and mtime)
+    last_activity = time.time()
+    print("...watching {}".format(folder), file=sys.stderr)
+    try:
+        while True:
+            image_files = list_image_files(folder)
+            for imfile in set(pending) - set(image_files):
+                del pending[imfile]
+            for imfile in image_files:
+                if imfile in processed:
+                    continue
+                try:
+                    stat = os.stat(imfile)
+                except OSError:
+                    pending.pop(imfile, None)
+                    continue
+                signature = (stat.st_size, stat.st_mtime)
+                now = time.time()
+                if imfile not in pending or pending[imfile][0] != signature:
+                    pending[imfile] = (signature, now)
+                    last_activity = now
+                    continue
+                if stat.st_size == 0 or now - pending[imfile][1] < settle_delay:
+                    continue
+
+                try:
+                    region_dfs = []
+                    raw_dfs, match_dfs = process_image(imfile, fs, destination_folder,
+                                                       scale_card_side_length=scale_card_side_length,
+                                                       pixels_per_cm=pixels_per_cm, min_lesion_area=min_lesion_area,
+                                                       passed_only=passed_only, scale_cache=scale_cache,
+                                                       n_jobs=n_jobs, save_masks=save_masks,
+                                                       region_dfs=region_dfs, stage_cache=stage_cache,
+                                                       output=output)
+                    if len(raw_dfs) > 0:
+                        _append_tidy(raw_dfs, destination_folder, name="raw_results.csv")
+                    if len(match_dfs) > 0:
+                        _append_tidy(match_dfs, destination_folder, name="matched_results.csv")
+                    if len(region_dfs) > 0:
+                        _append_tidy(region_dfs, destination_folder, name=REGION_TABLE)
+                except Exception as e:
+                    print("...failed image {}: {}: {}".format(imfile, type(e).__name__, e), file=sys.stderr)
+                if scale_cache is not None and scale_cache.file:
+                    scale_cache.write()
+
+                processed.add(imfile)
+                del pending[imfile]
+                with open(log, "a") as file:
+                    file.write(imfile + "\n")
+                last_activity = time.time()
+
+            waiting = any(signature[0] > 0 for signature, _ in pending.values())
+            if max_idle is not None and not waiting and time.time() - last_activity >= max_idle:
+                break
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("...stopped watching {}".format(folder), file=sys.stderr)
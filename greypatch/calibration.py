@@ -0,0 +1,211 @@
+"""
+calibration
+
+A module for finding filter settings for a new pathogen or cultivar from example images with reference masks
+
+
+Workflow Overview
+-----------------
+
+1. Draw reference masks for a few images, one binary image per tag marking the pixels that should be selected
+2. Run the calibration, which searches the hue, saturation and value ranges for each tag
+3. Write the best settings to a file and use it with greypatch-batch-process
+
+Each image's pixels are quantised once into HSV histograms, one of all the pixels considered for a tag and one of
+the pixels in the tag's reference mask, pooled over the images. Candidate threshold ranges fall on bin edges, so the
+pixels a candidate selects and the reference pixels among them are both read from summed-volume tables rather than
+by re-thresholding the images, and candidates are scored in vectorised blocks. Candidates are scored by the
+intersection over union of the pixels they select with the reference mask. The search is exhaustive over a coarse
+grid of candidates then refines each limit in turn at full bin resolution until no limit improves the score.
+
+Healthy, outer lesion and inner lesion areas are only ever thresholded within the leaf, so when the leaf_area
+reference mask is given too only the pixels within it are considered for them, see CALIBRATION_WITHIN.
+
+Basic Usage
+-----------
+
+1. Import module, calibrate
+
+    .. highlight:: python
+    .. code-block:: python
+
+        import greypatch as rp
+        images = [("leaf_1.jpg", {"leaf_area": "leaf_1_leaf.png", "outer_lesion_area": "leaf_1_lesion.png"}),
+                  ("leaf_2.jpg", {"leaf_area": "leaf_2_leaf.png", "outer_lesion_area": "leaf_2_lesion.png"})]
+        fs, scores = rp.calibrate_filter_settings(images, n_jobs=4)
+
+2. Write the settings to a file
+
+    .. highlight:: python
+    .. code-block:: python
+
+        fs.write("calibrated_filter.yml")
+
+"""
+
+import greypatch as rp
+import itertools
+import numpy as np
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from skimage import io
+from typing import Dict, List, Tuple, Union
+
+#: tags whose candidate pixels are restricted to those in another tag's reference mask, when it is given
+CALIBRATION_WITHIN = {
+    'healthy_area': 'leaf_area',
+    'outer_lesion_area': 'leaf_area',
+    'inner_lesion_area': 'leaf_area',
+}
+
+#: number of candidates scored at once
+_BLOCK_SIZE = 65536
+
+
+def _read_mask(mask: Union[str, np.ndarray]) -> np.ndarray:
+    """a reference mask as a 2D boolean array, from an array or a binary image file"""
+    if isinstance(mask, str):
+        mask = io.imread(mask)
+    mask = np.asarray(mask)
+    if mask.ndim == 3:
+        mask = mask[:, :, :3].any(axis=2)
+    return mask.astype(np.bool_)
+
+
+def _iou(hist_all: rp.HSVHistogram, hist_ref: rp.HSVHistogram, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+    """intersection over union with the reference pixels of the pixels in each box of bins"""
+    selected = hist_all.box_counts(lower, upper)
+    hits = hist_ref.box_counts(lower, upper)
+    union = selected + hist_ref.total - hits
+    return np.divide(hits, union, out=np.zeros(len(hits), dtype=np.float64), where=union > 0)
+
+
+def _best_candidate(hist_all, hist_ref, lower, upper, executor=None):
+    """score candidate boxes in blocks, returning the best box and its score"""
+    starts = range(0, len(lower), _BLOCK_SIZE)
+    blocks = [(lower[i:i + _BLOCK_SIZE], upper[i:i + _BLOCK_SIZE]) for i in starts]
+    if executor is None:
+        scores = [_iou(hist_all, hist_ref, l, u) for l, u in blocks]
+    else:
+        scores = list(executor.map(lambda b: _iou(hist_all, hist_ref, *b), blocks))
+    scores = np.concatenate(scores)
+    best = int(np.argmax(scores))
+    return lower[best], upper[best], float(scores[best])
+
+
+def _coarse_candidates(bins: int, step: int) -> Tuple[np.ndarray, np.ndarray]:
+    """every box on a grid of bin edges step bins apart"""
+    edges = list(range(0, bins, step)) + [bins]
+    pairs = [(lo, hi) for lo, hi in itertools.combinations(edges, 2)]
+    boxes = np.array([[p[0] for p in box] + [p[1] for p in box] for box in itertools.product(pairs, repeat=3)])
+    return boxes[:, :3], boxes[:, 3:]
+
+
+def _refine(hist_all, hist_ref, lower, upper, score, max_rounds=20):
+    """move each limit in turn to its best bin edge, until no limit improves the score"""
+    bins = hist_all.bins
+    lower, upper = lower.copy(), upper.copy()
+    for _ in range(max_rounds):
+        improved = False
+        for channel, end in itertools.product(range(3), (0, 1)):
+            if end == 0:
+                positions = np.arange(0, upper[channel])
+            else:
+                positions = np.arange(lower[channel] + 1, bins + 1)
+            lowers = np.repeat(lower[np.newaxis], len(positions), axis=0)
+            uppers = np.repeat(upper[np.newaxis], len(positions), axis=0)
+            (lowers if end == 0 else uppers)[:, channel] = positions
+            candidate_lower, candidate_upper, candidate_score = _best_candidate(hist_all, hist_ref, lowers, uppers)
+            if candidate_score > score:
+                lower, upper, score = candidate_lower, candidate_upper, candidate_score
+                improved = True
+        if not improved:
+            break
+    return lower, upper, score
+
+
+def calibrate_filter_settings(images: List[Tuple[Union[str, np.ndarray], Dict[str, Union[str, np.ndarray]]]],
+                              tags: List[str] = None, bins: int = 32, coarse_step: int = 4, n_jobs: int = 1,
+                              base_settings: rp.FilterSettings = None,
+                              within: Dict[str, str] = None) -> Tuple[rp.FilterSettings, Dict[str, float]]:
+    """
+    Search for the hue, saturation and value thresholds of each tag that best match reference masks.
+
+    The search is over ranges on a grid of `bins` bins per channel, exhaustively at every `coarse_step` th bin edge
+    and then refining each limit at every bin edge. Scores are computed on the quantised pixels, so a threshold
+    on a bin edge may pick up a few more pixels when the settings are used than when they were scored.
+
+    :param: images List -- list of (image, {tag: reference mask}), images as an HSV array or an image file,
+        reference masks as a boolean array or a binary image file the same size as the image
+    :param: tags List -- the tags to calibrate, defaults to every tag with a reference mask
+    :param: bins int -- number of bins per channel, the resolution of the thresholds found
+    :param: coarse_step int -- spacing in bins of the exhaustive search grid
+    :param: n_jobs int -- number of threads to convert the images to HSV and score candidates with
+    :param: base_settings FilterSettings -- settings whose other tags, eg scale_card, are copied to the result, and
+        whose region filters are kept for the tags calibrated
+    :param: within Dict -- tag to the tag whose reference mask restricts its candidate pixels, defaults to
+        CALIBRATION_WITHIN
+    :return: Tuple of the best FilterSettings and a dict of tag to its intersection over union score
+    """
+    within = CALIBRATION_WITHIN if within is None else within
+    if tags is None:
+        tags = sorted(set(tag for _, masks in images for tag in masks))
+
+    hists = {tag: (None, None) for tag in tags}
+    for image, masks in images:
+        hsv_img = rp.load_as_hsv(image, n_jobs=n_jobs) if isinstance(image, str) else image
+        masks = {tag: _read_mask(mask) for tag, mask in masks.items()}
+        for tag in tags:
+            if tag not in masks:
+                continue
+            population = masks.get(within.get(tag))
+            reference = masks[tag] if population is None else masks[tag] & population
+            hist_all = rp.HSVHistogram(hsv_img, bins=bins, mask=population, exact=False)
+            hist_ref = rp.HSVHistogram(hsv_img, bins=bins, mask=reference, exact=False)
+            pooled_all, pooled_ref = hists[tag]
+            hists[tag] = (hist_all.merge(pooled_all) if pooled_all is not None else hist_all,
+                          hist_ref.merge(pooled_ref) if pooled_ref is not None else hist_ref)
+
+    fs = rp.FilterSettings()
+    base = base_settings.settings if base_settings is not None else {}
+    for tag, setting in base.items():
+        if tag not in tags:
+            fs.add_setting(tag, h=setting['h'], s=setting['s'], v=setting['v'], filter=setting.get('filter'))
+
+    scores = {}
+    coarse_lower, coarse_upper = _coarse_candidates(bins, coarse_step)
+    executor = ThreadPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else None
+    try:
+        for tag in tags:
+            hist_all, hist_ref = hists[tag]
+            if hist_all is None:
+                raise ValueError("no reference masks given for tag '{}'".format(tag))
+            lower, upper, score = _best_candidate(hist_all, hist_ref, coarse_lower, coarse_upper, executor)
+            lower, upper, score = _refine(hist_all, hist_ref, lower, upper, score)
+            edges = hist_all.edges
+            fs.add_setting(tag, h=(float(edges[lower[0]]), float(edges[upper[0]])),
+                           s=(float(edges[lower[1]]), float(edges[upper[1]])),
+                           v=(float(edges[lower[2]]), float(edges[upper[2]])),
+                           filter=base.get(tag, {}).get('filter'))
+            scores[tag] = score
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return fs, scores
+
+
+def read_calibration_manifest(file: str) -> List[Tuple[str, Dict[str, str]]]:
+    """
+    read the images and reference masks to calibrate with from a yaml file, a list of entries like
+
+        - image: leaf_1.jpg
+          masks:
+            leaf_area: leaf_1_leaf.png
+            outer_lesion_area: leaf_1_lesion.png
+
+    :param: file str -- the manifest file
+    :return: List of (image file, {tag: reference mask file})
+    """
+    with open(file) as f:
+        entries = yaml.safe_load(f) or []
+    return [(entry['image'], dict(entry['masks'])) for entry in entries]
@@ -29,6 +29,14 @@ Basic Usage
 
         fs.add_setting("leaf_area", h=(0.1, 1.0), s=(0.3, 0.6), v=(0.4, 0.6) )
 
+   The leaf_area setting can also take a region filter expression that the leaves found must pass, by default
+   "area >= 2500", see RegionFilter
+
+    .. highlight:: python
+    .. code-block:: python
+
+        fs.add_setting("leaf_area", h=(0.1, 1.0), s=(0.3, 0.6), v=(0.4, 0.6), filter="area >= 10000")
+
 3. Access a setting by name
 
     .. highlight:: python
@@ -76,7 +84,7 @@ class FilterSettings(object):
         self.settings = {}
 
     def add_setting(self, tag: str, h: Tuple[float, float] = (), s: Tuple[float, float] = (),
-                    v: Tuple[float, float] = () ) -> None:
+                    v: Tuple[float, float] = (), filter: str = None) -> None:
         """
         add a setting to the object
     
@@ -84,10 +92,15 @@ class FilterSettings(object):
         :param: h Tuple -- a 2-tuple of Hue thresholds (lower, upper)
         :param: s Tuple -- a 2-tuple of Saturation thresholds (lower, upper)
         :param: v Tuple -- a 2-tuple of Value thresholds (lower, upper)
+        :param: filter str -- optional region filter expression the objects found must pass, eg "area >= 2500".
+            Used for leaf_area, see RegionFilter
         :return: None
         """
 
         self.settings[tag] = {'h': h, 's': s, 'v': v}
+        if filter is not None:
+            rp.RegionFilter(filter)
+            self.settings[tag]['filter'] = filter
 
     def write(self, outfile: str) -> None:
         """
@@ -49,6 +49,13 @@ Basic Usage
 
         rp.run_threshold_preview(hsv_image, width = 2)
 
+   Or pass the file path, to load a downsized copy for the preview in a fraction of the time
+
+    .. highlight:: python
+    .. code-block:: python
+
+        rp.run_threshold_preview(f.path, width = 2)
+
 
 5. Find objects using HSV values
 
@@ -92,7 +99,11 @@ from ipywidgets import FloatRangeSlider, FloatProgress
 from IPython.display import display
 import ipywidgets as widgets
 import math
+from concurrent.futures import ThreadPoolExecutor
 from numba import njit
+from PIL import Image
+from .hsvhistogram import HSVHistogram
+from .regionfilter import RegionFilter
 
 #: Default values for griffin named functions
 LEAF_AREA_HUE = tuple([i / 255 for i in (0, 255)])
@@ -136,20 +147,27 @@ SCALE_CARD_VAL = (0.25, 0.75)
 
 
 
-def pixel_volume_to_circular_area(pixels: int, scale: float) -> float:
+def pixel_volume_to_circular_area(pixels: Union[int, np.ndarray], scale: float) -> Union[float, np.ndarray]:
     """helps work out the area of a circular object with a similar pixel volume at the same scale
     pixels = pixels in the object , scale = pixels per cm in this image, obtainable from rp.griffin_scale_card()
 
-    returns a float giving the area a circle of that number of pixels would take up
-    """
+    returns a float giving the area a circle of that number of pixels would take up, or an array of them if pixels
+    is an array of pixel counts
 
-    i = 1
-    r = 0
-    while i < pixels / 2.0:
-        i = i + (i + 2)
-        r += 1
-    r =  r / scale
-    return math.pi * (r**2)
+    The radius in pixels is the number of steps of i -> 2i + 2 from i = 1 until i is at least half the pixels.
+    After k steps i = 3 * 2^k - 2, so the radius is the smallest k >= 0 with 3 * 2^k - 2 >= pixels / 2, found
+    directly from a log rather than by stepping
+    """
+    half = np.asarray(pixels, dtype=np.float64) / 2.0
+    r = np.maximum(np.ceil(np.log2((np.maximum(half, 1.0) + 2.0) / 3.0)), 0.0)
+    # the log can be off by one at the step boundaries, check against the exact step values
+    r = np.where(3.0 * 2.0 ** r - 2.0 < half, r + 1.0, r)
+    r = np.where((r > 0) & (3.0 * 2.0 ** (r - 1.0) - 2.0 >= half), r - 1.0, r)
+    r = r / scale
+    area = math.pi * (r**2)
+    if np.ndim(area) == 0:
+        return float(area)
+    return area
 
 
 
@@ -159,7 +177,8 @@ def pixel_volume_to_circular_area(pixels: int, scale: float) -> float:
 def threshold_hsv_img(im: np.ndarray,
                       h: Tuple[float, float] = HEALTHY_HUE,
                       s: Tuple[float, float] = HEALTHY_SAT,
-                      v: Tuple[float, float] = HEALTHY_VAL) -> np.ndarray:
+                      v: Tuple[float, float] = HEALTHY_VAL,
+                      mask: np.ndarray = None) -> np.ndarray:
     """
     Selects pixels passing an HSV image threshold in all three channels.
 
@@ -167,16 +186,35 @@ def threshold_hsv_img(im: np.ndarray,
     and upper thresholds specified in h, s and v (hue lower,upper; sat lower,upper and val lower, upper;
     respectively)
 
+    If mask is given, pixels where mask is False are treated as cleared background (HSV 0, 0, 0), exactly as if
+    im had been passed through clear_background first, without making the cleared copy.
+
     :param: im np.ndarray -- a numpy ndarray
     :param: h Tuple -- a 2-tuple of Hue thresholds (lower, upper)
     :param: s Tuple -- a 2-tuple of Saturation thresholds (lower, upper)
     :param: v Tuple -- a 2-tuple of Value thresholds (lower, upper)
+    :param: mask np.ndarray -- optional binary mask of pixels to consider, shape == im[:, :, 0]
     :return: np.ndarray -- a logical array (dtype bool) with shape == im
 
 
     """
     assert im.dtype.type is np.float64, "im must be np.ndarray of type float64. Looks like you're not using an HSV image."
-    return _threshold_three_channels(im, c1_limits=h, c2_limits=s, c3_limits=v)
+    result = _threshold_three_channels(im, c1_limits=h, c2_limits=s, c3_limits=v)
+    if mask is not None:
+        if _zero_passes(h, s, v):
+            result[~mask] = True
+        else:
+            result &= mask
+    return result
+
+
+def _zero_passes(h: Tuple[float, float], s: Tuple[float, float], v: Tuple[float, float]) -> bool:
+    """
+    Work out whether a cleared (HSV 0, 0, 0) pixel passes the thresholds in h, s and v.
+
+    Internal method.
+    """
+    return all(lower <= 0 <= upper for lower, upper in (h, s, v))
 
 
 def hsv_to_rgb255(img: np.ndarray) -> np.ndarray:
@@ -191,7 +229,7 @@ def hsv_to_rgb255(img: np.ndarray) -> np.ndarray:
     """
     return (color.hsv2rgb(img) * 255).astype('int')
 
-@njit
+@njit(nogil=True)
 def _threshold_three_channels(im: np.ndarray,
                               c1_limits: Tuple[Union[int, float], Union[int, float]] = (0, 1),
                               c2_limits: Tuple[Union[int, float], Union[int, float]] = (0, 1),
@@ -227,7 +265,171 @@ def _threshold_three_channels(im: np.ndarray,
     return result.astype(np.bool_)
 
 
-def load_as_hsv(fname: str) -> np.ndarray:
+def any_pixels_pass(im: np.ndarray, boxes: List[Tuple[Tuple[float, float], Tuple[float, float], Tuple[float, float]]],
+                    mask: np.ndarray = None) -> np.ndarray:
+    """
+    Find which of several HSV thresholds any pixel of an image passes, without making the threshold masks.
+
+    All the thresholds are tested in one pass over the pixels, which stops as soon as each has a passing pixel, so
+    it costs at most about one threshold_hsv_img. A threshold no pixel passes gives an empty threshold_hsv_img mask,
+    so the labelling and measuring that would follow it can be skipped.
+
+    :param: im np.ndarray -- an HSV image
+    :param: boxes List -- list of (h, s, v) thresholds, each a 2-tuple (lower, upper)
+    :param: mask np.ndarray -- optional binary mask, pixels outside it are treated as cleared background as in
+        threshold_hsv_img
+    :return: np.ndarray -- bool, one per box, True if any pixel passes it
+    """
+    assert im.dtype.type is np.float64, "im must be np.ndarray of type float64. Looks like you're not using an HSV image."
+    limits = np.array([[lower_upper for channel in box for lower_upper in channel] for box in boxes],
+                      dtype=np.float64).reshape(-1, 6)
+    if mask is None:
+        return _pixels_in_boxes(im, limits, np.ones(im.shape[:2], dtype=np.bool_))
+    found = _pixels_in_boxes(im, limits, mask.astype(np.bool_, copy=False))
+    if not mask.all():
+        found |= np.array([_zero_passes(*box) for box in boxes], dtype=np.bool_)
+    return found
+
+
+@njit(nogil=True)
+def _pixels_in_boxes(im, limits, mask):
+    """
+    Tests which rows of limits (h_min, h_max, s_min, s_max, v_min, v_max) any pixel where mask is set falls in,
+    stopping when all have been found.
+
+    Internal method.
+    """
+    n = limits.shape[0]
+    found = np.zeros(n, dtype=np.bool_)
+    remaining = n
+    x_d, y_d, _ = im.shape
+    for x in range(x_d):
+        for y in range(y_d):
+            if not mask[x, y]:
+                continue
+            for k in range(n):
+                if not found[k] and limits[k, 0] <= im[x, y, 0] <= limits[k, 1] and \
+                        limits[k, 2] <= im[x, y, 1] <= limits[k, 3] and limits[k, 4] <= im[x, y, 2] <= limits[k, 5]:
+                    found[k] = True
+                    remaining -= 1
+            if remaining == 0:
+                return found
+    return found
+
+
+#: the largest difference between rgb_to_hsv and skimage.color.rgb2hsv for uint8 images, by output dtype. float64 is
+#: the same to the bit, float32 differs only by rounding the float64 values to float32
+HSV_TOLERANCE = {np.dtype(np.float64): 0.0, np.dtype(np.float32): 2 ** -25}
+
+#: rows converted at a time by rgb_to_hsv for images that aren't uint8
+HSV_FALLBACK_ROWS = 256
+
+
+def rgb_to_hsv(rgb: np.ndarray, out: np.ndarray = None, dtype=np.float64,
+               threshold: Tuple[Tuple[float, float], Tuple[float, float], Tuple[float, float]] = None,
+               n_jobs: int = 1) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Convert an RGB image to HSV colour space, in one pass over the pixels.
+
+    skimage.color.rgb2hsv converts the whole image to float64 and then makes several more full size temporaries,
+    on one thread. For uint8 images this reads each pixel once and writes its HSV values straight into out, with
+    n_jobs threads each converting a strip of rows. The arithmetic is skimage's, so float64 results are identical
+    to rgb2hsv and float32 results are rgb2hsv's values rounded to float32, see HSV_TOLERANCE. Images of other types
+    are converted with rgb2hsv, HSV_FALLBACK_ROWS rows at a time.
+
+    With threshold the pixels passing the (h, s, v) thresholds are found in the same pass, as threshold_hsv_img
+    would find them in the float64 result, saving a second pass over the image.
+
+    :param: rgb np.ndarray -- an RGB image, shape (rows, cols, 3)
+    :param: out np.ndarray -- optional array to write the HSV image to, eg one kept between images or a view of a
+        larger array, shape == rgb and dtype float64 or float32
+    :param: dtype -- np.float64 or np.float32, the type of the result when out isn't given
+    :param: threshold Tuple -- optional (h, s, v) thresholds, each a 2-tuple (lower, upper)
+    :param: n_jobs int -- number of threads to convert uint8 images with
+    :return: np.ndarray -- the HSV image, out if given, or a tuple of it and the threshold mask (dtype bool) with
+        threshold
+    """
+    if rgb.ndim != 3 or rgb.shape[2] != 3:
+        raise ValueError("rgb must have shape (rows, cols, 3), not {}".format(rgb.shape))
+    if out is None:
+        out = np.empty(rgb.shape, dtype=dtype)
+    elif out.shape != rgb.shape:
+        raise ValueError("out must have shape {}, not {}".format(rgb.shape, out.shape))
+    if out.dtype not in HSV_TOLERANCE:
+        raise ValueError("HSV images must be float64 or float32, not {}".format(out.dtype))
+
+    if threshold is None:
+        limits = np.zeros(6, dtype=np.float64)
+        mask = np.empty((rgb.shape[0], 0), dtype=np.bool_)
+    else:
+        limits = np.array([lower_upper for channel in threshold for lower_upper in channel], dtype=np.float64)
+        mask = np.empty(rgb.shape[:2], dtype=np.bool_)
+
+    if rgb.dtype == np.uint8:
+        step = max(math.ceil(rgb.shape[0] / n_jobs), 1)
+
+        def convert(row):
+            _rgb_to_hsv_kernel(rgb[row:row + step], out[row:row + step], limits, mask[row:row + step],
+                               threshold is not None)
+
+        rows = range(0, rgb.shape[0], step)
+        if len(rows) > 1:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                list(executor.map(convert, rows))
+        else:
+            convert(0)
+    else:
+        for row in range(0, rgb.shape[0], HSV_FALLBACK_ROWS):
+            block = color.rgb2hsv(rgb[row:row + HSV_FALLBACK_ROWS])
+            out[row:row + HSV_FALLBACK_ROWS] = block
+            if threshold is not None:
+                h, s, v = threshold
+                mask[row:row + HSV_FALLBACK_ROWS] = threshold_hsv_img(block, h=h, s=s, v=v)
+
+    if threshold is None:
+        return out
+    return out, mask
+
+
+@njit(nogil=True)
+def _rgb_to_hsv_kernel(rgb, out, limits, mask, threshold):
+    """
+    Converts uint8 RGB to HSV with the operations of skimage.color.rgb2hsv, in float64, writing the values to out
+    and, if threshold, whether they fall in limits (h_min, h_max, s_min, s_max, v_min, v_max) to mask.
+
+    Internal method.
+    """
+    scale = 1. / 255
+    for x in range(rgb.shape[0]):
+        for y in range(rgb.shape[1]):
+            r = rgb[x, y, 0] * scale
+            g = rgb[x, y, 1] * scale
+            b = rgb[x, y, 2] * scale
+            v = max(r, g, b)
+            delta = v - min(r, g, b)
+            if delta == 0.:
+                h = 0.
+                s = 0.
+            else:
+                s = delta / v
+                # rgb2hsv assigns red, green then blue, so a later channel wins ties
+                if b == v:
+                    h = 4. + (r - g) / delta
+                elif g == v:
+                    h = 2. + (b - r) / delta
+                else:
+                    h = (g - b) / delta
+                h = (h / 6.) % 1.
+            out[x, y, 0] = h
+            out[x, y, 1] = s
+            out[x, y, 2] = v
+            if threshold:
+                mask[x, y] = limits[0] <= h <= limits[1] and limits[2] <= s <= limits[3] and \
+                    limits[4] <= v <= limits[5]
+
+
+def load_as_hsv(fname: str, return_rgb: bool = False, reduce: int = 1, n_jobs: int = 1) \
+        -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
     """
     Load a file into HSV colour space.
 
@@ -235,16 +437,92 @@ def load_as_hsv(fname: str) -> np.ndarray:
     returns numpy array dtype float 64. Strips the alpha (fourth) channel if it exists.
     Input must be colour image. One channel images will be rejected.
 
+    The image is converted with rgb_to_hsv, which writes straight into the result without full size temporaries,
+    giving the same values as skimage.color.rgb2hsv, on n_jobs threads.
+
+    With return_rgb the decoded RGB image is returned too, so that images written out or converted to greyscale
+    later can be made from the original pixels instead of converting the HSV image back.
+
+    With reduce of 2, 4 or 8 the image is loaded at 1/reduce of its width and height, for previews and other uses
+    that don't need every pixel. JPEGs are scaled by the decoder, which skips most of the decoding work, so a
+    reduced JPEG loads several times faster than a full one. Other formats are decoded in full then reduced by
+    averaging reduce x reduce blocks. Sizes are rounded up, see reduced_size. Don't use reduced images for
+    measurements.
+
     :param: fname str -- path to the image
-    :return: np.ndarray -- numpy array containing image
+    :param: return_rgb bool -- also return the decoded RGB image, usually uint8
+    :param: reduce int -- load the image at 1/reduce of its size, one of 1, 2, 4 or 8
+    :param: n_jobs int -- number of threads to convert the image to HSV with
+    :return: np.ndarray -- numpy array containing image, or a tuple of it and the RGB image with return_rgb
 
     """
-    img = io.imread(fname)
+    img = load_rgb(fname, reduce=reduce)
+    hsv_img = rgb_to_hsv(img, n_jobs=n_jobs)
+    if return_rgb:
+        return hsv_img, img
+    return hsv_img
+
+
+def load_rgb(fname: str, reduce: int = 1) -> np.ndarray:
+    """
+    Load a file as an RGB image, without converting it to HSV.
+
+    Strips the alpha (fourth) channel if it exists. Input must be colour image. One channel images will be rejected.
+
+    :param: fname str -- path to the image
+    :param: reduce int -- load the image at 1/reduce of its size, one of 1, 2, 4 or 8, see load_as_hsv
+    :return: np.ndarray -- the decoded image, usually uint8
+    """
+    if reduce == 1:
+        img = io.imread(fname)
+    else:
+        img = _read_reduced(fname, reduce)
+    return _colour_channels(img, fname)
+
+
+def _colour_channels(img, name):
+    """strips the alpha channel of an image if it has one, rejecting images that aren't colour"""
     if img.shape[-1] == 4:
         img = img[:,:,:3]
-    assert len(img.shape) == 3, "Image at: {} does not appear to be a 3 channel colour image.".format(fname)
-    hsv_img = color.rgb2hsv(img)
-    return hsv_img
+    assert len(img.shape) == 3, "Image at: {} does not appear to be a 3 channel colour image.".format(name)
+    return img
+
+
+#: the factors images can be reduced by when loaded, those JPEG decoders can scale by
+REDUCE_FACTORS = (1, 2, 4, 8)
+
+
+def reduced_size(size: Tuple[int, int], reduce: int) -> Tuple[int, int]:
+    """
+    The size of an image loaded with load_as_hsv(reduce=reduce)
+
+    :param: size Tuple -- the full size of the image, (width, height) or (rows, columns)
+    :param: reduce int -- the reduction factor
+    :return: Tuple, the reduced size in the same order
+    """
+    return tuple(-(-n // reduce) for n in size)
+
+
+def _read_reduced(fname: str, reduce: int) -> np.ndarray:
+    """
+    Decode an image at 1/reduce of its size.
+
+    Internal method.
+
+    JPEG decoders can scale by 1/2, 1/4 and 1/8 in the DCT, asked for with PIL's draft. Any reduction the decoder
+    doesn't do, eg for other formats, is done by block averaging with Image.reduce.
+    """
+    if reduce not in REDUCE_FACTORS:
+        raise ValueError("reduce must be one of {}, not {}".format(REDUCE_FACTORS, reduce))
+    with Image.open(fname) as img:
+        width = img.size[0]
+        if img.format == "JPEG":
+            # draft picks the largest reduction giving at least the size asked for, counting in whole pixels
+            img.draft("RGB", (img.size[0] // reduce, img.size[1] // reduce))
+        remaining = reduce // round(width / img.size[0])
+        if remaining > 1:
+            img = img.reduce(remaining)
+        return np.asarray(img)
 
 
 def preview_mask(m: np.ndarray, width: int = 5, height: int = 5) -> None:
@@ -373,24 +651,31 @@ def get_object_properties(label_array: np.ndarray, intensity_image: np.ndarray =
 
 
 def filter_region_property_list(region_props: List[measure._regionprops._RegionProperties],
-                                func: Callable[[measure._regionprops._RegionProperties], bool]) \
+                                func: Union[Callable[[measure._regionprops._RegionProperties], bool], str,
+                                            RegionFilter]) \
         -> List[measure._regionprops._RegionProperties]:
     """
     Filters region props objects from a list if they do not satisfy a condition.
 
     Given a list of region props, and a function that returns True/False for each region prop
-    Returns a list of region props that have passed
+    Returns a list of region props that have passed. The condition can also be a region filter expression,
+    eg "area >= 2500", which is evaluated on all the region props at once, see RegionFilter
 
     :param: region_props List -- list of skimage.measure.RegionProps objects
-    :param: func Callable -- a function that returns True/False to be evaluated against the RegionProps objects
+    :param: func Callable -- a function that returns True/False to be evaluated against the RegionProps objects,
+        or a filter expression str or RegionFilter
     :return: List of RegionProps
 
     """
+    if isinstance(func, str):
+        func = RegionFilter(func)
+    if isinstance(func, RegionFilter):
+        return func.filter(region_props)
     return [r for r in region_props if func(r)]
 
 
 def clean_labelled_mask(label_array: np.ndarray,
-                        region_props: List[measure._regionprops._RegionProperties]) -> np.ndarray:
+                        region_props: Union[List[measure._regionprops._RegionProperties], np.ndarray]) -> np.ndarray:
     """
     Removes unwanted object pixels from a mask.
 
@@ -398,13 +683,56 @@ def clean_labelled_mask(label_array: np.ndarray,
     removing them from the image. Intended to be used on label images
 
     :param: label_array np.ndarray -- the label array from which non-represented objects will be removed
-    :param: region_props List -- list of skimage.measure.RegionProps, the objects to keep in the label array
+    :param: region_props List -- list of skimage.measure.RegionProps, the objects to keep in the label array,
+        or an array of the labels to keep, eg from RegionFilter.select
     :return: np.ndarray -- cleaned label array
 
     """
-    labels_to_keep: list = [r.label for r in region_props]
-    keep_mask = np.isin(label_array, labels_to_keep)
-    return label_array * keep_mask
+    if isinstance(region_props, np.ndarray):
+        labels_to_keep = region_props
+    else:
+        labels_to_keep: list = [r.label for r in region_props]
+    lut = _label_lookup_table(label_array, labels_to_keep)
+    kept = np.flatnonzero(lut)
+    lut[kept] = kept
+    return lut[label_array]
+
+
+def remap_labels(label_array: np.ndarray,
+                 region_props: Union[List[measure._regionprops._RegionProperties], np.ndarray]) \
+        -> Tuple[np.ndarray, int]:
+    """
+    Removes unwanted objects from a label array and renumbers the rest.
+
+    Given a label array, sets the labels not represented in region_props to Zero and the ones that are to
+    1, 2, 3... in the order of their old labels, in one pass over the array. For a label array from label_image
+    this gives the same result as label_image on the cleaned mask, without labelling it again.
+
+    :param: label_array np.ndarray -- the label array from which non-represented objects will be removed
+    :param: region_props List -- list of skimage.measure.RegionProps, the objects to keep in the label array,
+        or an array of the labels to keep, eg from RegionFilter.select
+    :return: Tuple of the renumbered label array and the number of labels kept
+    """
+    if isinstance(region_props, np.ndarray):
+        labels_to_keep = region_props
+    else:
+        labels_to_keep = [r.label for r in region_props]
+    lut = _label_lookup_table(label_array, labels_to_keep)
+    kept = lut > 0
+    count = int(np.count_nonzero(kept))
+    lut[kept] = np.arange(1, count + 1, dtype=lut.dtype)
+    return lut[label_array], count
+
+
+def _label_lookup_table(label_array: np.ndarray, labels_to_keep) -> np.ndarray:
+    """
+    Internal method. A table indexed by label, non-zero for the labels to keep that occur in the label array
+    """
+    lut = np.zeros(int(label_array.max(initial=0)) + 1, dtype=label_array.dtype)
+    labels_to_keep = np.asarray(labels_to_keep, dtype=np.int64).ravel()
+    labels_to_keep = labels_to_keep[(labels_to_keep > 0) & (labels_to_keep < len(lut))]
+    lut[labels_to_keep] = 1
+    return lut
 
 
 def extract_image_segment(hsv_img: np.ndarray, region_prop: measure._regionprops._RegionProperties) -> np.ndarray:
@@ -423,10 +751,41 @@ def extract_image_segment(hsv_img: np.ndarray, region_prop: measure._regionprops
     return hsv_img[min_row:max_row, min_col:max_col]
 
 
+def fill_holes(mask: np.ndarray, method: str = "label") -> np.ndarray:
+    """
+    Fill the holes in the objects of a binary mask.
+
+    A hole is a background region that cannot be reached from the image border. With method "label" (the default)
+    the background is labelled once and only the enclosed components are filled, which gives the same result as
+    ndi.binary_fill_holes without its iterative propagation from the border. Method "propagate" uses
+    ndi.binary_fill_holes directly and method "none" returns the mask unfilled.
+
+    :param: mask np.ndarray -- binary mask image/array
+    :param: method str -- one of "label", "propagate" or "none"
+    :return: np.ndarray -- the filled mask, dtype bool
+    """
+    if method == "label":
+        background = np.logical_not(mask)
+        background_labels, count = ndi.label(background)
+        edges = np.concatenate([background_labels[0, :], background_labels[-1, :],
+                                background_labels[:, 0], background_labels[:, -1]])
+        lut = np.ones(count + 1, dtype=np.bool_)
+        lut[edges] = False
+        lut[0] = True
+        return lut[background_labels]
+    elif method == "propagate":
+        return ndi.binary_fill_holes(mask)
+    elif method == "none":
+        return mask.astype(np.bool_)
+    raise ValueError("unknown hole fill method '{}', use one of 'label', 'propagate' or 'none'".format(method))
+
+
 def griffin_healthy_regions(hsv_img: np.ndarray,
                             h: Tuple[float, float] = HEALTHY_HUE,
                             s: Tuple[float, float] = HEALTHY_SAT,
-                            v: Tuple[float, float] = HEALTHY_VAL) -> Tuple[np.ndarray, int]:
+                            v: Tuple[float, float] = HEALTHY_VAL,
+                            mask: np.ndarray = None,
+                            hole_fill: str = "label") -> Tuple[np.ndarray, int]:
     """
     Perform Ciaran Griffin's Healthy Region extraction.
 
@@ -437,101 +796,192 @@ def griffin_healthy_regions(hsv_img: np.ndarray,
     :param: h Tuple -- minimum and maximum Hue threshold values
     :param: s Tuple -- minimum and maximum Saturation threshold values
     :param: v Tuple -- minimum and maximum Value threshold values
+    :param: mask np.ndarray -- optional leaf mask, pixels outside it are treated as cleared background
+    :param: hole_fill str -- hole filling method passed to fill_holes
     :return: np.ndarray, int
 
 
     """
-    mask = threshold_hsv_img(hsv_img, h=h, s=s, v=v).astype(int)  # ,r,g,b)
-    filled_mask = ndi.binary_fill_holes(mask)
+    mask = threshold_hsv_img(hsv_img, h=h, s=s, v=v, mask=mask).astype(int)  # ,r,g,b)
+    filled_mask = fill_holes(mask, method=hole_fill)
 
     return (filled_mask, np.sum(mask))
 
 
 def griffin_lesion_regions(hsv_img, h: Tuple[float, float] = LESION_HUE, s: Tuple[float, float] = LESION_SAT,
-                           v: Tuple[float, float] = LESION_VAL) -> Tuple[np.ndarray, int]:
+                           v: Tuple[float, float] = LESION_VAL, mask: np.ndarray = None) -> Tuple[np.ndarray, int]:
     """given an image in hsv applies Ciaran Griffin's detection for lesion regions.
-    applies a hsv_space colour threshold,
+    applies a hsv_space colour threshold, optionally only within the leaf mask `mask`,
     returns a labelled mask of objects and the object count."""
-    mask = threshold_hsv_img(hsv_img, h=h, s=s, v=v).astype(int)
+    mask = threshold_hsv_img(hsv_img, h=h, s=s, v=v, mask=mask).astype(int)
     #lesion_mask = ndi.binary_fill_holes(mask)
     #return lesion_mask, np.sum(mask)
     return mask, np.sum(mask)
 
 def griffin_leaf_regions(hsv_img, h: Tuple[float, float] = LEAF_AREA_HUE, s: Tuple[float, float] = LEAF_AREA_SAT,
-                         v: Tuple[float, float] = LEAF_AREA_VAL) -> Tuple[np.ndarray, int]:
+                         v: Tuple[float, float] = LEAF_AREA_VAL, hole_fill: str = "label") -> Tuple[np.ndarray, int]:
     """given an image in hsv applies Ciaran Griffin's detection for leaf area regions.
-    applies a hsv_space colour threshold and fills that mask for holes.
+    applies a hsv_space colour threshold and fills that mask for holes using the fill_holes method in `hole_fill`.
     returns a binary mask and object count."""
     mask = threshold_hsv_img(hsv_img, h=h, s=s, v=v).astype(int)
-    return ndi.binary_fill_holes(mask)
+    return fill_holes(mask, method=hole_fill)
+
+
+def griffin_lesion_centres(hsv_img, lesion_region: measure._regionprops._RegionProperties, sigma: float = 2.0,
+                           hole_fill: str = "label", rgb_img: np.ndarray = None):
+    """finds lesion centres in a given lesion region. Use griffin_lesion_centres_batch for many regions
+    of the same image"""
+    return griffin_lesion_centres_batch(hsv_img, [lesion_region], sigma=sigma, hole_fill=hole_fill,
+                                        rgb_img=rgb_img)[0]
 
 
-def griffin_lesion_centres(hsv_img, lesion_region: measure._regionprops._RegionProperties, sigma: float = 2.0):
-    """finds lesion centres in a given lesion region"""
+def griffin_lesion_centres_batch(hsv_img: np.ndarray,
+                                 lesion_regions: List[measure._regionprops._RegionProperties],
+                                 sigma: float = 2.0,
+                                 hole_fill: str = "label",
+                                 rgb_img: np.ndarray = None) -> List[List[measure._regionprops._RegionProperties]]:
+    """
+    Find lesion centres in many lesion regions of the same image.
+
+    The greyscale conversion needed for edge detection is done once, over the union of the bounding boxes of
+    lesion_regions, rather than over the whole image for every region. Canny edge detection, hole filling and
+    labelling then run on each region's bounding box crop.
+
+    :param: hsv_img np.ndarray -- an HSV scaled image, usually a sub-image
+    :param: lesion_regions List -- list of RegionProps objects (or ImageAreas) describing the lesion regions
+    :param: sigma float -- standard deviation of the Gaussian filter used by the Canny edge detector
+    :param: hole_fill str -- hole filling method passed to fill_holes
+    :param: rgb_img np.ndarray -- the same image in RGB, eg from load_as_hsv with return_rgb, to convert to grey
+        without converting hsv_img back to RGB
+    :return: List of lists of RegionProps, the lesion centres found in each of lesion_regions, in the same order
+    """
+    if len(lesion_regions) == 0:
+        return []
+    bboxes = np.array([r.bbox for r in lesion_regions])
+    min_row, min_col = bboxes[:, :2].min(axis=0)
+    max_row, max_col = bboxes[:, 2:].max(axis=0)
     # convert to grey for canny
-    img_grey = color.rgb2gray(color.hsv2rgb(hsv_img))
-    sub_img = get_region_subimage(lesion_region, img_grey)
-    edges = feature.canny(sub_img, sigma=sigma).astype(int)
-    mask = ndi.binary_fill_holes(edges)
-    labelled_image, _ = label_image(mask)
-    region_props = get_object_properties(labelled_image, edges)
-    return region_props
+    if rgb_img is None:
+        img_grey = color.rgb2gray(color.hsv2rgb(hsv_img[min_row:max_row, min_col:max_col]))
+    else:
+        img_grey = color.rgb2gray(rgb_img[min_row:max_row, min_col:max_col])
+    centres = []
+    for r0, c0, r1, c1 in bboxes:
+        sub_img = img_grey[r0 - min_row:r1 - min_row, c0 - min_col:c1 - min_col]
+        edges = feature.canny(sub_img, sigma=sigma).astype(int)
+        mask = fill_holes(edges, method=hole_fill)
+        labelled_image, _ = label_image(mask)
+        centres.append(get_object_properties(labelled_image, edges))
+    return centres
+
+
+def griffin_scale_card(hsv_img, h, s, v, side_length=5, hole_fill="label", downsample=4, rgb_img=None):
+    '''returns pixels per cm of scale card object.
+    The card (the biggest object passing the threshold) is searched for in a copy of the image sampled at every
+    `downsample`th pixel, then its area is measured at full resolution in a window around it only.
+    Use downsample = 1 to search the full resolution image.
+    hsv_img can be None if the image is given as rgb_img instead, then only the sampled copy and the window are
+    converted to HSV.'''
+    def hsv(rows, cols):
+        if hsv_img is None:
+            return rgb_to_hsv(rgb_img[rows, cols])
+        return hsv_img[rows, cols]
+
+    coarse = hsv(slice(None, None, downsample), slice(None, None, downsample))
+    card_mask = fill_holes(threshold_hsv_img(coarse, h=h, s=s, v=v), method=hole_fill)
+    biggest_obj_area, card_slice = _biggest_object(card_mask)  # assume biggest object is scale card
+    if biggest_obj_area is None:
+        return None
+    if downsample > 1:
+        pad = 2 * downsample
+        rows, cols = card_slice
+        window = hsv(slice(max(rows.start * downsample - pad, 0), rows.stop * downsample + pad),
+                     slice(max(cols.start * downsample - pad, 0), cols.stop * downsample + pad))
+        card_mask = fill_holes(threshold_hsv_img(window, h=h, s=s, v=v), method=hole_fill)
+        biggest_obj_area, _ = _biggest_object(card_mask)
+    side = math.sqrt(biggest_obj_area)
+    return side / float(side_length)
+
+
+def _biggest_object(mask: np.ndarray) -> Tuple[Union[int, None], Union[Tuple[slice, slice], None]]:
+    """
+    Find the biggest object in a binary mask.
 
+    Internal method.
 
-def griffin_scale_card(hsv_img, h, s, v, side_length=5):
-    '''returns pixels per cm of scale card object'''
-    mask = threshold_hsv_img(hsv_img, h=h, s=s, v=v).astype(int)
-    card_mask = ndi.binary_fill_holes(mask)
-    labelled_image, _ = label_image(card_mask)
-    region_props = get_object_properties(labelled_image, card_mask)
-    plt.imshow(card_mask)
-    if len(region_props) > 0:
-        biggest_obj_area = sorted(region_props, key=lambda rp: rp.area, reverse=True)[0].area  # assume biggest object is scale card
-        side = math.sqrt(biggest_obj_area)
-        return side / float(side_length)
-    return None
-
-
-def clear_background(img: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    Returns the pixel area and the bounding box slices of the biggest object, or None, None if there are no objects.
+    """
+    labelled_image, count = label_image(mask)
+    if count == 0:
+        return None, None
+    areas = np.bincount(labelled_image.ravel())
+    areas[0] = 0
+    biggest = int(np.argmax(areas))
+    return int(areas[biggest]), ndi.find_objects(labelled_image, max_label=biggest)[biggest - 1]
+
+
+def clear_background(img: np.ndarray, mask: np.ndarray, out: np.ndarray = None) -> np.ndarray:
     """given an image and a binary mask, clears all pixels in the image (ie sets to zero)
-    the zero/false pixels in the mask"""
-    i = img.copy()
-    a = i[:, :, 0] * mask
-    b = i[:, :, 1] * mask
-    c = i[:, :, 2] * mask
-    return np.dstack([a, b, c])
+    the zero/false pixels in the mask. Pass out=img to clear the image in place."""
+    return np.multiply(img, mask[:, :, np.newaxis], out=out)
 
 
-def run_threshold_preview(image: np.ndarray, height: int = 15, width: int = 15, slider_width: int = 500, perfect: bool=False, scale: float = 0.25) -> None:
+def run_threshold_preview(image: Union[np.ndarray, str], height: int = 15, width: int = 15, slider_width: int = 500, perfect: bool=False, scale: float = 0.25, exact_counts: bool = False) -> None:
     """ Given an HSV image, generates some sliders and an overlay image. Shows the image colouring the
     pixels that are included in the sliders thresholds in red. Note this does not return an image or
     mask of those pixels, its just a tool for finding the thresholds
 
     If `perfect = False` (default) the image is downsized by a factor in `scale` (default = 0.25) before running the thresholding.
 
+    `image` can also be the path to an image file. Then unless `perfect = True` the file is loaded already
+    downsized, see load_as_hsv, which for a JPEG is much quicker than loading it in full, and the pixel counts
+    shown are of the downsized image.
+
+    Unless `perfect = True` the selected pixels are counted from an HSVHistogram with a bin per slider step, built
+    once. It counts the bins wholly within the thresholds, so the count can miss pixels lying exactly on an upper
+    threshold. With `exact_counts = True` the histogram also keeps its pixels sorted by bin for exact counts, which
+    takes longer to build.
+
     """
+    if isinstance(image, str):
+        reduce = 1 if perfect else max(r for r in REDUCE_FACTORS if r * scale <= 1)
+        image = load_as_hsv(image, reduce=reduce)
+        scale = scale * reduce
 
     if perfect:
         _perfect_threshold_preview(image, height=height, width=width, slider_width=slider_width)
     else:
-        _fast_threshold_preview(image, height=height, width=width, slider_width=slider_width, scale=scale)
+        _fast_threshold_preview(image, height=height, width=width, slider_width=slider_width, scale=scale,
+                                exact_counts=exact_counts)
+
 
+#: the step of the threshold preview sliders
+PREVIEW_SLIDER_STEP = 0.01
 
-def _fast_threshold_preview(image: np.ndarray, height: int = 15,  width: int = 15, slider_width: int = 500, scale: float = 0.25):
+
+def _fast_threshold_preview(image: np.ndarray, height: int = 15,  width: int = 15, slider_width: int = 500, scale: float = 0.25, exact_counts: bool = False):
     slider_width = str(slider_width) + 'px'
+    # full size pixel counts for each slider setting without re-thresholding the full size image, with bin edges on
+    # the slider steps so that whole bin counts are all but exact
+    hist = HSVHistogram(image, bins=round(1 / PREVIEW_SLIDER_STEP), exact=exact_counts)
+    # the downsized image is made once, each slider change copies it to draw on
+    if scale == 1:
+        preview = image
+    else:
+        out_shape = list(image.shape)
+        out_shape[0] = int(out_shape[0] * scale)
+        out_shape[1] = int(out_shape[1] * scale)
+        preview = transform.resize(image, tuple(out_shape))
 
 
     @widgets.interact(
-        h=FloatRangeSlider(min=0., max=1., step=0.01, readout_format='.2f', layout={'width': slider_width}, continuous_update = False),
-        s=FloatRangeSlider(min=0., max=1., step=0.01, readout_format='.2f', layout={'width': slider_width}, continuous_update = False),
-        v=FloatRangeSlider(min=0., max=1., step=0.01, readout_format='.2f', layout={'width': slider_width}, continuous_update = False)
+        h=FloatRangeSlider(min=0., max=1., step=PREVIEW_SLIDER_STEP, readout_format='.2f', layout={'width': slider_width}, continuous_update = False),
+        s=FloatRangeSlider(min=0., max=1., step=PREVIEW_SLIDER_STEP, readout_format='.2f', layout={'width': slider_width}, continuous_update = False),
+        v=FloatRangeSlider(min=0., max=1., step=PREVIEW_SLIDER_STEP, readout_format='.2f', layout={'width': slider_width}, continuous_update = False)
     )
 
     def interact_plot( h=(0.2, 0.4), s=(0.2, 0.4), v=(0.2, 0.4)):
-        out_shape = list(image.shape)
-        out_shape[0] = int(out_shape[0] * scale)
-        out_shape[1] = int(out_shape[1] * scale)
-        i = transform.resize(image, tuple(out_shape))
+        i = preview.copy()
 
         thresh = threshold_hsv_img(i, h=h, s=s, v=v)
 
@@ -548,7 +998,9 @@ def _fast_threshold_preview(image: np.ndarray, height: int = 15,  width: int = 1
         plt.figure(figsize=(width, height))
         plt.imshow(color.hsv2rgb(i))
 
-        return_string = "Selected Values\nHue: {0}\nSaturation: {1}\nValue: {2}\n".format(h, s, v)
+        selected = hist.count(h=h, s=s, v=v)
+        return_string = "Selected Values\nHue: {0}\nSaturation: {1}\nValue: {2}\nSelected Pixels: {5}{3} ({4:.2%})\n".format(
+            h, s, v, selected, selected / max(hist.total, 1), "" if exact_counts else "at least ")
         print(return_string)
 
 def _perfect_threshold_preview(image: np.ndarray, height: int = 15, width: int = 15,  slider_width: int = 500):
@@ -0,0 +1,177 @@
+"""
+hsvhistogram
+
+A module for counting the pixels of an HSV image that pass threshold settings without re-thresholding the image
+
+
+Workflow Overview
+-----------------
+
+1. Build the histogram once per image, one scan of the pixels
+2. Count the pixels in any hue, saturation and value threshold box in constant time, as often as needed
+
+The histogram quantises each channel into `bins` equal bins and keeps a 3-D summed-volume table of the counts, so
+the number of pixels in any box of whole bins is found from eight table look ups. Boxes whose limits fall inside a
+bin are counted exactly by adding the pixels in the part-covered bins, which are kept sorted by bin so only those
+pixels are tested. Counts match np.sum(rp.threshold_hsv_img(img, h, s, v)).
+
+Basic Usage
+-----------
+
+1. Import module, build a histogram
+
+    .. highlight:: python
+    .. code-block:: python
+
+        import greypatch as rp
+        hist = rp.HSVHistogram(hsv_image)
+
+2. Count pixels passing a threshold
+
+    .. highlight:: python
+    .. code-block:: python
+
+        hist.count(h=(0.0, 0.16), s=(0.15, 1.0), v=(0.2, 0.35))
+
+3. Count only within a mask, eg a leaf
+
+    .. highlight:: python
+    .. code-block:: python
+
+        leaf_hist = rp.HSVHistogram(hsv_image, mask=leaf_mask)
+
+"""
+
+import numpy as np
+from typing import Tuple
+
+
+class HSVHistogram(object):
+    """
+    class representing a quantised 3-D histogram of HSV pixel values with a summed-volume table
+
+    :ivar bins: number of bins per channel
+    :ivar edges: the bin edges, bins + 1 values from 0.0 to 1.0. Bin b holds edges[b] <= x < edges[b + 1], the last
+        bin also holds 1.0
+    :ivar counts: np.ndarray of shape (bins, bins, bins), pixel counts per (h, s, v) bin
+    :ivar table: np.ndarray of shape (bins + 1, bins + 1, bins + 1), the summed-volume table of counts
+    :ivar total: number of pixels counted
+    """
+
+    def __init__(self, hsv_img: np.ndarray, bins: int = 64, mask: np.ndarray = None, exact: bool = True):
+        """
+        :param: hsv_img np.ndarray -- an HSV image in (0.0, 1.0)
+        :param: bins int -- number of bins per channel
+        :param: mask np.ndarray -- optional binary mask, only pixels where it is True are counted
+        :param: exact bool -- keep the pixel order needed for exact counts of boxes that are not whole bins
+        """
+        self.bins = bins
+        self.edges = np.linspace(0.0, 1.0, bins + 1)
+        if mask is None:
+            pixels = hsv_img.reshape(-1, 3)
+        else:
+            pixels = hsv_img[mask.astype(np.bool_)]
+        self.total = pixels.shape[0]
+
+        flat = self._flat_bins(pixels)
+        self.counts = np.bincount(flat, minlength=bins ** 3).reshape(bins, bins, bins)
+        self.table = np.zeros((bins + 1, bins + 1, bins + 1), dtype=np.int64)
+        self.table[1:, 1:, 1:] = self.counts.cumsum(axis=0).cumsum(axis=1).cumsum(axis=2)
+
+        self._pixels = None
+        if exact:
+            index_type = np.int32 if self.total < np.iinfo(np.int32).max else np.int64
+            self._pixels = pixels
+            self._order = np.argsort(flat, kind='stable').astype(index_type)
+            self._offsets = np.concatenate([[0], np.cumsum(self.counts.ravel())])
+
+    def _flat_bins(self, pixels: np.ndarray) -> np.ndarray:
+        """bin index of each pixel, flattened over (h, s, v)"""
+        idx = np.clip(np.searchsorted(self.edges, pixels, side='right') - 1, 0, self.bins - 1)
+        return (idx[:, 0] * self.bins + idx[:, 1]) * self.bins + idx[:, 2]
+
+    def merge(self, other: "HSVHistogram") -> "HSVHistogram":
+        """
+        Add the counts of another histogram with the same bins to this one, eg to pool several images. The merged
+        histogram counts whole bins only.
+
+        :param: other HSVHistogram -- the histogram to add
+        :return: HSVHistogram, this histogram
+        """
+        if other.bins != self.bins:
+            raise ValueError("can't merge histograms with {} and {} bins".format(self.bins, other.bins))
+        self.counts = self.counts + other.counts
+        self.table = self.table + other.table
+        self.total += other.total
+        self._pixels = None
+        return self
+
+    def box_counts(self, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+        """
+        Count the pixels in boxes of whole bins, in constant time per box.
+
+        Box i covers bins lower[i, c] <= b < upper[i, c] in each channel c.
+
+        :param: lower np.ndarray -- integer array of shape (n, 3) or (3,), the first bin of each box per channel
+        :param: upper np.ndarray -- integer array of shape (n, 3) or (3,), one past the last bin of each box
+        :return: np.ndarray of n counts, or a single count
+        """
+        lower = np.asarray(lower)
+        upper = np.maximum(np.asarray(upper), lower)
+        h0, s0, v0 = lower[..., 0], lower[..., 1], lower[..., 2]
+        h1, s1, v1 = upper[..., 0], upper[..., 1], upper[..., 2]
+        t = self.table
+        return (t[h1, s1, v1] - t[h0, s1, v1] - t[h1, s0, v1] - t[h1, s1, v0]
+                + t[h0, s0, v1] + t[h0, s1, v0] + t[h1, s0, v0] - t[h0, s0, v0])
+
+    def _bin_ranges(self, limits):
+        """outer and inner bin ranges [first, last) of threshold limits on one channel"""
+        lower, upper = limits
+        outer = (max(np.searchsorted(self.edges, lower, side='right') - 1, 0),
+                 min(np.searchsorted(self.edges, upper, side='right'), self.bins))
+        inner = (np.searchsorted(self.edges, lower, side='left'),
+                 np.searchsorted(self.edges, upper, side='right') - 1)
+        return outer, inner
+
+    def count(self, h: Tuple[float, float] = (0.0, 1.0), s: Tuple[float, float] = (0.0, 1.0),
+              v: Tuple[float, float] = (0.0, 1.0), exact: bool = True) -> int:
+        """
+        Count the pixels passing threshold limits in all three channels, as threshold_hsv_img would select them.
+
+        With exact = False, or a histogram built without exact support, the count is of the bins that lie wholly
+        within the limits, a lower bound that is exact when the limits fall on bin edges.
+
+        :param: h Tuple -- a 2-tuple of Hue thresholds (lower, upper)
+        :param: s Tuple -- a 2-tuple of Saturation thresholds (lower, upper)
+        :param: v Tuple -- a 2-tuple of Value thresholds (lower, upper)
+        :param: exact bool -- count the pixels in part-covered bins too
+        :return: int
+        """
+        limits = (h, s, v)
+        if any(lower > upper for lower, upper in limits):
+            return 0
+        ranges = [self._bin_ranges(l) for l in limits]
+        outer = np.array([r[0] for r in ranges])
+        inner = np.array([r[1] for r in ranges])
+        inner_count = int(self.box_counts(inner[:, 0], inner[:, 1]))
+        if not exact or self._pixels is None:
+            return inner_count
+
+        # bins in the outer box but not the inner box are only part covered, test their pixels
+        grids = np.meshgrid(*[np.arange(o0, o1) for o0, o1 in outer], indexing='ij')
+        in_inner = np.ones(grids[0].shape, dtype=np.bool_)
+        for grid, (i0, i1) in zip(grids, inner):
+            in_inner &= (grid >= i0) & (grid < i1)
+        shell = ((grids[0] * self.bins + grids[1]) * self.bins + grids[2])[~in_inner]
+        starts = self._offsets[shell]
+        lengths = self._offsets[shell + 1] - starts
+        nonzero = lengths > 0
+        starts, lengths = starts[nonzero], lengths[nonzero]
+        if len(starts) == 0:
+            return inner_count
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        pixels = self._pixels[self._order[positions]]
+        passing = np.ones(len(pixels), dtype=np.bool_)
+        for c, (lower, upper) in enumerate(limits):
+            passing &= (pixels[:, c] >= lower) & (pixels[:, c] <= upper)
+        return inner_count + int(passing.sum())
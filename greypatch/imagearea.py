@@ -46,21 +46,33 @@ class ImageArea(object):
 class HealthyArea(ImageArea):
     pass
 
+def lesion_passes(area, size, scale, min_lesion_area):
+    """
+    whether a lesion passes the minimum area filter, on its size if the scale is known else its pixel area
+
+    :param area: the lesion's area in pixels
+    :param size: the lesion's size in real units, NA if the scale is not known
+    :param scale: the scale of the image, NA if not known
+    :param min_lesion_area: the minimum area to pass
+    :return: bool
+    """
+    if scale == "NA":
+        if area < min_lesion_area:
+            return False
+        else:
+            return True
+    else:
+        if size < min_lesion_area:
+            return False
+        else:
+            return True
+
+
 class LesionArea(ImageArea):
 
     def __init__(self, rprop, scale, pixel_length, min_lesion_area = None):
         super().__init__(rprop, scale, pixel_length)
-        if self.scale == "NA":
-            if self.area < min_lesion_area:
-                self.passed = False
-            else:
-                self.passed = True
-        else:
-            #self.size = self.area / self.scale
-            if self.size < min_lesion_area:
-                self.passed = False
-            else:
-                self.passed = True
+        self.passed = lesion_passes(self.area, self.size, self.scale, min_lesion_area)
         self.matches_with = None
 
 
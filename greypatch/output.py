@@ -0,0 +1,203 @@
+"""
+output
+
+A module for choosing which images are written for the sub-images of a run, at what size and in which format
+
+
+Workflow Overview
+-----------------
+
+1. Create an output profile
+2. Write each image's sub-images with it, in place of SubImage.write_sub_image and write_annotated_sub_image
+
+The profiles are
+
+* full -- the sub-image at full resolution and the annotated sub-image at 72 DPI, as always written
+* annotated-only -- only the annotated sub-image
+* thumbnails -- the sub-image and annotated sub-image scaled down so their longer side is at most max_side pixels.
+  The annotated image is drawn at the smaller size rather than drawn full size and scaled
+* none -- no images, only the results files
+
+Images can be written as JPEG, PNG or WebP, JPEG and WebP at the given quality. The full profile as JPEG writes the
+same files as SubImage.write_sub_image and write_annotated_sub_image. With contact_sheet the sub-images of an image
+are put into one file, and the annotated sub-images into another, in a grid in sub-image order, instead of a file
+each.
+
+Basic Usage
+-----------
+
+1. Import module, create a profile
+
+    .. highlight:: python
+    .. code-block:: python
+
+        import greypatch as rp
+        profile = rp.OutputProfile("thumbnails", image_format="webp", max_side=256, quality=60)
+
+2. Write an image's sub-images
+
+    .. highlight:: python
+    .. code-block:: python
+
+        profile.write(sub_images, "leaf.jpg", "~/Desktop/test_out")
+
+3. Or use it in a run
+
+    .. highlight:: python
+    .. code-block:: python
+
+        rp.batch_process(folder="~/Desktop/input_images", settings="~/Desktop/default_filter.yml",
+                         destination_folder="~/Desktop/test_out", pixels_per_cm=412, output=profile)
+
+"""
+
+import math
+import os
+import numpy as np
+from PIL import Image
+from typing import List
+
+#: the output profiles, see OutputProfile
+OUTPUT_PROFILES = ("full", "annotated-only", "thumbnails", "none")
+
+#: the formats images can be written in
+IMAGE_FORMATS = ("jpg", "png", "webp")
+
+_PIL_FORMATS = {"jpg": "JPEG", "png": "PNG", "webp": "WEBP"}
+
+
+def contact_sheet(images: List[np.ndarray], columns: int = None, gap: int = 4, background: int = 255) -> np.ndarray:
+    """
+    Put images into one image, in a grid of equal cells filled row by row, each image at the top left of its cell.
+
+    :param: images List -- uint8 RGB images
+    :param: columns int -- number of columns, by default the square root of the number of images rounded up
+    :param: gap int -- pixels between cells
+    :param: background int -- grey level of the space around the images
+    :return: np.ndarray -- uint8 RGB image
+    """
+    if columns is None:
+        columns = max(math.ceil(math.sqrt(len(images))), 1)
+    rows = max(math.ceil(len(images) / columns), 1)
+    cell_h = max([i.shape[0] for i in images], default=1)
+    cell_w = max([i.shape[1] for i in images], default=1)
+    sheet = np.full((rows * cell_h + (rows - 1) * gap, columns * cell_w + (columns - 1) * gap, 3), background,
+                    dtype=np.uint8)
+    for n, image in enumerate(images):
+        top = (n // columns) * (cell_h + gap)
+        left = (n % columns) * (cell_w + gap)
+        sheet[top:top + image.shape[0], left:left + image.shape[1]] = image
+    return sheet
+
+
+class OutputProfile(object):
+    """
+    class representing the choice of images written for each sub-image
+
+    :ivar profile: one of OUTPUT_PROFILES
+    :ivar image_format: one of IMAGE_FORMATS
+    :ivar max_side: the longest side of thumbnails in pixels
+    :ivar quality: JPEG and WebP quality, 1 to 100. Ignored for PNG
+    :ivar contact_sheet: write one file of sub-images and one of annotated sub-images per image
+    """
+
+    def __init__(self, profile: str = "full", image_format: str = "jpg", max_side: int = 256, quality: int = 75,
+                 contact_sheet: bool = False):
+        if profile not in OUTPUT_PROFILES:
+            raise ValueError("unknown output profile '{}', use one of {}".format(profile, ", ".join(OUTPUT_PROFILES)))
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError("unknown image format '{}', use one of {}".format(image_format, ", ".join(IMAGE_FORMATS)))
+        if max_side < 1 or not 1 <= quality <= 100:
+            raise ValueError("max_side must be at least 1 and quality from 1 to 100")
+        self.profile = profile
+        self.image_format = image_format
+        self.max_side = max_side
+        self.quality = quality
+        self.contact_sheet = contact_sheet
+
+    @property
+    def writes_sub_images(self) -> bool:
+        """whether the profile writes the sub-images"""
+        return self.profile in ("full", "thumbnails")
+
+    @property
+    def writes_annotated(self) -> bool:
+        """whether the profile writes the annotated sub-images"""
+        return self.profile in ("full", "annotated-only", "thumbnails")
+
+    def _thumbnail_side(self):
+        return self.max_side if self.profile == "thumbnails" else None
+
+    def sub_image(self, sub_image) -> np.ndarray:
+        """
+        The sub-image as the profile writes it.
+
+        :param: sub_image SubImage -- the sub-image
+        :return: np.ndarray -- uint8 RGB image
+        """
+        rgb = sub_image.sub_rgb
+        max_side = self._thumbnail_side()
+        if max_side is None or max(rgb.shape[:2]) <= max_side:
+            return rgb
+        img = Image.fromarray(rgb)
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        return np.asarray(img)
+
+    def annotated_image(self, sub_image) -> np.ndarray:
+        """
+        The annotated sub-image as the profile writes it.
+
+        :param: sub_image SubImage -- the sub-image
+        :return: np.ndarray -- uint8 RGB image
+        """
+        return sub_image.annotated_image(max_side=self._thumbnail_side())
+
+    def save(self, image: np.ndarray, stem: str) -> str:
+        """
+        Write an image in the profile's format.
+
+        :param: image np.ndarray -- uint8 RGB image
+        :param: stem str -- the file to write, without extension
+        :return: str the file written
+        """
+        file = "{}.{}".format(stem, self.image_format)
+        options = {} if self.image_format == "png" else {'quality': self.quality}
+        Image.fromarray(image).save(file, format=_PIL_FORMATS[self.image_format], **options)
+        return file
+
+    def write(self, sub_images: List, image_file: str, destination_folder: str) -> List[str]:
+        """
+        Write the images of an image's sub-images that the profile asks for.
+
+        :param: sub_images List -- the image's SubImages, with a dest_folder unless writing contact sheets
+        :param: image_file str -- the image the sub-images are from, naming the contact sheets
+        :param: destination_folder str -- folder to write contact sheets in
+        :return: List of the files written
+        """
+        if self.profile == "none" or len(sub_images) == 0:
+            return []
+        files = []
+        if self.contact_sheet:
+            stem = os.path.join(destination_folder, os.path.basename(image_file))
+            if self.writes_sub_images:
+                files.append(self.save(contact_sheet([self.sub_image(s) for s in sub_images]), stem + "_sub_images"))
+            if self.writes_annotated:
+                files.append(self.save(contact_sheet([self.annotated_image(s) for s in sub_images]),
+                                       stem + "_annotated"))
+            return files
+
+        as_before = self.profile == "full" and self.image_format == "jpg"
+        for s in sub_images:
+            if self.writes_sub_images:
+                if as_before:
+                    s.write_sub_image()
+                    files.append(s.imtag)
+                else:
+                    files.append(self.save(self.sub_image(s), os.path.splitext(s.imtag)[0]))
+            if self.writes_annotated:
+                if as_before:
+                    s.write_annotated_sub_image()
+                    files.append(s.annot_imtag)
+                else:
+                    files.append(self.save(self.annotated_image(s), os.path.splitext(s.annot_imtag)[0]))
+        return files
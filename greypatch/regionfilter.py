@@ -0,0 +1,210 @@
+"""
+regionfilter
+
+A module for selecting labelled regions with declarative filter expressions, evaluated on whole columns of region
+properties at once rather than by calling a Python function on each region
+
+
+Workflow Overview
+-----------------
+
+1. Write a filter expression over region properties, eg "area >= 2500" or "major/minor >= 2 & area >= 90000"
+2. Select the labels of the regions in a label image that pass it, or filter a list of region properties
+
+Expressions may use the names of any skimage.measure.regionprops_table scalar property, numbers, the arithmetic
+operators + - * /, the comparisons < <= > >= == != and & (and), | (or), ~ (not), with brackets. Comparisons bind
+more tightly than & and |. major and minor are short for major_axis_length and minor_axis_length. A division by
+zero gives NaN, and a comparison with NaN is False, so a region whose value can't be calculated doesn't pass.
+
+Filters for a FilterSettings tag can be set with its 'filter' key, see FilterSettings.add_setting.
+
+Basic Usage
+-----------
+
+1. Import module, create a filter
+
+    .. highlight:: python
+    .. code-block:: python
+
+        import greypatch as rp
+        f = rp.RegionFilter("major/minor >= 2 & area >= 90000")
+
+2. Get the labels of the regions that pass
+
+    .. highlight:: python
+    .. code-block:: python
+
+        labels_to_keep = f.select(label_array)
+
+3. Or filter a list of region properties
+
+    .. highlight:: python
+    .. code-block:: python
+
+        kept = rp.filter_region_property_list(region_props, "area >= 2500")
+
+"""
+
+import ast
+import re
+import numpy as np
+from skimage import measure
+from typing import Dict, List
+
+#: short names that can be used in filter expressions for region properties
+REGION_FILTER_ALIASES = {
+    'major': 'major_axis_length',
+    'minor': 'minor_axis_length',
+}
+
+#: the filter used to select leaves in get_sub_images when the leaf_area setting has no filter
+LEAF_AREA_FILTER = "area >= 2500"
+
+_COMPARISONS = {
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+}
+
+_ARITHMETIC = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+}
+
+
+def _divide(a, b):
+    """division giving NaN where the divisor is zero"""
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64))
+    return np.divide(a, b, out=np.full(a.shape, np.nan), where=b != 0)
+
+
+class RegionFilter(object):
+    """
+    class representing a parsed region filter expression
+
+    :ivar expression: the expression as given
+    :ivar columns: the region properties the expression uses, with aliases expanded
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        # & | ~ are the familiar pandas spellings but bind more tightly than comparisons in Python, so they are
+        # read as and, or, not
+        text = re.sub(r"&&?", " and ", expression)
+        text = re.sub(r"\|\|?", " or ", text)
+        text = text.replace("~", " not ")
+        try:
+            self._tree = ast.parse(text.strip(), mode="eval")
+        except SyntaxError as e:
+            raise ValueError("can't parse region filter '{}': {}".format(expression, e.msg))
+        self.columns = []
+        self._check(self._tree.body)
+
+    def _check(self, node):
+        """checks an expression node only uses allowed operations, collecting the property names it uses"""
+        if isinstance(node, ast.BoolOp):
+            for value in node.values:
+                self._check(value)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.USub, ast.UAdd)):
+            self._check(node.operand)
+        elif isinstance(node, ast.BinOp) and (type(node.op) in _ARITHMETIC or isinstance(node.op, ast.Div)):
+            self._check(node.left)
+            self._check(node.right)
+        elif isinstance(node, ast.Compare) and all(type(op) in _COMPARISONS for op in node.ops):
+            self._check(node.left)
+            for comparator in node.comparators:
+                self._check(comparator)
+        elif isinstance(node, ast.Name):
+            column = REGION_FILTER_ALIASES.get(node.id, node.id)
+            if column not in self.columns:
+                self.columns.append(column)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) \
+                and not isinstance(node.value, bool):
+            pass
+        else:
+            raise ValueError("region filter '{}' can't use '{}'".format(self.expression, ast.dump(node)))
+
+    def _evaluate(self, node, table):
+        if isinstance(node, ast.BoolOp):
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            result = self._truth(self._evaluate(node.values[0], table))
+            for value in node.values[1:]:
+                result = combine(result, self._truth(self._evaluate(value, table)))
+            return result
+        if isinstance(node, ast.UnaryOp):
+            operand = self._evaluate(node.operand, table)
+            if isinstance(node.op, ast.Not):
+                return np.logical_not(self._truth(operand))
+            return -operand if isinstance(node.op, ast.USub) else operand
+        if isinstance(node, ast.BinOp):
+            left, right = self._evaluate(node.left, table), self._evaluate(node.right, table)
+            if isinstance(node.op, ast.Div):
+                return _divide(left, right)
+            return _ARITHMETIC[type(node.op)](left, right)
+        if isinstance(node, ast.Compare):
+            left = self._evaluate(node.left, table)
+            result = None
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self._evaluate(comparator, table)
+                passed = _COMPARISONS[type(op)](left, right)
+                result = passed if result is None else np.logical_and(result, passed)
+                left = right
+            return result
+        if isinstance(node, ast.Name):
+            return np.asarray(table[REGION_FILTER_ALIASES.get(node.id, node.id)], dtype=np.float64)
+        return node.value
+
+    @staticmethod
+    def _truth(value):
+        """values used as conditions are true when non-zero, NaN is false"""
+        value = np.asarray(value)
+        if value.dtype == np.bool_:
+            return value
+        return np.nan_to_num(value.astype(np.float64), nan=0.0) != 0
+
+    def evaluate(self, table: Dict[str, np.ndarray]) -> np.ndarray:
+        """
+        Evaluate the filter on columns of region properties.
+
+        :param: table dict -- property name to array of values, one per region, with every name in columns
+        :return: np.ndarray of bool, one per region
+        """
+        missing = [c for c in self.columns if c not in table]
+        if missing:
+            raise ValueError("region filter '{}' needs properties {}".format(self.expression, missing))
+        n = len(next(iter(table.values()))) if table else 0
+        with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+            result = self._truth(self._evaluate(self._tree.body, table))
+        return np.broadcast_to(result, (n,)).copy()
+
+    def select(self, label_array: np.ndarray) -> np.ndarray:
+        """
+        Find the labels of the regions in a label image that pass the filter, computing only the properties the
+        filter uses.
+
+        :param: label_array np.ndarray -- a label image
+        :return: np.ndarray of the labels that pass, ascending
+        """
+        table = measure.regionprops_table(label_array, properties=['label'] + [c for c in self.columns
+                                                                             if c != 'label'])
+        return table['label'][self.evaluate(table)]
+
+    def filter(self, region_props: List) -> List:
+        """
+        Filter a list of region properties, or ImageAreas, reading only the properties the filter uses.
+
+        :param: region_props List -- list of skimage.measure.RegionProps objects
+        :return: List of the RegionProps that pass
+        """
+        table = {c: [getattr(r, c) for r in region_props] for c in self.columns}
+        if not table:
+            table = {'label': [getattr(r, 'label') for r in region_props]}
+        keep = self.evaluate(table)
+        return [r for r, k in zip(region_props, keep) if k]
+
+    def __repr__(self):
+        return "RegionFilter({!r})".format(self.expression)
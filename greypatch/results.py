@@ -0,0 +1,215 @@
+"""
+results
+
+A module for collecting the raw and matched lesion results of many sub-images into typed record buffers
+
+
+Workflow Overview
+-----------------
+
+1. Create an empty set of records, usually one per image
+2. Add the inner and outer lesion areas of each sub-image, once their inner and outer lesions have been matched
+3. Make the raw and matched results DataFrames once, when all the sub-images have been added
+
+Rows are written into preallocated NumPy record arrays that grow as needed, and the matched results are made from
+the matched pairs directly, so no DataFrame is made, appended to, queried or merged per sub-image. The columns,
+their order within a sub-image and the values are those of SubImage.get_results_dataframes and the matched
+results made from them.
+
+Basic Usage
+-----------
+
+1. Import module, create records
+
+    .. highlight:: python
+    .. code-block:: python
+
+        import greypatch as rp
+        records = rp.ResultRecords()
+
+2. Add sub-images
+
+    .. highlight:: python
+    .. code-block:: python
+
+        for s in sub_images:
+            records.add_sub_image(s.inner_lesion_area_props, s.outer_lesion_area_props,
+                                  image_file=s.parent_image_file, sub_image_index=s.index, passed_only=True)
+
+3. Make DataFrames
+
+    .. highlight:: python
+    .. code-block:: python
+
+        raw_df = records.raw_frame()
+        matched_df = records.matched_frame()
+
+"""
+
+import numpy as np
+import pandas as pd
+from typing import List, Tuple
+
+#: record type of a row of the raw results. Scales and sizes may be "NA" and pixel areas keep the type of the
+#: region's area, so they are held as objects
+RAW_RESULTS_DTYPE = np.dtype([
+    ('label', np.int64),
+    ('area_type', object),
+    ('matched_with', object),
+    ('passed', np.bool_),
+    ('pixels_in_area', object),
+    ('scale', object),
+    ('size', object),
+    ('image_file', object),
+    ('sub_image_index', np.int64),
+])
+
+#: record type of a row of the matched results, an outer lesion's raw results (_x) then its inner lesion's (_y)
+MATCHED_RESULTS_DTYPE = np.dtype(
+    [(name + "_x", np.int64 if name == 'matched_with' else RAW_RESULTS_DTYPE[name])
+     for name in RAW_RESULTS_DTYPE.names] +
+    [(name + "_y", RAW_RESULTS_DTYPE[name]) for name in RAW_RESULTS_DTYPE.names] +
+    [('outer_inner_ratio_pixels', np.float64)]
+)
+
+
+class _RecordBuffer(object):
+    """a growable, preallocated array of records"""
+
+    def __init__(self, dtype, capacity=64):
+        self._data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def reserve(self, n):
+        """makes room for n more records, doubling the capacity as needed"""
+        needed = self.size + n
+        if needed > len(self._data):
+            grown = np.empty(max(needed, 2 * len(self._data)), dtype=self._data.dtype)
+            grown[:self.size] = self._data[:self.size]
+            self._data = grown
+
+    def append(self, record):
+        self.reserve(1)
+        self._data[self.size] = record
+        self.size += 1
+
+    @property
+    def records(self):
+        return self._data[:self.size]
+
+
+class ResultRecords(object):
+    """
+    class representing the raw and matched lesion results of a set of sub-images
+
+    :ivar sub_images: the number of sub-images added
+    :ivar has_matched: whether any sub-image had both inner and outer lesion results, so that it has matched
+        results, possibly none
+    """
+
+    def __init__(self, capacity: int = 64):
+        self._raw = _RecordBuffer(RAW_RESULTS_DTYPE, capacity)
+        self._matched = _RecordBuffer(MATCHED_RESULTS_DTYPE, max(capacity // 2, 1))
+        self.sub_images = 0
+        self.has_matched = False
+
+    def add_sub_image(self, inner_areas: List, outer_areas: List, image_file: str = None,
+                      sub_image_index: int = None, passed_only: bool = False) -> None:
+        """
+        Add the results of a sub-image's inner and outer lesion areas. Areas should have been matched already, see
+        match_inner_outer.
+
+        When the sub-image has both inner and outer results its outer rows come first and matched_with is given as
+        a string, "None" for lesions that didn't match, and the matched pairs are added to the matched results.
+        Otherwise its inner rows come first and matched_with is left empty.
+
+        :param: inner_areas List -- the sub-image's inner LesionAreas
+        :param: outer_areas List -- the sub-image's outer LesionAreas
+        :param: image_file str -- the image the sub-image is from
+        :param: sub_image_index int -- the index of the sub-image
+        :param: passed_only bool -- only add areas that pass the filter
+        :return: None
+        """
+        if passed_only:
+            inner_areas = [r for r in inner_areas if r.passed]
+            outer_areas = [r for r in outer_areas if r.passed]
+        paired = len(inner_areas) > 0 and len(outer_areas) > 0
+        self.sub_images += 1
+        if paired:
+            groups = (("outer_lesion_area", outer_areas), ("inner_lesion_area", inner_areas))
+        else:
+            groups = (("inner_lesion_area", inner_areas), ("outer_lesion_area", outer_areas))
+
+        rows = {}
+        self._raw.reserve(len(inner_areas) + len(outer_areas))
+        for area_type, areas in groups:
+            for r in areas:
+                matched_with = str(r.matches_with) if paired else r.matches_with
+                row = (r.label, area_type, matched_with, r.passed, r.area, r.scale, r.size, image_file,
+                       sub_image_index)
+                self._raw.append(row)
+                rows[area_type, r.label] = row
+        if not paired:
+            return
+
+        self.has_matched = True
+        for outer in outer_areas:
+            if outer.matches_with is None:
+                continue
+            inner_row = rows.get(("inner_lesion_area", int(outer.matches_with)))
+            if inner_row is None or inner_row[2] == "None":
+                continue
+            outer_row = rows["outer_lesion_area", outer.label]
+            ratio = np.float64(inner_row[4]) / np.float64(outer_row[4])
+            self._matched.append(outer_row[:2] + (int(outer_row[2]),) + outer_row[3:] + inner_row + (ratio,))
+
+    def add(self, other: "ResultRecords") -> None:
+        """
+        Add the results of another set of records after these.
+
+        :param: other ResultRecords -- the records to add
+        :return: None
+        """
+        for buffer, records in ((self._raw, other.raw), (self._matched, other.matched)):
+            buffer.reserve(len(records))
+            buffer._data[buffer.size:buffer.size + len(records)] = records
+            buffer.size += len(records)
+        self.sub_images += other.sub_images
+        self.has_matched = self.has_matched or other.has_matched
+
+    @property
+    def raw(self) -> np.ndarray:
+        """the raw results records, a view of RAW_RESULTS_DTYPE records"""
+        return self._raw.records
+
+    @property
+    def matched(self) -> np.ndarray:
+        """the matched results records, a view of MATCHED_RESULTS_DTYPE records"""
+        return self._matched.records
+
+    def raw_frame(self) -> pd.DataFrame:
+        """
+        make the raw results DataFrame
+
+        :return: pandas.DataFrame
+        """
+        return pd.DataFrame.from_records(self.raw, columns=RAW_RESULTS_DTYPE.names)
+
+    def matched_frame(self) -> pd.DataFrame:
+        """
+        make the matched results DataFrame
+
+        :return: pandas.DataFrame
+        """
+        return pd.DataFrame.from_records(self.matched, columns=MATCHED_RESULTS_DTYPE.names)
+
+    def results_dataframes(self) -> Tuple[List[pd.DataFrame], List[pd.DataFrame]]:
+        """
+        make the raw and matched results DataFrames as lists, as process_image returns them. The raw list is empty
+        if no sub-images were added and the matched list if no sub-image had matched results
+
+        :return: list of raw results DataFrames, list of matched results DataFrames
+        """
+        raw_dfs = [self.raw_frame()] if self.sub_images > 0 else []
+        match_dfs = [self.matched_frame()] if self.has_matched else []
+        return raw_dfs, match_dfs
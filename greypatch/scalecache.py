@@ -0,0 +1,178 @@
+"""
+scalecache
+
+A module for re-using scale card measurements across images taken on the same fixed camera rig
+
+
+Workflow Overview
+-----------------
+
+1. Create a cache, optionally backed by a file
+2. Look up the scale for an image, detecting the scale card only when the cache has no validated value
+3. Record detected scales so that the rig's value can be validated and re-used
+4. Write the cache to file for re-use in later runs
+
+Images are grouped into rigs by their camera EXIF metadata (make, model, lens and focal length) and their
+dimensions. A rig's pixels per cm value is validated once `min_observations` detections agree to within
+`tolerance` (as a proportion of their median).
+
+Basic Usage
+-----------
+
+1. Import module, create a cache
+
+    .. highlight:: python
+    .. code-block:: python
+
+        import greypatch as rp
+        cache = rp.ScaleCache("scale_cache.yml")
+
+2. Look up or detect the scale
+
+    .. highlight:: python
+    .. code-block:: python
+
+        scale = cache.lookup(imfile)
+        if scale is None:
+            scale = rp.griffin_scale_card(rp.load_as_hsv(imfile), h, s, v, side_length=5)
+            cache.record(imfile, scale)
+
+3. Write the cache to a file
+
+    .. highlight:: python
+    .. code-block:: python
+
+        cache.write()
+
+"""
+
+import os
+import tempfile
+import threading
+import yaml
+import numpy as np
+from PIL import Image
+from typing import Union
+
+#: EXIF tags used to identify a camera rig, in IFD0
+_IFD0_TAGS = {271: "make", 272: "model"}
+#: EXIF tags used to identify a camera rig, in the Exif sub-IFD
+_EXIF_TAGS = {42036: "lens", 37386: "focal_length"}
+_EXIF_IFD_POINTER = 0x8769
+
+
+class ScaleCache(object):
+    """
+    class representing stored pixels per cm values for fixed camera rigs
+
+    :ivar file: the file the cache is read from and written to, if any
+    :ivar min_observations: number of agreeing detections needed before a rig's value is re-used
+    :ivar tolerance: maximum spread of agreeing detections as a proportion of their median
+    :ivar entries: dict of rig key to {'observations': list of float, 'pixels_per_cm': float or None}
+
+    A cache can be shared by threads, eg the jobs of a Worker, recording, looking up and writing are done one at a
+    time.
+    """
+
+    def __init__(self, file: str = None, min_observations: int = 3, tolerance: float = 0.02):
+        self.file = file
+        self.min_observations = min_observations
+        self.tolerance = tolerance
+        self.entries = {}
+        self._lock = threading.Lock()
+        if file and os.path.exists(file):
+            self.read(file)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def rig_key(imfile: str) -> str:
+        """
+        make the key identifying the camera rig an image was taken with, from EXIF metadata and image dimensions.
+        Reads only the image header, the pixels are not decoded.
+
+        :param: imfile str -- path to the image
+        :return: str
+        """
+        with Image.open(imfile) as img:
+            width, height = img.size
+            exif = img.getexif()
+            values = {name: exif.get(tag) for tag, name in _IFD0_TAGS.items()}
+            try:
+                exif_ifd = exif.get_ifd(_EXIF_IFD_POINTER)
+            except (AttributeError, KeyError):
+                exif_ifd = {}
+            values.update({name: exif_ifd.get(tag) for tag, name in _EXIF_TAGS.items()})
+        fields = [str(values[name]).strip("\x00 ") if values[name] is not None else "unknown"
+                  for name in ("make", "model", "lens", "focal_length")]
+        return "|".join(fields + ["{}x{}".format(width, height)])
+
+    def lookup(self, imfile: str) -> Union[float, None]:
+        """
+        get the validated pixels per cm value for the rig an image was taken with
+
+        :param: imfile str -- path to the image
+        :return: float or None if the rig has no validated value yet
+        """
+        key = self.rig_key(imfile)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            return entry['pixels_per_cm']
+
+    def record(self, imfile: str, pixels_per_cm: float) -> None:
+        """
+        record a detected pixels per cm value for the rig an image was taken with, validating the rig's value
+        when the most recent min_observations detections agree
+
+        :param: imfile str -- path to the image
+        :param: pixels_per_cm float -- the detected scale
+        :return: None
+        """
+        key = self.rig_key(imfile)
+        with self._lock:
+            entry = self.entries.setdefault(key, {'observations': [], 'pixels_per_cm': None})
+            entry['observations'].append(float(pixels_per_cm))
+            recent = entry['observations'][-self.min_observations:]
+            if len(recent) >= self.min_observations:
+                median = float(np.median(recent))
+                if (max(recent) - min(recent)) <= self.tolerance * median:
+                    entry['pixels_per_cm'] = median
+
+    def write(self, outfile: str = None) -> None:
+        """
+        write the cache to a yaml file. The file is written to a temporary file and moved into place, so it is
+        never left part written
+
+        :param: outfile str -- name of the file to write, defaults to the file the cache was created with
+        :return: None
+        """
+        outfile = outfile or self.file
+        with self._lock:
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(outfile)), suffix=".tmp",
+                                             delete=False) as file:
+                yaml.safe_dump(self.entries, file)
+            os.replace(file.name, outfile)
+
+    def read(self, infile: str):
+        """
+
+        :param: infile str -- name of the file to read
+        :return: ScaleCache
+        """
+        with open(infile) as file:
+            entries = yaml.safe_load(file) or {}
+        with self._lock:
+            self.entries = entries
+        return self
+
+    def __contains__(self, imfile):
+        return self.lookup(imfile) is not None
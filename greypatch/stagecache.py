@@ -0,0 +1,180 @@
+"""
+stagecache
+
+A module for keeping the output of each segmentation stage on disk, so that a run with changed settings recomputes
+only the stages whose settings changed
+
+
+Workflow Overview
+-----------------
+
+1. Create a cache in a folder, which can be shared by runs with different settings and images
+2. Pass it to get_sub_images, process_image or batch_process. Each stage's output is looked up before the stage is
+   run and stored after
+3. Change a band's settings and run again, only that band is segmented again
+
+The pipeline's stages and the settings each depends on are given in STAGE_SETTINGS. The leaf_area stage stores the
+leaf label image of the whole image, and each band stage stores its label image within every leaf of the image.
+Entries are keyed by a hash of the image file's bytes and of the settings the stage depends on, so changing the
+inner_lesion_area thresholds leaves the leaf, healthy and outer entries in use. The areas, their sizes and whether
+they pass the filter are made from the label images each run, so the scale and min_lesion_area can change without
+missing the cache. Images are still decoded and converted to HSV, for the sub-images written.
+
+Entries are never removed, delete the folder to clear the cache.
+
+Basic Usage
+-----------
+
+1. Import module, create a cache
+
+    .. highlight:: python
+    .. code-block:: python
+
+        import greypatch as rp
+        cache = rp.StageCache("~/Desktop/stage_cache")
+
+2. Use it in a run
+
+    .. highlight:: python
+    .. code-block:: python
+
+        rp.batch_process(folder="~/Desktop/input_images", settings="~/Desktop/default_filter.yml",
+                         destination_folder="~/Desktop/test_out", pixels_per_cm=412, stage_cache=cache)
+
+3. See which stages were re-used
+
+    .. highlight:: python
+    .. code-block:: python
+
+        cache.hits, cache.misses
+
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+import numpy as np
+from typing import Dict, Union
+
+#: changed when the output of a stage changes, so that older entries aren't used
+STAGE_CACHE_VERSION = 1
+
+#: the FilterSettings tags the output of each stage depends on
+STAGE_SETTINGS = {
+    'leaf_area': ('leaf_area',),
+    'healthy_area': ('leaf_area', 'healthy_area'),
+    'outer_lesion_area': ('leaf_area', 'outer_lesion_area'),
+    'inner_lesion_area': ('leaf_area', 'inner_lesion_area'),
+}
+
+#: the stages run within each leaf
+BAND_STAGES = ('healthy_area', 'outer_lesion_area', 'inner_lesion_area')
+
+
+def _canonical(value):
+    """settings values in a form that hashes the same however they were written, eg 1 and 1.0, tuple or list"""
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, (bool, np.bool_)) or value is None or isinstance(value, str):
+        return value
+    return float(value)
+
+
+class StageCache(object):
+    """
+    class representing stored stage outputs in a folder
+
+    :ivar folder: the folder entries are stored in
+    :ivar hits: dict of stage to the number of times its output was found in the cache
+    :ivar misses: dict of stage to the number of times it had to be run
+    """
+
+    def __init__(self, folder: str):
+        self.folder = os.path.expanduser(folder)
+        os.makedirs(self.folder, exist_ok=True)
+        self.hits = {}
+        self.misses = {}
+        self._image_hashes = {}
+
+    def image_hash(self, imfile: str) -> str:
+        """
+        Hash the bytes of an image file. Hashes are remembered while the file's size and modification time are
+        unchanged.
+
+        :param: imfile str -- path to the image
+        :return: str hex digest
+        """
+        stat = os.stat(imfile)
+        signature = (os.path.abspath(imfile), stat.st_size, stat.st_mtime_ns)
+        if signature not in self._image_hashes:
+            digest = hashlib.sha256()
+            with open(imfile, "rb") as file:
+                for block in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(block)
+            self._image_hashes[signature] = digest.hexdigest()
+        return self._image_hashes[signature]
+
+    def key(self, stage: str, image_hash: str, fs) -> str:
+        """
+        Make the key of a stage's output for an image and the settings it depends on.
+
+        :param: stage str -- one of STAGE_SETTINGS
+        :param: image_hash str -- the image's hash, see image_hash
+        :param: fs FilterSettings -- the settings of the run
+        :return: str hex digest
+        """
+        settings = {tag: _canonical(fs[tag]) if tag in fs else None for tag in STAGE_SETTINGS[stage]}
+        text = json.dumps({'version': STAGE_CACHE_VERSION, 'stage': stage, 'image': image_hash,
+                           'settings': settings}, sort_keys=True)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _path(self, stage, key):
+        return os.path.join(self.folder, "{}_{}.npz".format(stage, key))
+
+    def get(self, stage: str, image_hash: str, fs) -> Union[Dict[str, np.ndarray], None]:
+        """
+        Look up a stage's output.
+
+        :param: stage str -- one of STAGE_SETTINGS
+        :param: image_hash str -- the image's hash, see image_hash
+        :param: fs FilterSettings -- the settings of the run
+        :return: dict of name to array as stored by put, or None if there is no usable entry
+        """
+        path = self._path(stage, self.key(stage, image_hash, fs))
+        try:
+            with np.load(path) as arrays:
+                result = {name: arrays[name] for name in arrays.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            self.misses[stage] = self.misses.get(stage, 0) + 1
+            return None
+        self.hits[stage] = self.hits.get(stage, 0) + 1
+        return result
+
+    def put(self, stage: str, image_hash: str, fs, arrays: Dict[str, np.ndarray]) -> None:
+        """
+        Store a stage's output. The entry is written to a temporary file and moved into place, so processes sharing
+        the folder never read part of an entry.
+
+        :param: stage str -- one of STAGE_SETTINGS
+        :param: image_hash str -- the image's hash, see image_hash
+        :param: fs FilterSettings -- the settings of the run
+        :param: arrays dict -- name to array
+        :return: None
+        """
+        path = self._path(stage, self.key(stage, image_hash, fs))
+        with tempfile.NamedTemporaryFile(dir=self.folder, suffix=".npz.tmp", delete=False) as file:
+            np.savez_compressed(file, **arrays)
+        os.replace(file.name, path)
+
+    def summary(self) -> str:
+        """
+        the number of times each stage was found in the cache and run
+
+        :return: str
+        """
+        return ", ".join("{} {} cached {} run".format(stage, self.hits.get(stage, 0), self.misses.get(stage, 0))
+                         for stage in STAGE_SETTINGS if stage in self.hits or stage in self.misses)
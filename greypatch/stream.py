@@ -0,0 +1,136 @@
+"""
+stream
+
+A module for running the greypatch pipeline on images held in memory, yielding each image's results as it is done
+and writing nothing to disk, for use inside other programs
+
+
+Workflow Overview
+-----------------
+
+1. Read or make the FilterSettings
+2. Pass an iterable of (image id, image) pairs to stream_images. Images can be RGB arrays or the bytes of an image
+   file, eg a JPEG from a camera
+3. Use the ImageResult of each image as it is yielded
+
+Images are taken from the iterable one at a time, only when the next result is asked for, so images can be
+produced by an acquisition loop as they are taken and only one image is held at a time.
+
+Basic Usage
+-----------
+
+1. Import module, read settings
+
+    .. highlight:: python
+    .. code-block:: python
+
+        import greypatch as rp
+        fs = rp.FilterSettings().read("~/Desktop/default_filter.yml")
+
+2. Stream images
+
+    .. highlight:: python
+    .. code-block:: python
+
+        images = ((frame_id, camera.capture_jpeg_bytes()) for frame_id in range(100))
+        for result in rp.stream_images(images, fs, pixels_per_cm=412, min_lesion_area=0.001):
+            store(result.image_id, result.raw_results, result.matched_results)
+
+3. Keep the label images too
+
+    .. highlight:: python
+    .. code-block:: python
+
+        for result in rp.stream_images(images, fs, pixels_per_cm=412, masks=True):
+            outer_labels = result.masks[1]['outer_lesion_area']
+
+"""
+
+import greypatch as rp
+import numpy as np
+import pandas as pd
+from skimage import io
+from io import BytesIO
+from typing import Dict, Iterable, Iterator, Tuple, Union
+
+
+class ImageResult(object):
+    """
+    class representing the results of one image of a stream
+
+    :ivar image_id: the id the image was given with, used as the image_file of the results
+    :ivar scale: the pixels per cm of the image, or None if not known
+    :ivar raw_results: pandas.DataFrame of the lesion areas, as raw_results.csv
+    :ivar matched_results: pandas.DataFrame of the matched inner and outer lesion areas, as matched_results.csv
+    :ivar region_table: pandas.DataFrame of every region found, passed or not, as region_table.csv
+    :ivar masks: dict of sub-image index to its label images, leaf mask and bbox, see SubImage.label_masks, or None
+        if masks weren't asked for
+    :ivar sub_images: the image's SubImages, if asked for, else None
+    """
+
+    def __init__(self, image_id, scale, raw_results: pd.DataFrame, matched_results: pd.DataFrame,
+                 region_table: pd.DataFrame, masks: Dict = None, sub_images=None):
+        self.image_id = image_id
+        self.scale = scale
+        self.raw_results = raw_results
+        self.matched_results = matched_results
+        self.region_table = region_table
+        self.masks = masks
+        self.sub_images = sub_images
+
+    def __repr__(self):
+        return "ImageResult({!r}, {} lesion areas, {} matches)".format(self.image_id, len(self.raw_results),
+                                                                        len(self.matched_results))
+
+
+def _decode(image_id, image):
+    """an RGB array of an image given as an array or the bytes of an image file"""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = io.imread(BytesIO(image))
+    return rp.greypatch._colour_channels(np.asarray(image), image_id)
+
+
+def stream_images(images: Iterable[Tuple[object, Union[np.ndarray, bytes]]], settings: rp.FilterSettings,
+                  scale_card_side_length=False, pixels_per_cm=False, min_lesion_area=False,
+                  passed_only: bool = True, masks: bool = False, keep_sub_images: bool = False,
+                  n_jobs: int = 1) -> Iterator[ImageResult]:
+    """
+    Run the pipeline on images in memory, yielding the results of each in turn without writing any files.
+
+    :param: images Iterable -- (image id, image) pairs, each image an RGB or RGBA array or the bytes of an image file
+    :param: settings FilterSettings -- the image segmentation settings
+    :param: scale_card_side_length float -- find a scale card of this side length in cm in each image
+    :param: pixels_per_cm float -- use a previously known value for pixels per centimetre
+    :param: min_lesion_area float -- the minimum area a lesion can be to be retained
+    :param: passed_only bool -- only include lesion areas that pass the filter in the raw and matched results
+    :param: masks bool -- include each sub-image's label images in the results
+    :param: keep_sub_images bool -- include the SubImages in the results, holding them in memory until the result is
+        dropped
+    :param: n_jobs int -- number of threads to convert each image to HSV and segment its leaves with
+    :return: Iterator of ImageResult, one per image in order
+    """
+    if scale_card_side_length and "scale_card" not in settings:
+        raise ValueError("scale card side length provided but no scale card image options present in FilterSettings")
+    for image_id, image in images:
+        rgb = _decode(image_id, image)
+        hsv, leaf_mask = rp.rgb_to_hsv(rgb, threshold=rp.subimage._leaf_thresholds(settings), n_jobs=n_jobs)
+        scale = pixels_per_cm or None
+        if scale_card_side_length:
+            scale = rp.griffin_scale_card(hsv, h=settings['scale_card']['h'], s=settings['scale_card']['s'],
+                                          v=settings['scale_card']['v'], side_length=scale_card_side_length)
+            if not scale:
+                raise ValueError("No scale card pixel value returned for image {}; likely scale card not found in "
+                                 "image.".format(image_id))
+        sub_images = rp.subimage._make_sub_images(image_id, hsv, rgb, settings, None, min_lesion_area, scale,
+                                                  1 / scale if scale else None, n_jobs, leaf_mask=leaf_mask)
+        records = rp.ResultRecords()
+        for s in sub_images:
+            records.add_sub_image(s.inner_lesion_area_props, s.outer_lesion_area_props, image_file=image_id,
+                                  sub_image_index=s.index, passed_only=passed_only)
+        if sub_images:
+            region_table = pd.concat([s.region_table() for s in sub_images])
+        else:
+            region_table = pd.DataFrame(columns=rp.REGION_TABLE_COLUMNS)
+        yield ImageResult(image_id, scale, records.raw_frame(), records.matched_frame(), region_table,
+                          masks={s.index: s.label_masks() for s in sub_images} if masks else None,
+                          sub_images=sub_images if keep_sub_images else None)
@@ -4,12 +4,17 @@ from skimage import measure, io, color
 import skimage
 import os
 import pandas as pd
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.patches as mpatches
 from shapely.geometry.polygon import Polygon
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 warnings.filterwarnings("ignore")
 
+#: rows converted to HSV at a time when finding the leaves on the lower memory path, see get_sub_images
+LOW_MEMORY_STRIP_ROWS = 256
+
 
 def _get_object_properties(label_array: np.ndarray, intensity_image: np.ndarray = None):
     """given a label array returns a list of computed RegionProperties objects."""
@@ -25,6 +30,99 @@ def _ed(p1,p2):
     return np.linalg.norm(np.array(p1) - np.array(p2))
 
 
+def load_label_masks(path, mmap=True):
+    """
+    load the label images of a subimage written by SubImage.write_label_masks
+
+    :param path: the .npz file or the folder of .npy files
+    :param mmap: memory-map the arrays of a folder of .npy files rather than reading them. Ignored for .npz files
+    :return: dict of healthy_area, outer_lesion_area, inner_lesion_area label images, leaf_mask and, if known, bbox
+    """
+    if os.path.isdir(path):
+        return {os.path.splitext(f)[0]: np.load(os.path.join(path, f), mmap_mode="r" if mmap else None)
+                for f in sorted(os.listdir(path)) if f.endswith(".npy")}
+    with np.load(path) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+
+def match_inner_outer(inner_areas, outer_areas):
+    """
+    for each passed inner lesion finds the closest passed outer lesion and matches them up, setting matches_with
+    on both. Works on anything with passed, centroid, label and matches_with attributes, so matches can be made
+    again from a stored region table.
+
+    :param inner_areas: list of inner LesionAreas
+    :param outer_areas: list of outer LesionAreas
+    :return: None
+    """
+    inners = {}
+    outers = {}
+    matches = []
+
+
+    for i, inner in enumerate(inner_areas):
+        if inner.passed:
+            min = np.inf
+            for o, outer in enumerate(outer_areas):
+                if outer.passed:
+                    #print("inner {} - outer {} : {}" .format(inner.centroid, outer.centroid, _ed(np.array(inner.centroid), np.array(outer.centroid) ) ) )
+                    if _ed(np.array(inner.centroid), np.array(outer.centroid)) < min:
+                        inners[i] = o
+
+    for o, outer in enumerate(outer_areas):
+        if outer.passed:
+            min = np.inf
+            for i, inner in enumerate(inner_areas):
+                if inner.passed:
+                    if _ed(np.array(outer.centroid), np.array(inner.centroid)) < min:
+                        outers[o] = i
+
+    for current_inner in inners.keys():
+        best_outer = inners[current_inner]
+        if best_outer in outers and outers[best_outer] == current_inner: #reciprocal nearest
+            matches.append([current_inner, best_outer])
+            inner_areas[current_inner].matches_with = str(outer_areas[best_outer].label)
+            outer_areas[best_outer].matches_with = str(inner_areas[current_inner].label)
+
+
+def _make_results_frame(regions, area_type=None, image_file=None, sub_image_index=None):
+    """makes a pandas dataframe of the results for regions of one area type"""
+    nrow = len(regions)
+    d = {}
+    #d = {p: [rp[p] for rp in regions] for p in props}
+    d['label'] = [r.label for r in regions]
+    d['area_type'] = [area_type] * nrow
+    d['matched_with'] = [r.matches_with for r in regions]
+    d['passed'] = [r.passed for r in regions]
+    d['pixels_in_area'] = [r.area for r in regions]
+    d['scale'] =  [r.scale for r in regions]
+    d['size'] = [r.size for r in regions]
+    d['image_file'] = [image_file] * nrow
+    d['sub_image_index'] = [sub_image_index] * nrow
+
+
+    return pd.DataFrame(d)
+
+
+def _results_dataframes(inner_areas, outer_areas, image_file=None, sub_image_index=None, passed_only=False):
+    """makes the inner and outer lesion results dataframes of a subimage"""
+    outer_df = _make_results_frame(outer_areas, area_type = "outer_lesion_area",
+                                   image_file=image_file, sub_image_index=sub_image_index)
+    inner_df = _make_results_frame(inner_areas, area_type = "inner_lesion_area",
+                                   image_file=image_file, sub_image_index=sub_image_index)
+
+    if passed_only:
+        inner_df = inner_df[inner_df["passed"]]
+        outer_df = outer_df[outer_df["passed"]]
+
+    return inner_df, outer_df
+
+
+#: columns of the region table, see SubImage.region_table
+REGION_TABLE_COLUMNS = ['image_file', 'sub_image_index', 'area_type', 'label', 'pixels_in_area', 'scale', 'size',
+                        'centroid_row', 'centroid_col', 'circular_area']
+
+
 def _make_match_dataframe(df):
     df['matched_with'] = df.matched_with.astype(str)
     o = df.query('area_type == "outer_lesion_area" &  matched_with != "None" ')
@@ -34,45 +132,177 @@ def _make_match_dataframe(df):
     m['outer_inner_ratio_pixels'] = m['pixels_in_area_y'] / m['pixels_in_area_x']
     return m
 
+def _find_leaves(im, file_settings, leaf_mask=None):
+    """finds the leaves in an HSV image, returning their RegionProperties in label order"""
+    return _get_object_properties(_leaf_labels(im, file_settings, leaf_mask))
+
+
+def _leaf_labels(im, file_settings, leaf_mask=None):
+    """labels the leaves in an HSV image, 1, 2, 3... for those passing the leaf filter"""
+    labelled_leaf_area = _label_leaf_area(im, file_settings, leaf_mask)
+    leaf_filter = rp.RegionFilter(file_settings['leaf_area'].get('filter') or rp.LEAF_AREA_FILTER)
+    leaf_areas_to_keep = leaf_filter.select(labelled_leaf_area)
+    final_labelled_leaf_area, _ = rp.remap_labels(labelled_leaf_area, leaf_areas_to_keep)
+    return final_labelled_leaf_area
+
+
+def _label_leaf_area(im, file_settings, leaf_mask=None):
+    """
+    labels the objects passing the leaf_area thresholds in an HSV image, or in leaf_mask, the threshold mask, if
+    already made
+    """
+    if leaf_mask is None:
+        leaf_area_mask = rp.griffin_leaf_regions(im,
+                                                 h=file_settings['leaf_area']['h'],
+                                                 s=file_settings['leaf_area']['s'],
+                                                 v=file_settings['leaf_area']['v'])
+    else:
+        leaf_area_mask = rp.fill_holes(leaf_mask)
+    labelled_leaf_area, _ = rp.label_image(leaf_area_mask)
+    return labelled_leaf_area
+
+
+def _leaf_thresholds(file_settings):
+    """the (h, s, v) leaf_area thresholds, for rgb_to_hsv"""
+    return tuple(file_settings['leaf_area'][channel] for channel in ('h', 's', 'v'))
+
+
+def _leaf_threshold_mask(rgb, file_settings, strip_rows=LOW_MEMORY_STRIP_ROWS):
+    """
+    the leaf_area threshold mask of an RGB image, converting strip_rows rows at a time into one buffer so that the
+    whole image is never held in HSV
+    """
+    mask = np.empty(rgb.shape[:2], dtype=np.bool_)
+    strip = np.empty((min(strip_rows, rgb.shape[0]),) + rgb.shape[1:], dtype=np.float64)
+    for row in range(0, rgb.shape[0], strip_rows):
+        rows = min(strip_rows, rgb.shape[0] - row)
+        _, mask[row:row + rows] = rp.rgb_to_hsv(rgb[row:row + rows], out=strip[:rows],
+                                                threshold=_leaf_thresholds(file_settings))
+    return mask
+
+
 def get_sub_images(imfile,
     file_settings = None, 
     dest_folder = None,
     min_lesion_area = None,
     scale = None,
-    pixel_length = None
+    pixel_length = None,
+    n_jobs = 1,
+    stage_cache = None,
+    low_memory = False
 ):
     """
     extracts different leaves from a single image file, returning them as individual SubImage objects.
 
+    With n_jobs > 1 the leaves, and the healthy, outer and inner lesion bands within each leaf, are segmented on
+    thread pools of n_jobs threads. The threshold kernel and most of the labelling release the GIL, so this cuts
+    the time for a single image with many leaves.
+
+    With low_memory the image is never held in HSV. The leaf_area threshold is found converting
+    LOW_MEMORY_STRIP_ROWS rows at a time, the image's leaf label images are freed once the leaves are found and
+    then only each leaf's bounding box is converted, one leaf at a time. The sub-images are the same, but n_jobs is
+    ignored, so it is slower.
+
     :param: imfile str -- path to the image
     :param: file_settings str -- FilterSettings object with image segmentation options
-    :param: dest_folder str -- folder in which to place results files
+    :param: dest_folder str -- folder in which to place results files, None if the sub-images won't be written
     :param: min_lesion_area float -- minimum area for a lesion to pass filter. In either pixels or actual size if 'scale' passed
     :param: scale float -- pixels per real unit length, if known or computed earlier.
+    :param: n_jobs int -- number of threads to convert the image to HSV and segment leaves and bands with
+    :param: stage_cache StageCache -- re-use the leaf and band label images of earlier runs with the same image and
+        settings, storing those that have to be made. See StageCache
+    :param: low_memory bool -- use less memory, for images too big to process otherwise
     :param: max_lc_ratio float -- maximum length/width ratio of lesion centre to pass filter
     :param: min_lc_size float -- minimum lesion centre size. Computed in real units if 'scale' passed. Computed as area of circle with same pixel volume as the centre.
     :param: lc_prop_across_parent float -- minimum proportion lesion centre must be across the width of the parent lesion (in the row the centre centroid occurs) to pass filter
     """
-    im = rp.load_as_hsv(imfile)
-    leaf_area_mask = rp.griffin_leaf_regions(im,
-                                             h=file_settings['leaf_area']['h'],
-                                             s=file_settings['leaf_area']['s'],
-                                             v=file_settings['leaf_area']['v'])
-    labelled_leaf_area, _ = rp.label_image(leaf_area_mask)
-    leaf_area_properties = rp.get_object_properties(labelled_leaf_area)
-    leaf_areas_to_keep = rp.filter_region_property_list(leaf_area_properties, rp.is_not_small)
-    cleaned_leaf_area = rp.clean_labelled_mask(labelled_leaf_area, leaf_areas_to_keep)
-    final_labelled_leaf_area, _ = rp.label_image(cleaned_leaf_area)
-    three_d_final_labelled_leaf_area = np.dstack((final_labelled_leaf_area, final_labelled_leaf_area,
-                                                  final_labelled_leaf_area))  # stupid hack because get object properties needs 3d label array to match image
-    props = rp.subimage._get_object_properties(three_d_final_labelled_leaf_area, intensity_image=im)
-    sub_labels = [p.image.astype(int)[:, :, -1] for p in props]
-    sub_images = [p.intensity_image for p in props]
-    cleared_leaf_sub_images = [rp.clear_background(sub_images[i], sub_labels[i]) for i in range(len(sub_labels))]
-    sub_image_objs = []
-    for sub_i_idx, sub_i in enumerate(cleared_leaf_sub_images, 1):
-        sub_image_objs.append( rp.SubImage(sub_i, sub_i_idx, imfile, file_settings = file_settings, dest_folder = dest_folder, min_lesion_area = min_lesion_area, scale = scale, pixel_length = pixel_length  ) )
-    return sub_image_objs
+    rgb = rp.load_rgb(imfile)
+    if low_memory:
+        return _make_sub_images(imfile, None, rgb, file_settings, dest_folder, min_lesion_area, scale, pixel_length,
+                                1, stage_cache, leaf_mask=_leaf_threshold_mask(rgb, file_settings))
+    im, leaf_mask = rp.rgb_to_hsv(rgb, threshold=_leaf_thresholds(file_settings), n_jobs=n_jobs)
+    return _make_sub_images(imfile, im, rgb, file_settings, dest_folder, min_lesion_area, scale, pixel_length, n_jobs,
+                            stage_cache, leaf_mask=leaf_mask)
+
+
+def get_sub_images_from_array(rgb,
+    image_id,
+    file_settings = None,
+    dest_folder = None,
+    min_lesion_area = None,
+    scale = None,
+    pixel_length = None,
+    n_jobs = 1
+):
+    """
+    extracts different leaves from an image already in memory, returning them as individual SubImage objects, as
+    get_sub_images does for an image file.
+
+    :param: rgb np.ndarray -- the RGB image, an alpha channel is ignored
+    :param: image_id -- the image's name or other id, used as the parent_image_file of the sub-images
+    :param: file_settings str -- FilterSettings object with image segmentation options
+    :param: dest_folder str -- folder in which to place results files, None if the sub-images won't be written
+    :param: min_lesion_area float -- minimum area for a lesion to pass filter. In either pixels or actual size if 'scale' passed
+    :param: scale float -- pixels per real unit length, if known or computed earlier.
+    :param: n_jobs int -- number of threads to convert the image to HSV and segment leaves and bands with
+    """
+    rgb = rp.greypatch._colour_channels(np.asarray(rgb), image_id)
+    im, leaf_mask = rp.rgb_to_hsv(rgb, threshold=_leaf_thresholds(file_settings), n_jobs=n_jobs)
+    return _make_sub_images(image_id, im, rgb, file_settings, dest_folder, min_lesion_area, scale, pixel_length,
+                            n_jobs, leaf_mask=leaf_mask)
+
+
+def _make_sub_images(imfile, im, rgb, file_settings, dest_folder, min_lesion_area, scale, pixel_length, n_jobs,
+                     stage_cache=None, leaf_mask=None):
+    """
+    the SubImages of the leaves of an image given in HSV and RGB, see get_sub_images. leaf_mask is the image's
+    leaf_area threshold mask if already made, eg by rgb_to_hsv. With im None each leaf's bounding box is converted
+    from rgb as it is needed, leaf_mask must then be given
+    """
+    cached_bands = {}
+    if stage_cache is None:
+        leaf_labels = _leaf_labels(im, file_settings, leaf_mask)
+    else:
+        image_hash = stage_cache.image_hash(imfile)
+        cached = stage_cache.get('leaf_area', image_hash, file_settings)
+        if cached is None:
+            leaf_labels = _leaf_labels(im, file_settings, leaf_mask)
+            stage_cache.put('leaf_area', image_hash, file_settings,
+                            {'labels': leaf_labels.astype(np.min_scalar_type(leaf_labels.max(initial=0)))})
+        else:
+            leaf_labels = cached['labels']
+        for band in rp.BAND_STAGES:
+            cached = stage_cache.get(band, image_hash, file_settings)
+            if cached is not None:
+                cached_bands[band] = cached
+    # keep only each leaf's bbox and mask, so the image size label and mask arrays are freed before segmenting
+    leaves = [(p.bbox, p.image) for p in _get_object_properties(leaf_labels)]
+    del leaf_labels, leaf_mask
+
+    def make_sub_image(sub_i_idx, leaf, executor=None):
+        (min_row, min_col, max_row, max_col), leaf_image = leaf
+        # bbox view into the parent image, background is cleared lazily using the leaf mask
+        sub_rgb = rgb[min_row:max_row, min_col:max_col]
+        sub_i = rp.rgb_to_hsv(sub_rgb) if im is None else im[min_row:max_row, min_col:max_col]
+        labels = {band: arrays[str(sub_i_idx)] for band, arrays in cached_bands.items()}
+        return rp.SubImage(sub_i, sub_i_idx, imfile, file_settings = file_settings, dest_folder = dest_folder, min_lesion_area = min_lesion_area, scale = scale, pixel_length = pixel_length, leaf_mask = leaf_image, bbox = leaf[0], executor = executor, rgb = sub_rgb, labels = labels )
+
+    if n_jobs > 1:
+        # bands get a pool of their own, leaf threads waiting on bands in a shared pool could deadlock it
+        with ThreadPoolExecutor(max_workers=n_jobs) as band_executor, \
+                ThreadPoolExecutor(max_workers=n_jobs) as leaf_executor:
+            futures = [leaf_executor.submit(make_sub_image, sub_i_idx, leaf, band_executor)
+                       for sub_i_idx, leaf in enumerate(leaves, 1)]
+            sub_images = [f.result() for f in futures]
+    else:
+        sub_images = [make_sub_image(sub_i_idx, leaf) for sub_i_idx, leaf in enumerate(leaves, 1)]
+
+    if stage_cache is not None:
+        for band in rp.BAND_STAGES:
+            if band not in cached_bands:
+                stage_cache.put(band, image_hash, file_settings,
+                                {str(s.index): s.label_image(band) for s in sub_images})
+    return sub_images
 
 
 class SubImage(object):
@@ -80,17 +310,26 @@ class SubImage(object):
     """
     class representing sub-image (leaf containing area) of a larger image.
 
-    :ivar sub_i: the subimage
+    :ivar sub_i: the subimage, with pixels outside the leaf mask cleared
+    :ivar sub_view: the uncleared subimage, usually a view into the parent image
+    :ivar leaf_mask: binary mask of the leaf pixels in sub_view, None if sub_i was already cleared
+    :ivar rgb_view: the uncleared subimage in its original RGB, usually a view into the decoded image, or None
+    :ivar bbox: the bounding box (min_row, min_col, max_row, max_col) of the subimage in the parent image, if known
     :ivar sub_i_idx: the index of the subimage from the subimage list
     :ivar scale: the scale of the image if computed
     :ivar pixel_length: the length of a pixel side in real units
-    :ivar imtag: the name of the file this subimage is referred to in the output
-    :ivar annot_imtag: the name of the annotated image file this subimage is referred to in the output
+    :ivar imtag: the name of the file this subimage is referred to in the output, None without a dest_folder
+    :ivar annot_imtag: the name of the annotated image file this subimage is referred to in the output, None without
+        a dest_folder
     :ivar parent_image_file: the name of the file this subimage is derived from
     :ivar healthy_obj_props: list of HealthyAreas found in the subimage
     :ivar leaf_area_props: list of LeafAreas found in the subimage
     :ivar lesion_area_props: list of LesionAreas found in the subimage
     :ivar lesion_centre_props: list of LesionCentres found in the subimage
+    :ivar skipped_bands: the bands that weren't segmented because no pixel of the leaf passes their thresholds
+    :param: executor -- optional concurrent.futures Executor to segment the healthy, outer and inner bands on
+    :param: labels -- optional dict of band, "healthy_area", "outer_lesion_area" or "inner_lesion_area", to the
+        band's label image of the subimage, eg from a StageCache. Bands given are not segmented again
     """
 
     def __init__(self, 
@@ -101,10 +340,18 @@ class SubImage(object):
     dest_folder = None,
     min_lesion_area = None,
     scale = None,
-    pixel_length = None
+    pixel_length = None,
+    leaf_mask = None,
+    bbox = None,
+    executor = None,
+    rgb = None,
+    labels = None
     ):
 
-        self.sub_i = sub_i
+        self.sub_view = sub_i
+        self.rgb_view = rgb
+        self.leaf_mask = leaf_mask
+        self.bbox = bbox
         self.index = sub_i_idx
         if scale:
             self.scale = scale
@@ -112,29 +359,92 @@ class SubImage(object):
         else:
             self.scale = "NA"
             self.pixel_length = "NA"
-        self.imtag = os.path.join(dest_folder, "{}_sub_image_{}{}".format(os.path.basename(parent_image_file), sub_i_idx, ".jpg") )
-        self.annot_imtag = os.path.join(dest_folder, "{}_sub_image_{}{}".format(os.path.basename(parent_image_file), sub_i_idx, "_annotated.jpg"))
+        if dest_folder is None:
+            self.imtag = None
+            self.annot_imtag = None
+        else:
+            self.imtag = os.path.join(dest_folder, "{}_sub_image_{}{}".format(os.path.basename(parent_image_file), sub_i_idx, ".jpg") )
+            self.annot_imtag = os.path.join(dest_folder, "{}_sub_image_{}{}".format(os.path.basename(parent_image_file), sub_i_idx, "_annotated.jpg"))
         self.parent_image_file = parent_image_file
-        self.healthy_obj_props = self._get_healthy_areas(sub_i, file_settings, scale, pixel_length)
-        self.outer_lesion_area_props = self._get_lesion_areas(sub_i, file_settings, scale, pixel_length, key="outer_lesion_area", min_lesion_area = min_lesion_area)  # 0 to many per image
-        self.inner_lesion_area_props = self._get_lesion_areas(sub_i, file_settings, scale, pixel_length, key="inner_lesion_area", min_lesion_area = min_lesion_area)
+        labels = labels or {}
+        self.skipped_bands = self._empty_bands(sub_i, file_settings, [band for band in rp.BAND_STAGES if band not in labels])
+        band_finders = {
+            "healthy_area": (self._get_healthy_areas, dict(labels = labels.get("healthy_area"))),
+            "outer_lesion_area": (self._get_lesion_areas, dict(key="outer_lesion_area", min_lesion_area = min_lesion_area, labels = labels.get("outer_lesion_area"))),  # 0 to many per image
+            "inner_lesion_area": (self._get_lesion_areas, dict(key="inner_lesion_area", min_lesion_area = min_lesion_area, labels = labels.get("inner_lesion_area"))),
+        }
+        areas = {}
+        for band, (find, kwargs) in band_finders.items():
+            if band in self.skipped_bands:
+                areas[band] = []
+            elif executor is None:
+                areas[band] = find(sub_i, file_settings, scale, pixel_length, **kwargs)
+            else:
+                areas[band] = executor.submit(find, sub_i, file_settings, scale, pixel_length, **kwargs)
+        areas = {band: a if isinstance(a, list) else a.result() for band, a in areas.items()}
+        self.healthy_obj_props = areas["healthy_area"]
+        self.outer_lesion_area_props = areas["outer_lesion_area"]
+        self.inner_lesion_area_props = areas["inner_lesion_area"]
         self.matched_innerouter = self._match_innerouter()
 
+    @property
+    def sub_i(self):
+        """
+        the subimage with the background cleared. Computed on access when a leaf mask is held
+
+        :return: np.ndarray
+        """
+        if self.leaf_mask is None:
+            return self.sub_view
+        return rp.clear_background(self.sub_view, self.leaf_mask)
+
+    @property
+    def sub_rgb(self):
+        """
+        the subimage as uint8 RGB with the background cleared, from the original RGB pixels when they are held
+        rather than by converting the HSV subimage back
+
+        :return: np.ndarray
+        """
+        if self.rgb_view is None:
+            return skimage.img_as_ubyte(color.hsv2rgb(self.sub_i))
+        leaf_mask = self.leaf_mask if self.leaf_mask is not None else np.any(self.sub_i > 0, axis=2)
+        return rp.clear_background(skimage.img_as_ubyte(self.rgb_view), leaf_mask)
+
+    def _empty_bands(self, im, fs, bands):
+        """
+        Finds the bands, of those given, whose thresholds no pixel of the leaf passes, so that segmenting them can
+        be skipped. Tests all the bands in one pass that stops once each has a passing pixel, see any_pixels_pass
 
+        :param im: the image to search
+        :param fs: a FilterSettings object
+        :param bands: list of FilterSettings keys of the bands to test
+        :return: list of the bands that would be empty
+        """
+        if not bands:
+            return []
+        found = rp.any_pixels_pass(im, [(fs[band]['h'], fs[band]['s'], fs[band]['v']) for band in bands],
+                                   mask=self.leaf_mask)
+        return [band for band, f in zip(bands, found) if not f]
 
-    def _get_healthy_areas(self, im, fs,scale, pixel_length):
+    def _get_healthy_areas(self, im, fs,scale, pixel_length, labels = None):
         """
         Finds healthy areas according to filtersettings in fs
 
         :param im: the image to search
         :param fs: a FilterSettings object
+        :param labels: the healthy area label image, if already known
         :return: list of HealthyArea objects
         """
-        healthy_mask, _ = rp.griffin_healthy_regions(im,
-                                                        h=fs['healthy_area']['h'],
-                                                        s=fs['healthy_area']['s'],
-                                                        v=fs['healthy_area']['v'])
-        labelled_healthy_area, _ = rp.label_image(healthy_mask)
+        if labels is None:
+            healthy_mask, _ = rp.griffin_healthy_regions(im,
+                                                            h=fs['healthy_area']['h'],
+                                                            s=fs['healthy_area']['s'],
+                                                            v=fs['healthy_area']['v'],
+                                                            mask=self.leaf_mask)
+            labelled_healthy_area, _ = rp.label_image(healthy_mask)
+        else:
+            labelled_healthy_area = labels
         labelled_healthy_area_properties = rp.get_object_properties(labelled_healthy_area)
         return [rp.HealthyArea(o,scale, pixel_length) for o in labelled_healthy_area_properties]
 
@@ -155,7 +465,7 @@ class SubImage(object):
         return [rp.LeafArea(o,scale,pixel_length) for o in leaf_area_properties]
 
 
-    def _get_lesion_areas(self, im, fs, scale, pixel_length, key='outer_lesion_area', min_lesion_area = None):
+    def _get_lesion_areas(self, im, fs, scale, pixel_length, key='outer_lesion_area', min_lesion_area = None, labels = None):
         """
         Finds brown lesion areas according to filtersettings in fs
 
@@ -163,13 +473,18 @@ class SubImage(object):
         :param fs: a FilterSettings object
         :param key: a FilterSettings object key string specifying which params to use (IE which lesion type to search for)
         :param min_lesion_area: the minimum area to set a LesionArea objects passed attribute to TRUE
+        :param labels: the lesion area label image, if already known
         :return: list of LesionArea objects
         """
-        lesion_area_mask, _ = rp.griffin_lesion_regions(im,
-                                                        h=fs[key]['h'],
-                                                        s=fs[key]['s'],
-                                                        v=fs[key]['v'])
-        labelled_lesion_area, _ = rp.label_image(lesion_area_mask)
+        if labels is None:
+            lesion_area_mask, _ = rp.griffin_lesion_regions(im,
+                                                            h=fs[key]['h'],
+                                                            s=fs[key]['s'],
+                                                            v=fs[key]['v'],
+                                                            mask=self.leaf_mask)
+            labelled_lesion_area, _ = rp.label_image(lesion_area_mask)
+        else:
+            labelled_lesion_area = labels
         labelled_lesion_area_properties = rp.get_object_properties(labelled_lesion_area)
         return [rp.LesionArea(o, scale, pixel_length, min_lesion_area=min_lesion_area) for o in
                 labelled_lesion_area_properties]
@@ -195,37 +510,7 @@ class SubImage(object):
 
         :return: list of lists, [inner_lesion, outer_lesion]
         """
-        inners = {}
-        outers = {}
-        matches = []
-
-
-        for i, inner in enumerate(self.inner_lesion_area_props):
-            if inner.passed:
-                min = np.inf
-                for o, outer in enumerate(self.outer_lesion_area_props):
-                    if outer.passed:
-                        #print("inner {} - outer {} : {}" .format(inner.centroid, outer.centroid, _ed(np.array(inner.centroid), np.array(outer.centroid) ) ) )
-                        if _ed(np.array(inner.centroid), np.array(outer.centroid)) < min:
-                            inners[i] = o
-
-        for o, outer in enumerate(self.outer_lesion_area_props):
-            if outer.passed:
-                min = np.inf
-                for i, inner in enumerate(self.inner_lesion_area_props):
-                    if inner.passed:
-                        if _ed(np.array(outer.centroid), np.array(inner.centroid)) < min:
-                            outers[o] = i
-
-        for current_inner in inners.keys():
-            best_outer = inners[current_inner]
-            if best_outer in outers and outers[best_outer] == current_inner: #reciprocal nearest
-                matches.append([current_inner, best_outer])
-                self.inner_lesion_area_props[current_inner].matches_with = str(self.outer_lesion_area_props[best_outer].label)
-                self.outer_lesion_area_props[best_outer].matches_with = str(self.inner_lesion_area_props[current_inner].label)
-
-
-
+        match_inner_outer(self.inner_lesion_area_props, self.outer_lesion_area_props)
 
     def _make_polygons_for_image(self, list_of_rprops ):
         """
@@ -246,13 +531,38 @@ class SubImage(object):
 
     def write_annotated_sub_image(self):
         """
-        create output annotated subimage jpeg with results overlay
+        create output annotated subimage jpeg with results overlay.
+        Uses a figure of its own rather than pyplot's global state so is safe to call from threads
         :return: None
         """
-        size = self._calc_size(self.sub_i)
-        fig = plt.figure(figsize=size)
-        img = skimage.img_as_ubyte(color.hsv2rgb(self.sub_i))
-        plt.imshow(img)
+        self._check_can_write()
+        fig = self._annotated_figure()
+        fig.savefig(self.annot_imtag, dpi = 72, )
+
+    def annotated_image(self, max_side = None):
+        """
+        render the annotated subimage as uint8 RGB, at 72 DPI as write_annotated_sub_image writes it, or at a lower
+        DPI so that its longer side is at most max_side pixels
+        :param max_side: the largest width or height of the rendered image, None for 72 DPI
+        :return: np.ndarray
+        """
+        h, w = self.sub_view.shape[:2]
+        dpi = 72 if max_side is None else 72 * min(1.0, max_side / max(h, w))
+        fig = self._annotated_figure(dpi = dpi)
+        fig.canvas.draw()
+        return np.asarray(fig.canvas.buffer_rgba())[:, :, :3].copy()
+
+    def _annotated_figure(self, dpi = None):
+        """
+        the figure of the annotated subimage, a figure of its own rather than pyplot's global state
+        :param dpi: the figure's DPI, None for matplotlib's default
+        :return: matplotlib.figure.Figure
+        """
+        size = self._calc_size(self.sub_view)
+        fig = Figure(figsize=size, dpi=dpi)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        ax.imshow(self.sub_rgb)
         brown = (165/255, 42/255, 42/255, 0.5)
         grey = (125/255, 125/255, 125/255, 0.5)
         green = (45/255, 90/255, 39/255, 0.5)
@@ -262,15 +572,14 @@ class SubImage(object):
         inner_lesion_polys = self._make_polygons_for_image(self.inner_lesion_area_props)
 
         for p in healthy_polys:
-            plt.plot(p[0], p[1], color=green )
+            ax.plot(p[0], p[1], color=green )
 
         for p in outer_lesion_polys:
-            plt.plot(p[0], p[1], color=brown )
+            ax.plot(p[0], p[1], color=brown )
 
         for p in inner_lesion_polys:
-            plt.plot(p[0], p[1], color=grey)
+            ax.plot(p[0], p[1], color=grey)
 
-        ax = plt.gca()
         for p in self.outer_lesion_area_props:
             if p.passed:
                 l = "outer: "  + str(p.label)
@@ -283,16 +592,81 @@ class SubImage(object):
         h_patch = mpatches.Patch(color=green, label='Healthy')
         l_patch = mpatches.Patch(color=brown, label="Outer Lesion")
         c_patch = mpatches.Patch(color=grey, label="Inner Lesion")
-        plt.legend(bbox_to_anchor=(1, 1), bbox_transform=plt.gcf().transFigure,handles=[h_patch,l_patch,c_patch],loc="upper right")
-        plt.savefig(self.annot_imtag, dpi = 72, )
-        plt.close(fig)
+        ax.legend(bbox_to_anchor=(1, 1), bbox_transform=fig.transFigure,handles=[h_patch,l_patch,c_patch],loc="upper right")
+        return fig
 
     def write_sub_image(self):
         """
         write out subimage (nonannotated)
         :return: None
         """
-        io.imsave(self.imtag, skimage.img_as_ubyte(color.hsv2rgb(self.sub_i)))
+        self._check_can_write()
+        io.imsave(self.imtag, self.sub_rgb)
+
+    def label_images(self):
+        """
+        rebuild the healthy, outer and inner lesion label images of the subimage from the found areas, each area
+        set to its label. Uses the smallest unsigned integer type that holds the labels
+        :return: dict of area type to np.ndarray
+        """
+        return {area_type: self.label_image(area_type)
+                for area_type in ("healthy_area", "outer_lesion_area", "inner_lesion_area")}
+
+    def label_image(self, area_type):
+        """
+        rebuild one label image of the subimage, see label_images
+        :param area_type: "healthy_area", "outer_lesion_area" or "inner_lesion_area"
+        :return: np.ndarray
+        """
+        areas = {"healthy_area": self.healthy_obj_props,
+                 "outer_lesion_area": self.outer_lesion_area_props,
+                 "inner_lesion_area": self.inner_lesion_area_props}[area_type]
+        max_label = max([a.label for a in areas], default=0)
+        labels = np.zeros(self.sub_view.shape[:2], dtype=np.min_scalar_type(max_label))
+        for a in areas:
+            labels[a.slice][a.image] = a.label
+        return labels
+
+    def label_masks(self):
+        """
+        the label images of the subimage with the leaf mask and, if known, the subimage's bbox offset into the
+        parent image, as written by write_label_masks
+        :return: dict of name to np.ndarray
+        """
+        arrays = self.label_images()
+        leaf_mask = self.leaf_mask if self.leaf_mask is not None else np.any(self.sub_i > 0, axis=2)
+        arrays['leaf_mask'] = np.asarray(leaf_mask, dtype=np.bool_)
+        if self.bbox is not None:
+            arrays['bbox'] = np.asarray(self.bbox, dtype=np.int64)
+        return arrays
+
+    def _check_can_write(self):
+        if self.imtag is None:
+            raise ValueError("sub image {} of {} has no dest_folder to write to".format(self.index, self.parent_image_file))
+
+    def write_label_masks(self, fmt="npz"):
+        """
+        write out the label images of the subimage, with the leaf mask and the subimage's bbox offset into the
+        parent image, for re-analysis without re-segmenting. Read them back with load_label_masks.
+
+        With fmt "npz" the arrays are written compressed to a single file, <sub image name>_labels.npz. With fmt
+        "npy" they are written uncompressed to a folder, <sub image name>_labels, one .npy file per array, so that
+        they can be memory-mapped when loaded.
+        :param fmt: "npz" or "npy"
+        :return: str the file or folder written
+        """
+        self._check_can_write()
+        arrays = self.label_masks()
+        stem = os.path.splitext(self.imtag)[0] + "_labels"
+        if fmt == "npz":
+            np.savez_compressed(stem + ".npz", **arrays)
+            return stem + ".npz"
+        elif fmt == "npy":
+            os.makedirs(stem, exist_ok=True)
+            for name, array in arrays.items():
+                np.save(os.path.join(stem, name + ".npy"), array)
+            return stem
+        raise ValueError("unknown label mask format '{}', use one of 'npz' or 'npy'".format(fmt))
 
     def _make_pandas(self, regions, area_type=None, image_file=None, sub_image_index = None):
         """
@@ -304,21 +678,8 @@ class SubImage(object):
         :param sub_image_index: the index of the subimage the regions are derived from
         :return: pandas.dataframe
         """
-        nrow = len(regions)
-        d = {}
-        #d = {p: [rp[p] for rp in regions] for p in props}
-        d['label'] = [r.label for r in regions]
-        d['area_type'] = [area_type] * nrow
-        d['matched_with'] = [r.matches_with for r in regions]
-        d['passed'] = [r.passed for r in regions]
-        d['pixels_in_area'] = [r.area for r in regions]
-        d['scale'] =  [r.scale for r in regions]
-        d['size'] = [r.size for r in regions]
-        d['image_file'] = [image_file] * nrow
-        d['sub_image_index'] = [sub_image_index] * nrow
-
-
-        return pd.DataFrame(d)
+        return _make_results_frame(regions, area_type=area_type, image_file=image_file,
+                                   sub_image_index=sub_image_index)
 
 
     def get_results_dataframes(self, passed_only=False):
@@ -326,18 +687,38 @@ class SubImage(object):
         generates a pandas dataframe of results from the SubImage object
         :return: pandas.dataframe
         """
+        return _results_dataframes(self.inner_lesion_area_props, self.outer_lesion_area_props,
+                                   image_file=self.parent_image_file, sub_image_index=self.index,
+                                   passed_only=passed_only)
 
-
-        outer_df = self._make_pandas(self.outer_lesion_area_props, area_type = "outer_lesion_area",
-                                     image_file=self.parent_image_file, sub_image_index=self.index)
-        inner_df = self._make_pandas(self.inner_lesion_area_props, area_type = "inner_lesion_area",
-                                     image_file=self.parent_image_file, sub_image_index=self.index)
-
-        if passed_only:
-            inner_df = inner_df[inner_df["passed"]]
-            outer_df = outer_df[outer_df["passed"]]
-
-        return inner_df, outer_df
+    def region_table(self):
+        """
+        generates a pandas dataframe of every region found in the SubImage, passed or not, with the centroids
+        needed to match lesions again and the area of a circle of the same pixel volume, see
+        pixel_volume_to_circular_area. The leaf itself is the single leaf_area row
+        :return: pandas.dataframe
+        """
+        leaf = self.leaf_mask if self.leaf_mask is not None else np.any(self.sub_i > 0, axis=2)
+        leaf_rows, leaf_cols = np.nonzero(leaf)
+        leaf_area = float(len(leaf_rows))
+        leaf_size = (self.pixel_length ** 2) * leaf_area if self.scale != "NA" else "NA"
+        rows = [{'image_file': self.parent_image_file, 'sub_image_index': self.index, 'area_type': "leaf_area",
+                 'label': 1, 'pixels_in_area': leaf_area, 'scale': self.scale, 'size': leaf_size,
+                 'centroid_row': leaf_rows.mean(), 'centroid_col': leaf_cols.mean()}]
+        for area_type, regions in (("healthy_area", self.healthy_obj_props),
+                                   ("outer_lesion_area", self.outer_lesion_area_props),
+                                   ("inner_lesion_area", self.inner_lesion_area_props)):
+            for r in regions:
+                rows.append({'image_file': self.parent_image_file, 'sub_image_index': self.index,
+                             'area_type': area_type, 'label': r.label, 'pixels_in_area': r.area,
+                             'scale': r.scale, 'size': r.size,
+                             'centroid_row': r.centroid[0], 'centroid_col': r.centroid[1]})
+        table = pd.DataFrame(rows, columns=REGION_TABLE_COLUMNS[:-1])
+        if self.scale == "NA":
+            table['circular_area'] = "NA"
+        else:
+            table['circular_area'] = rp.pixel_volume_to_circular_area(table['pixels_in_area'].values, self.scale)
+        return table
 
 
 
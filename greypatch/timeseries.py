@@ -0,0 +1,445 @@
+"""
+timeseries
+
+A module for following the leaves and lesions of a tray photographed repeatedly, eg daily, through a series of images
+
+
+Workflow Overview
+-----------------
+
+1. Create a time series with the filter settings for the tray
+2. Add the images in the order they were taken. Each is registered to the one before and its leaves and lesions are
+   linked to those already seen
+3. Write the growth table, one row per lesion per image, and the registration table
+
+Each image is registered to the previous one by phase correlation of greyscale copies sampled at every
+REGISTRATION_STEP th pixel, giving the translation of the tray between the images and the correlation of the aligned
+images. The correlation peak is refined to a fraction of a sample, so translations that aren't a multiple of
+REGISTRATION_STEP are found to within about a pixel, and the tray's position is kept to a fraction of a pixel so
+that rounding doesn't build up over the series. When the correlation is at least min_correlation the leaves are looked for only in windows around where
+they were in the previous image, moved by the translation, and only those windows are converted to HSV. If the
+registration is poor, a leaf isn't found in its window or reaches the edge of its window, the whole image is
+searched as get_sub_images does. New leaves are only found by a whole image search, and leaves a whole image
+search doesn't find, eg ones that were removed or have grown into another leaf, are no longer tracked.
+
+Leaves, then the lesions within each leaf, are linked to those of earlier images by how much they overlap once the
+translation is allowed for, see link_regions. A leaf keeps its id, used as its sub-image index, through the series
+and each lesion gets an id of its own. Lesions that aren't linked to one seen before start a new id.
+
+Basic Usage
+-----------
+
+1. Import module, create a time series
+
+    .. highlight:: python
+    .. code-block:: python
+
+        import greypatch as rp
+        fs = rp.FilterSettings().read("~/Desktop/default_filter.yml")
+        series = rp.TimeSeries(fs, dest_folder="~/Desktop/test_out", min_lesion_area=0.001)
+
+2. Add the images in order
+
+    .. highlight:: python
+    .. code-block:: python
+
+        for imfile in ["tray_1_day_01.jpg", "tray_1_day_02.jpg", "tray_1_day_03.jpg"]:
+            sub_images = series.add_image(imfile, scale=412)
+
+3. Get the growth of each lesion
+
+    .. highlight:: python
+    .. code-block:: python
+
+        growth = series.growth_table()
+
+Or process a folder of one tray's images, in file name order, writing the results files
+
+    .. highlight:: python
+    .. code-block:: python
+
+        rp.process_time_series(folder="~/Desktop/tray_1", settings="~/Desktop/default_filter.yml",
+                               destination_folder="~/Desktop/test_out", pixels_per_cm=412, min_lesion_area=0.001)
+
+"""
+
+import greypatch as rp
+import os
+import sys
+import numpy as np
+import pandas as pd
+from skimage import color
+from typing import List, Tuple, Union
+
+#: images are registered on greyscale copies sampled at every REGISTRATION_STEP th pixel
+REGISTRATION_STEP = 4
+
+#: file in the destination folder of the size of each lesion in each image of a time series
+GROWTH_RESULTS = "growth_results.csv"
+
+#: file in the destination folder of the registration of each image of a time series to the one before
+REGISTRATION_RESULTS = "registration_results.csv"
+
+#: columns of the growth table, see TimeSeries.growth_table
+GROWTH_COLUMNS = ['lesion_id', 'sub_image_index', 'frame', 'image_file', 'label', 'pixels_in_area', 'scale', 'size',
+                  'pixels_growth', 'size_growth']
+
+#: columns of the registration table, see TimeSeries.registration_table
+REGISTRATION_COLUMNS = ['frame', 'image_file', 'row_offset', 'col_offset', 'correlation', 'leaf_detection']
+
+_LESION_PROPS = {
+    'outer_lesion_area': 'outer_lesion_area_props',
+    'inner_lesion_area': 'inner_lesion_area_props',
+}
+
+
+def register_images(previous: np.ndarray, current: np.ndarray,
+                    subpixel: bool = False) -> Tuple[Tuple[float, float], float]:
+    """
+    Estimate the translation between two greyscale images of the same scene, by phase correlation.
+
+    With subpixel the correlation peak is refined from its two neighbours as Foroosh, Zerubia and Berthod (2002) do
+    for phase correlation, giving the offset to a fraction of a pixel.
+
+    :param: previous np.ndarray -- the earlier image
+    :param: current np.ndarray -- the later image, the same shape as previous
+    :param: subpixel bool -- refine the offset to a fraction of a pixel, else it is in whole pixels
+    :return: Tuple of the (row, column) offset, so that a point at p in previous is at p + offset in current, and
+        the correlation of the overlapping pixels of the images once aligned, from -1 to 1
+    """
+    if previous.shape != current.shape:
+        raise ValueError("can't register images of shapes {} and {}".format(previous.shape, current.shape))
+    rows, cols = previous.shape
+    # tapering the edges stops the image borders correlating with each other
+    window = np.outer(np.hanning(rows), np.hanning(cols))
+    f = np.fft.fft2((previous - previous.mean()) * window)
+    g = np.fft.fft2((current - current.mean()) * window)
+    cross = g * np.conj(f)
+    cross /= np.maximum(np.abs(cross), np.finfo(np.float64).tiny)
+    correlation = np.fft.ifft2(cross).real
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    offset = tuple(int(p) - n if p > n // 2 else int(p) for p, n in zip(peak, correlation.shape))
+    overlap = _overlap_correlation(previous, current, offset)
+    if subpixel:
+        offset = tuple(o + _peak_fraction(correlation, peak, axis) for axis, o in enumerate(offset))
+    return offset, overlap
+
+
+def _peak_fraction(correlation, peak, axis):
+    """the fraction of a pixel the true peak of a phase correlation is from peak along axis, -1 to 1"""
+    n = correlation.shape[axis]
+    before, after = list(peak), list(peak)
+    before[axis] = (peak[axis] - 1) % n
+    after[axis] = (peak[axis] + 1) % n
+    centre, low, high = correlation[peak], correlation[tuple(before)], correlation[tuple(after)]
+    if high >= low and high > 0:
+        return float(high / (high + centre))
+    if low > high and low > 0:
+        return float(-low / (low + centre))
+    return 0.0
+
+
+def _overlap_correlation(previous, current, offset):
+    """the correlation of the pixels of previous and current that overlap when current is moved back by offset"""
+    rows, cols = previous.shape
+    dr, dc = offset
+    a = previous[max(-dr, 0):rows - max(dr, 0), max(-dc, 0):cols - max(dc, 0)]
+    b = current[max(dr, 0):rows - max(-dr, 0), max(dc, 0):cols - max(-dc, 0)]
+    if a.size < 2 or a.std() == 0 or b.std() == 0:
+        return 0.0
+    return float(np.corrcoef(a.ravel(), b.ravel())[0, 1])
+
+
+def _shift(bbox, offset, sign=1):
+    """moves a (min_row, min_col, max_row, max_col) bounding box by sign * offset, rounded to whole pixels"""
+    dr, dc = int(round(sign * offset[0])), int(round(sign * offset[1]))
+    return bbox[0] + dr, bbox[1] + dc, bbox[2] + dr, bbox[3] + dc
+
+
+def _overlap(a, b) -> int:
+    """the number of pixels in both of two (bbox, mask) regions"""
+    (a_bbox, a_mask), (b_bbox, b_mask) = a, b
+    r0, c0 = max(a_bbox[0], b_bbox[0]), max(a_bbox[1], b_bbox[1])
+    r1, c1 = min(a_bbox[2], b_bbox[2]), min(a_bbox[3], b_bbox[3])
+    if r0 >= r1 or c0 >= c1:
+        return 0
+    a_part = a_mask[r0 - a_bbox[0]:r1 - a_bbox[0], c0 - a_bbox[1]:c1 - a_bbox[1]]
+    b_part = b_mask[r0 - b_bbox[0]:r1 - b_bbox[0], c0 - b_bbox[1]:c1 - b_bbox[1]]
+    return int(np.count_nonzero(a_part & b_part))
+
+
+def link_regions(previous: List[Tuple[Tuple[int, int, int, int], np.ndarray]],
+                 current: List[Tuple[Tuple[int, int, int, int], np.ndarray]],
+                 min_overlap: float = 0.25) -> List[Union[int, None]]:
+    """
+    Link the regions of one image to those of an earlier image by overlap, one to one.
+
+    Regions are given as (bbox, mask) in the same coordinates, mask being the region's binary image within bbox, as
+    RegionProperties bbox and image. A pair can be linked when their overlap is at least min_overlap of the smaller
+    region, and pairs are linked largest overlap first.
+
+    :param: previous List -- the earlier image's regions
+    :param: current List -- the later image's regions
+    :param: min_overlap float -- the smallest overlap that links two regions, as a proportion of the smaller
+    :return: List of, for each current region, the index of the previous region it is linked to, or None
+    """
+    previous_areas = [int(np.count_nonzero(mask)) for _, mask in previous]
+    current_areas = [int(np.count_nonzero(mask)) for _, mask in current]
+    pairs = []
+    for i, p in enumerate(previous):
+        for j, c in enumerate(current):
+            n = _overlap(p, c)
+            if n > 0 and n >= min_overlap * min(previous_areas[i], current_areas[j]):
+                pairs.append((n, i, j))
+    links = [None] * len(current)
+    used = set()
+    for n, i, j in sorted(pairs, key=lambda pair: (-pair[0], pair[1], pair[2])):
+        if links[j] is None and i not in used:
+            links[j] = i
+            used.add(i)
+    return links
+
+
+class TimeSeries(object):
+    """
+    class representing a series of images of the same tray, tracking its leaves and lesions from image to image
+
+    Positions are held in the coordinates of the first image.
+
+    :ivar frame: the number of images added
+    :ivar offset: the (row, column) position of the latest image's tray relative to the first's, to a fraction of a
+        pixel
+    :ivar leaves: dict of leaf id to (bbox, leaf mask) where the leaf was last found, for the leaves still tracked
+    :ivar lesions: dict of lesion id to (leaf id, bbox, mask, pixels_in_area, size) where the lesion was last found
+    :param: file_settings FilterSettings -- the image segmentation settings
+    :param: dest_folder str -- folder in which to place results files
+    :param: min_lesion_area float -- minimum area for a lesion to pass filter
+    :param: passed_only bool -- only track lesions that pass the filter
+    :param: lesion_type str -- the lesions to track, "outer_lesion_area" or "inner_lesion_area"
+    :param: min_correlation float -- the lowest registration correlation at which leaves are looked for in windows
+        and the translation is used
+    :param: margin int -- pixels added around a leaf's previous bounding box for the window it is looked for in
+    :param: min_overlap float -- the smallest overlap that links leaves or lesions, see link_regions
+    """
+
+    def __init__(self, file_settings: rp.FilterSettings, dest_folder: str = "", min_lesion_area=None,
+                 passed_only: bool = True, lesion_type: str = "outer_lesion_area", min_correlation: float = 0.5,
+                 margin: int = 64, min_overlap: float = 0.25):
+        if lesion_type not in _LESION_PROPS:
+            raise ValueError("lesion_type must be one of {}, not '{}'".format(list(_LESION_PROPS), lesion_type))
+        self.file_settings = file_settings
+        self.dest_folder = dest_folder
+        self.min_lesion_area = min_lesion_area
+        self.passed_only = passed_only
+        self.lesion_type = lesion_type
+        self.min_correlation = min_correlation
+        self.margin = margin
+        self.min_overlap = min_overlap
+        self.frame = 0
+        self.offset = (0, 0)
+        self.leaves = {}
+        self.lesions = {}
+        self._grey = None
+        self._next_leaf_id = 1
+        self._next_lesion_id = 1
+        self._growth_rows = []
+        self._registration_rows = []
+
+    def add_image(self, imfile: str, scale: float = None) -> List[rp.SubImage]:
+        """
+        Add the next image of the series, finding its leaves and lesions and linking them to those seen before.
+
+        :param: imfile str -- path to the image
+        :param: scale float -- pixels per real unit length, if known
+        :return: List of the image's SubImages, each indexed by its leaf id, in leaf id order
+        """
+        rgb = rp.load_rgb(imfile)
+        grey = color.rgb2gray(rgb[::REGISTRATION_STEP, ::REGISTRATION_STEP])
+        pixel_length = 1 / scale if scale else None
+        offset, correlation = (0, 0), float("nan")
+        sub_images = None
+        if self._grey is not None and self._grey.shape == grey.shape:
+            step_offset, correlation = register_images(self._grey, grey, subpixel=True)
+            if correlation >= self.min_correlation:
+                offset = (step_offset[0] * REGISTRATION_STEP, step_offset[1] * REGISTRATION_STEP)
+                self.offset = (self.offset[0] + offset[0], self.offset[1] + offset[1])
+                sub_images = self._windowed_sub_images(imfile, rgb, scale, pixel_length)
+        leaf_detection = "windowed"
+        if sub_images is None:
+            leaf_detection = "full"
+            sub_images = self._full_sub_images(imfile, rgb, scale, pixel_length)
+            # leaves the whole image search didn't find would send every later image to a whole image search
+            found = set(s.index for s in sub_images)
+            self.leaves = {i: leaf for i, leaf in self.leaves.items() if i in found}
+            self.lesions = {i: lesion for i, lesion in self.lesions.items() if lesion[0] in found}
+        sub_images.sort(key=lambda s: s.index)
+
+        for s in sub_images:
+            self.leaves[s.index] = (_shift(s.bbox, self.offset, -1), s.leaf_mask)
+        self._track_lesions(sub_images)
+        self._registration_rows.append((self.frame, imfile, int(round(offset[0])), int(round(offset[1])),
+                                        correlation, leaf_detection))
+        self._grey = grey
+        self.frame += 1
+        return sub_images
+
+    def _make_sub_image(self, imfile, hsv, rgb, bbox, leaf_mask, leaf_id, scale, pixel_length):
+        """a SubImage of a leaf, hsv being the leaf's bounding box of the image in HSV"""
+        r0, c0, r1, c1 = bbox
+        return rp.SubImage(hsv, leaf_id, imfile, file_settings=self.file_settings, dest_folder=self.dest_folder,
+                           min_lesion_area=self.min_lesion_area, scale=scale, pixel_length=pixel_length,
+                           leaf_mask=leaf_mask, bbox=tuple(bbox), rgb=rgb[r0:r1, c0:c1])
+
+    def _full_sub_images(self, imfile, rgb, scale, pixel_length):
+        """finds the leaves in the whole image, linking them to the leaves seen before"""
+        hsv, leaf_mask = rp.rgb_to_hsv(rgb, threshold=rp.subimage._leaf_thresholds(self.file_settings))
+        props = rp.subimage._find_leaves(hsv, self.file_settings, leaf_mask)
+        leaf_ids = list(self.leaves)
+        links = link_regions([self.leaves[i] for i in leaf_ids],
+                             [(_shift(p.bbox, self.offset, -1), p.image) for p in props], self.min_overlap)
+        sub_images = []
+        for p, link in zip(props, links):
+            if link is None:
+                leaf_id = self._next_leaf_id
+                self._next_leaf_id += 1
+            else:
+                leaf_id = leaf_ids[link]
+            sub_images.append(self._make_sub_image(imfile, rp.get_region_subimage(p, hsv), rgb, p.bbox, p.image,
+                                                   leaf_id, scale, pixel_length))
+        return sub_images
+
+    def _windowed_sub_images(self, imfile, rgb, scale, pixel_length):
+        """
+        looks for each leaf in a window around where it was, returning None if any leaf isn't found entirely
+        within its window
+        """
+        rows, cols = rgb.shape[:2]
+        leaf_filter = rp.RegionFilter(self.file_settings['leaf_area'].get('filter') or rp.LEAF_AREA_FILTER)
+        found = []
+        for leaf_id, (bbox, mask) in self.leaves.items():
+            r0, c0, r1, c1 = _shift(bbox, self.offset)
+            w0, v0 = max(r0 - self.margin, 0), max(c0 - self.margin, 0)
+            w1, v1 = min(r1 + self.margin, rows), min(c1 + self.margin, cols)
+            if w0 >= w1 or v0 >= v1:
+                return None
+            hsv, leaf_mask = rp.rgb_to_hsv(rgb[w0:w1, v0:v1],
+                                           threshold=rp.subimage._leaf_thresholds(self.file_settings))
+            labels = rp.subimage._label_leaf_area(hsv, self.file_settings, leaf_mask)
+
+            # the labels under where the leaf was
+            t0, l0, t1, l1 = max(r0, w0), max(c0, v0), min(r1, w1), min(c1, v1)
+            if t0 >= t1 or l0 >= l1:
+                return None
+            under = labels[t0 - w0:t1 - w0, l0 - v0:l1 - v0][mask[t0 - r0:t1 - r0, l0 - c0:l1 - c0]]
+            counts = np.bincount(under, minlength=labels.max() + 1)
+            keep = np.zeros(len(counts), dtype=np.bool_)
+            keep[leaf_filter.select(labels)] = True
+            counts[~keep] = 0
+            best = int(np.argmax(counts))
+            region = labels == best
+            if counts[best] == 0 or counts[best] < self.min_overlap * min(np.count_nonzero(mask),
+                                                                          np.count_nonzero(region)):
+                return None
+            region_rows = np.flatnonzero(region.any(axis=1))
+            region_cols = np.flatnonzero(region.any(axis=0))
+            b0, b1 = region_rows[0], region_rows[-1] + 1
+            e0, e1 = region_cols[0], region_cols[-1] + 1
+            # a leaf touching the window edge may carry on outside it
+            if (b0 == 0 and w0 > 0) or (e0 == 0 and v0 > 0) or \
+                    (b1 == labels.shape[0] and w1 < rows) or (e1 == labels.shape[1] and v1 < cols):
+                return None
+            found.append((leaf_id, hsv[b0:b1, e0:e1], region[b0:b1, e0:e1], (w0 + b0, v0 + e0, w0 + b1, v0 + e1)))
+
+        if len(set(f[3] for f in found)) < len(found):
+            # leaves that have grown together
+            return None
+        return [self._make_sub_image(imfile, hsv, rgb, bbox, leaf_mask, leaf_id, scale, pixel_length)
+                for leaf_id, hsv, leaf_mask, bbox in found]
+
+    def _track_lesions(self, sub_images):
+        """links the lesions of each leaf to those seen in it before, adding their rows to the growth table"""
+        for s in sub_images:
+            areas = [a for a in getattr(s, _LESION_PROPS[self.lesion_type]) if a.passed or not self.passed_only]
+            regions = [(_shift((a.bbox[0] + s.bbox[0], a.bbox[1] + s.bbox[1], a.bbox[2] + s.bbox[0],
+                                a.bbox[3] + s.bbox[1]), self.offset, -1), a.image) for a in areas]
+            lesion_ids = [i for i, lesion in self.lesions.items() if lesion[0] == s.index]
+            links = link_regions([self.lesions[i][1:3] for i in lesion_ids], regions, self.min_overlap)
+            for a, (bbox, mask), link in zip(areas, regions, links):
+                pixels_growth, size_growth = "NA", "NA"
+                if link is None:
+                    lesion_id = self._next_lesion_id
+                    self._next_lesion_id += 1
+                else:
+                    lesion_id = lesion_ids[link]
+                    _, _, _, previous_pixels, previous_size = self.lesions[lesion_id]
+                    pixels_growth = a.area - previous_pixels
+                    if a.size != "NA" and previous_size != "NA":
+                        size_growth = a.size - previous_size
+                self._growth_rows.append((lesion_id, s.index, self.frame, s.parent_image_file, a.label, a.area,
+                                          a.scale, a.size, pixels_growth, size_growth))
+                self.lesions[lesion_id] = (s.index, bbox, mask, a.area, a.size)
+
+    def growth_table(self) -> pd.DataFrame:
+        """
+        the size of each tracked lesion in each image it was found in, and its growth since the image it was last
+        found in, NA in the image it was first found in
+        :return: pandas.DataFrame
+        """
+        return pd.DataFrame(self._growth_rows, columns=GROWTH_COLUMNS)
+
+    def registration_table(self) -> pd.DataFrame:
+        """
+        the translation of each image from the one before, to the nearest pixel, the correlation of the aligned
+        images and whether its leaves were looked for in windows or in the whole image. The first image's
+        correlation is NaN
+        :return: pandas.DataFrame
+        """
+        return pd.DataFrame(self._registration_rows, columns=REGISTRATION_COLUMNS)
+
+
+def process_time_series(folder: str = ".", settings: Union[str, rp.FilterSettings] = "settings.yml",
+                        destination_folder: str = ".", scale_card_side_length=False, pixels_per_cm=False,
+                        min_lesion_area=False, passed_only: bool = True,
+                        scale_cache: Union[str, rp.ScaleCache] = None, min_correlation: float = 0.5,
+                        save_masks: str = None, output: rp.OutputProfile = None) -> None:
+    """
+    Run the pipeline on the images of one tray, taken at intervals, as a time series and write the results files.
+
+    The images are taken in file name order, so should be named to sort by when they were taken. Alongside the
+    sub-images, raw_results.csv and matched_results.csv, in which sub_image_index is the tracked leaf id, the
+    growth table is written to GROWTH_RESULTS and the registration table to REGISTRATION_RESULTS.
+
+    :param: folder str -- folder containing the tray's images
+    :param: settings str or FilterSettings -- file of filter settings, or the settings object, to use
+    :param: destination_folder str -- folder to write output. Created if does not exist
+    :param: scale_card_side_length float -- find a scale card of this side length in cm in each image
+    :param: pixels_per_cm float -- use a previously known value for pixels per centimetre
+    :param: min_lesion_area float -- the minimum area a lesion can be to be retained
+    :param: passed_only bool -- only output and track objects that pass the filter
+    :param: scale_cache str or ScaleCache -- file of, or the, scale card values per camera rig
+    :param: min_correlation float -- the lowest registration correlation at which leaves are looked for in windows
+    :param: save_masks str -- also write each sub-image's label images in this format, "npz" or "npy"
+    :param: output OutputProfile -- the images to write for each sub-image, by default the full profile
+    :return: None
+    """
+    fs, scale_cache = rp.batch._prepare_run(settings, destination_folder, scale_card_side_length, scale_cache)
+    series = TimeSeries(fs, dest_folder=destination_folder, min_lesion_area=min_lesion_area,
+                        passed_only=passed_only, min_correlation=min_correlation)
+    records = rp.ResultRecords()
+    for imfile in sorted(rp.list_image_files(folder)):
+        print("...doing image {}".format(imfile), file=sys.stderr)
+        scale = rp.find_scale(imfile, fs, scale_card_side_length, pixels_per_cm, scale_cache=scale_cache)
+        sub_images = series.add_image(imfile, scale=scale)
+        (output or rp.OutputProfile()).write(sub_images, imfile, destination_folder)
+        for s in sub_images:
+            if save_masks:
+                s.write_label_masks(fmt=save_masks)
+            records.add_sub_image(s.inner_lesion_area_props, s.outer_lesion_area_props,
+                                  image_file=s.parent_image_file, sub_image_index=s.index, passed_only=passed_only)
+
+    if scale_cache is not None and scale_cache.file:
+        scale_cache.write()
+    raw_dfs, match_dfs = records.results_dataframes()
+    rp.write_results(raw_dfs, match_dfs, destination_folder)
+    rp.batch._write_out(os.path.join(destination_folder, GROWTH_RESULTS), series.growth_table())
+    rp.batch._write_out(os.path.join(destination_folder, REGISTRATION_RESULTS), series.registration_table())
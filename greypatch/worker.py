@@ -0,0 +1,313 @@
+"""
+worker
+
+A module for running greypatch as a long-running local service, as used by the webtool.
+
+Starting a fresh greypatch-batch-process for every upload means importing the whole stack, compiling the numba
+kernels and parsing the filter settings YAML each time. The worker does that once, then accepts jobs over HTTP
+and runs them with a bounded number of jobs at a time. Results are written in the same layout as
+greypatch-batch-process.
+
+
+Workflow Overview
+-----------------
+
+1. Start the service, usually with the greypatch-worker script
+2. POST a job as JSON to /jobs, receiving a job id
+3. GET /jobs/<job id> until the job status is 'done' or 'failed'
+
+Basic Usage
+-----------
+
+1. Start the service
+
+    .. highlight:: python
+    .. code-block:: python
+
+        import greypatch as rp
+        rp.serve(host="127.0.0.1", port=8765, max_jobs=2)
+
+2. Submit a job
+
+    .. code-block:: bash
+
+        curl -X POST http://127.0.0.1:8765/jobs -d '{"source_folder": "/var/www/tmp_folder_id",
+            "destination_folder": "/var/www/tmp_folder_out",
+            "filter_settings": "/var/www/tmp_folder_id/default_filter.yml",
+            "pixels_per_cm": 412, "min_lesion_area": 0.001}'
+
+3. Check on it
+
+    .. code-block:: bash
+
+        curl http://127.0.0.1:8765/jobs/<job id>
+
+"""
+
+import greypatch as rp
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from typing import Dict
+
+#: job options that must be given to Worker.submit
+REQUIRED_JOB_OPTIONS = ('source_folder', 'destination_folder', 'filter_settings')
+#: job options accepted by Worker.submit and their defaults
+JOB_OPTIONS = {
+    'source_folder': None,
+    'destination_folder': None,
+    'filter_settings': None,
+    'scale_card_side_length': False,
+    'pixels_per_cm': False,
+    'min_lesion_area': False,
+    'passed_only': True,
+    'scale_cache': None,
+    'n_jobs': 1,
+    'save_masks': None,
+    'stage_cache': None,
+    'output_profile': "full",
+    'image_format': "jpg",
+    'thumbnail_size': 256,
+    'image_quality': 75,
+    'contact_sheet': False,
+}
+
+
+class Worker(object):
+    """
+    class representing a pool of warm greypatch job runners
+
+    :ivar max_jobs: the number of jobs that can run at once, further jobs are queued
+    :ivar max_finished_jobs: the number of finished jobs whose status is kept, the oldest are forgotten first
+    :ivar max_settings: the number of settings files whose parsed settings are kept, the least recently used are
+        forgotten first
+    :ivar jobs: dict of job id to job status dict
+    """
+
+    def __init__(self, max_jobs: int = 2, max_finished_jobs: int = 1000, max_settings: int = 100):
+        self.max_jobs = max_jobs
+        self.max_finished_jobs = max_finished_jobs
+        self.max_settings = max_settings
+        self.jobs = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs)
+        self._settings = OrderedDict()  # path -> (mtime, FilterSettings), least recently used first
+        self._scale_caches = {}
+        self._lock = threading.Lock()
+
+    def warm_up(self) -> None:
+        """
+        compile the numba kernels for the array layouts the pipeline uses, so that the first job doesn't pay for it
+
+        :return: None
+        """
+        rp.batch._warm_up_kernels()
+
+    def get_settings(self, file: str) -> rp.FilterSettings:
+        """
+        get the FilterSettings in a file, parsing it only if it is new or has changed since it was last read. Only
+        the latest version of each file is kept, for the max_settings files used most recently
+
+        :param: file str -- path to the settings file
+        :return: FilterSettings
+        """
+        path = os.path.abspath(file)
+        mtime = os.path.getmtime(file)
+        with self._lock:
+            cached = self._settings.pop(path, None)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, rp.FilterSettings().read(file))
+            self._settings[path] = cached
+            while len(self._settings) > self.max_settings:
+                self._settings.popitem(last=False)
+            return cached[1]
+
+    def get_scale_cache(self, file: str) -> rp.ScaleCache:
+        """
+        get the ScaleCache kept for a file, shared by all jobs that name it. ScaleCache serialises the jobs'
+        recording and writing
+
+        :param: file str -- path to the scale cache file
+        :return: ScaleCache
+        """
+        key = os.path.abspath(file)
+        with self._lock:
+            if key not in self._scale_caches:
+                self._scale_caches[key] = rp.ScaleCache(key)
+            return self._scale_caches[key]
+
+    def submit(self, request: Dict) -> str:
+        """
+        queue a job
+
+        :param: request dict -- job options, see JOB_OPTIONS and REQUIRED_JOB_OPTIONS
+        :return: str the job id
+        """
+        unknown = set(request) - set(JOB_OPTIONS)
+        if unknown:
+            raise ValueError("unknown job options: {}".format(", ".join(sorted(unknown))))
+        options = {k: request.get(k, default) for k, default in JOB_OPTIONS.items()}
+        missing = [k for k in REQUIRED_JOB_OPTIONS if options[k] is None]
+        if missing:
+            raise ValueError("job options must include: {}".format(", ".join(missing)))
+        if bool(options['scale_card_side_length']) == bool(options['pixels_per_cm']):
+            raise ValueError("need exactly one of scale_card_side_length or pixels_per_cm")
+        for k in ('scale_card_side_length', 'pixels_per_cm', 'min_lesion_area'):
+            if options[k]:
+                options[k] = float(options[k])
+        options['n_jobs'] = int(options['n_jobs'])
+
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self.jobs[job_id] = {'job_id': job_id, 'status': 'queued', 'submitted': time.time(),
+                                 'started': None, 'finished': None, 'error': None, 'options': options}
+        self._executor.submit(self._run, job_id, options)
+        return job_id
+
+    def status(self, job_id: str) -> Dict:
+        """
+        get the status of a job
+
+        :param: job_id str -- the job id returned by submit
+        :return: dict, job status
+        """
+        with self._lock:
+            return dict(self.jobs[job_id])
+
+    def job_counts(self) -> Dict[str, int]:
+        """
+        count the jobs kept in each status
+
+        :return: dict of status to the number of jobs
+        """
+        with self._lock:
+            statuses = [job['status'] for job in self.jobs.values()]
+        return {status: statuses.count(status) for status in ('queued', 'running', 'done', 'failed')}
+
+    def _update(self, job_id, **changes):
+        """changes a job's status dict, forgetting the oldest finished jobs once there are too many"""
+        with self._lock:
+            self.jobs[job_id].update(changes)
+            if changes.get('finished') is None:
+                return
+            finished = sorted((job['finished'], i) for i, job in self.jobs.items() if job['finished'] is not None)
+            for _, i in finished[:max(len(finished) - self.max_finished_jobs, 0)]:
+                del self.jobs[i]
+
+    def _run(self, job_id, options):
+        self._update(job_id, status='running', started=time.time())
+        try:
+            scale_cache = self.get_scale_cache(options['scale_cache']) if options['scale_cache'] else None
+            output = rp.OutputProfile(options['output_profile'], image_format=options['image_format'],
+                                      max_side=options['thumbnail_size'], quality=options['image_quality'],
+                                      contact_sheet=options['contact_sheet'])
+            rp.batch_process(folder=options['source_folder'], settings=self.get_settings(options['filter_settings']),
+                             destination_folder=options['destination_folder'],
+                             scale_card_side_length=options['scale_card_side_length'],
+                             pixels_per_cm=options['pixels_per_cm'], min_lesion_area=options['min_lesion_area'],
+                             passed_only=options['passed_only'], scale_cache=scale_cache,
+                             n_jobs=options['n_jobs'], save_masks=options['save_masks'],
+                             stage_cache=options['stage_cache'], output=output)
+            self._update(job_id, status='done', finished=time.time())
+        except Exception as e:
+            error = "{}: {}".format(type(e).__name__, e)
+            print("...job {} failed: {}".format(job_id, error), file=sys.stderr)
+            self._update(job_id, status='failed', error=error, finished=time.time())
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        stop accepting jobs, optionally waiting for queued and running jobs to finish
+
+        :param: wait bool -- wait for the jobs
+        :return: None
+        """
+        self._executor.shutdown(wait=wait)
+
+
+class _WorkerHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, worker):
+        super().__init__(server_address, _WorkerRequestHandler)
+        self.worker = worker
+
+
+class _WorkerRequestHandler(BaseHTTPRequestHandler):
+
+    def _send_json(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self._send_json(404, {'error': "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            job_id = self.server.worker.submit(request)
+        except (ValueError, AttributeError, TypeError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        self._send_json(202, {'job_id': job_id})
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path == "/health":
+            counts = self.server.worker.job_counts()
+            self._send_json(200, {'status': "ok", 'max_jobs': self.server.worker.max_jobs,
+                                  'queued': counts['queued'], 'running': counts['running']})
+        elif path.startswith("/jobs/"):
+            try:
+                self._send_json(200, self.server.worker.status(path[len("/jobs/"):]))
+            except KeyError:
+                self._send_json(404, {'error': "no such job"})
+        else:
+            self._send_json(404, {'error': "not found"})
+
+    def log_message(self, format, *args):
+        sys.stderr.write("...worker {}\n".format(format % args))
+
+
+def make_server(host: str = "127.0.0.1", port: int = 8765, max_jobs: int = 2) -> HTTPServer:
+    """
+    create a warmed up worker and the HTTP server that feeds it jobs, without starting to serve
+
+    :param: host str -- address to listen on, keep this local
+    :param: port int -- port to listen on, 0 picks a free port
+    :param: max_jobs int -- the number of jobs that can run at once
+    :return: HTTPServer, the worker is available as its worker attribute
+    """
+    worker = Worker(max_jobs=max_jobs)
+    worker.warm_up()
+    return _WorkerHTTPServer((host, port), worker)
+
+
+def serve(host: str = "127.0.0.1", port: int = 8765, max_jobs: int = 2) -> None:
+    """
+    run the worker service until interrupted
+
+    :param: host str -- address to listen on, keep this local
+    :param: port int -- port to listen on
+    :param: max_jobs int -- the number of jobs that can run at once
+    :return: None
+    """
+    server = make_server(host=host, port=port, max_jobs=max_jobs)
+    print("...greypatch worker listening on {}:{}".format(*server.server_address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.worker.shutdown(wait=True)
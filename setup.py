@@ -9,7 +9,7 @@ setup(
     author='Dan MacLean',
     author_email='dan.maclean@tsl.ac.uk',
     description='Finding Different Disease Lesions in Plant Leaves',
-    scripts=['scripts/greypatch-batch-process'],
+    scripts=['scripts/greypatch-batch-process', 'scripts/greypatch-worker', 'scripts/greypatch-calibrate'],
     python_requires='>=3.6',
     install_requires=[
         "ipywidgets == 7.5.1",
@@ -24,6 +24,7 @@ setup(
         "pyyaml >=  5.2",
         "shapely >= 1.6.0",
         "pandas >= 0.25.0",
+        "pillow >= 6.0.0",
         "yattag >= 1.12.2"
     ],
 )
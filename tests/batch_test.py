@@ -0,0 +1,152 @@
+import pytest
+import os
+import pandas as pd
+import greypatch as rp
+
+SETTINGS = "tests/known_coords_sizes/within_cartoon_filter.yaml"
+
+
+def _fake_process_image(imfile, fs, destination_folder, **kwargs):
+    df = pd.DataFrame({'label': [1], 'area_type': ["outer_lesion_area"], 'image_file': [imfile]})
+    return [df], []
+
+
+def test_watch_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(rp.batch, "process_image", _fake_process_image)
+    source = tmp_path / "in"
+    dest = tmp_path / "out"
+    source.mkdir()
+    for name in ("a.jpg", "b.jpg"):
+        (source / name).write_bytes(b"image")
+    (source / "empty.jpg").write_bytes(b"")
+    rp.watch_folder(folder=str(source), settings=SETTINGS, destination_folder=str(dest), pixels_per_cm=100,
+                    poll_interval=0.01, settle_delay=0.05, max_idle=0.2)
+    raw = pd.read_csv(str(dest / "raw_results.csv"))
+    assert sorted(os.path.basename(f) for f in raw.image_file) == ["a.jpg", "b.jpg"]
+
+    (source / "c.jpg").write_bytes(b"image")
+    rp.watch_folder(folder=str(source), settings=SETTINGS, destination_folder=str(dest), pixels_per_cm=100,
+                    poll_interval=0.01, settle_delay=0.05, max_idle=0.2)
+    raw = pd.read_csv(str(dest / "raw_results.csv"))
+    assert sorted(os.path.basename(f) for f in raw.image_file) == ["a.jpg", "b.jpg", "c.jpg"]
+    assert len(open(str(dest / rp.PROCESSED_LOG)).readlines()) == 3
+
+
+def test_watch_folder_forgets_vanished_images(tmp_path, monkeypatch):
+    monkeypatch.setattr(rp.batch, "process_image", _fake_process_image)
+    source = tmp_path / "in"
+    source.mkdir()
+    (source / "a.jpg").write_bytes(b"image")
+    (source / "moved.jpg").write_bytes(b"image")
+    list_image_files = rp.batch.list_image_files
+    calls = []
+
+    def listing(folder):
+        calls.append(folder)
+        if len(calls) == 2:
+            (source / "moved.jpg").unlink()
+        if len(calls) > 100:
+            pytest.fail("watch did not stop")
+        return list_image_files(folder) + [str(source / "deleted.jpg")]
+
+    monkeypatch.setattr(rp.batch, "list_image_files", listing)
+    rp.watch_folder(folder=str(source), settings=SETTINGS, destination_folder=str(tmp_path / "out"),
+                    pixels_per_cm=100, poll_interval=0.01, settle_delay=0.05, max_idle=0.2)
+    raw = pd.read_csv(str(tmp_path / "out" / "raw_results.csv"))
+    assert [os.path.basename(f) for f in raw.image_file] == ["a.jpg"]
+
+
+def test_watch_folder_rejects_own_destination(tmp_path):
+    with pytest.raises(ValueError):
+        rp.watch_folder(folder=str(tmp_path), settings=SETTINGS, destination_folder=str(tmp_path) + "/.",
+                        max_idle=0)
+
+
+def test_parse_shard():
+    assert rp.parse_shard("2/10") == (2, 10)
+    for bad in ("10/10", "a/b", "3"):
+        with pytest.raises(ValueError):
+            rp.parse_shard(bad)
+
+
+@pytest.mark.parametrize("by", ["index", "hash"])
+def test_shard_image_files(by):
+    files = ["/images/img_{}.jpg".format(i) for i in range(23)]
+    shards = [rp.shard_image_files(files, (i, 4), by=by) for i in range(4)]
+    assert sorted(sum(shards, [])) == sorted(files)
+    assert shards == [rp.shard_image_files(list(reversed(files)), (i, 4), by=by) for i in range(4)]
+
+
+def test_merge_shards(tmp_path):
+    for i in range(2):
+        (tmp_path / rp.shard_file_name("raw_results.csv", (i, 2))).write_text("label,area\n{},1.0\n".format(i))
+        (tmp_path / rp.shard_file_name("timing_results.csv", (i, 2))).write_text("shard,seconds\n{},2.0\n".format(i))
+    rp.merge_shards(str(tmp_path))
+    assert (tmp_path / "raw_results.csv").read_text() == "label,area\n0,1.0\n1,1.0\n"
+    assert not (tmp_path / "matched_results.csv").exists()
+
+    (tmp_path / rp.shard_file_name("timing_results.csv", (1, 2))).unlink()
+    with pytest.raises(ValueError):
+        rp.merge_shards(str(tmp_path))
+
+
+def test_parse_memory():
+    assert rp.parse_memory("16G") == 16 * 2 ** 30
+    assert rp.parse_memory("1.5m") == int(1.5 * 2 ** 20)
+    assert rp.parse_memory("512MiB") == 512 * 2 ** 20
+    assert rp.parse_memory("1000") == 1000
+    with pytest.raises(ValueError):
+        rp.parse_memory("lots")
+
+
+@pytest.mark.parametrize("run_over_budget", [False, True])
+def test_batch_process_within_memory(tmp_path, monkeypatch, run_over_budget):
+    monkeypatch.setattr(rp.batch, "process_image", _fake_process_image)
+    # neither image fits on the full path, only the smaller one on the lower memory path
+    monkeypatch.setattr(rp.batch, "IMAGE_BYTES_PER_PIXEL", 10 ** 4)
+    monkeypatch.setattr(rp.batch, "LOW_MEMORY_BYTES_PER_PIXEL", 300)
+    source = tmp_path / "in"
+    source.mkdir()
+    for name in ("blobs_within.jpg", "centered_leaf.jpg"):
+        (source / name).write_bytes(open(os.path.join("tests/known_coords_sizes", name), "rb").read())
+    source = str(source)
+    images = rp.list_image_files(source)
+    big = [f for f in images if f.endswith("blobs_within.jpg")]
+    assert rp.estimate_image_memory(big[0], low_memory=True) < rp.estimate_image_memory(big[0])
+    budget = rp.batch._peak_rss() + rp.batch.WORKER_OVERHEAD_BYTES + 2 ** 28
+    dest = tmp_path / "out"
+    rp.batch_process(folder=source, settings=SETTINGS, destination_folder=str(dest), pixels_per_cm=100,
+                     max_memory=budget, max_workers=2, run_over_budget=run_over_budget)
+    raw = pd.read_csv(str(dest / "raw_results.csv"))
+    report = pd.read_csv(str(dest / rp.MEMORY_REPORT))
+    assert list(report.image_file) == images
+    assert report.low_memory.all()
+    statuses = dict(zip(report.image_file, report.status))
+    if run_over_budget:
+        assert list(raw.image_file) == images
+        assert statuses[big[0]] == "over_budget"
+        assert (report.peak_rss_bytes > 0).all()
+    else:
+        assert list(raw.image_file) == [f for f in images if f not in big]
+        assert statuses[big[0]] == "skipped"
+        assert report.peak_rss_bytes.isna().tolist() == [f in big for f in images]
+    assert [s for f, s in statuses.items() if f not in big] == ["processed"]
+
+
+@pytest.mark.parametrize("min_lesion_area", [0.001, 2.0])
+def test_refilter_matches_full_run(tmp_path, min_lesion_area):
+    fs = rp.FilterSettings().read(SETTINGS)
+    imfile = "tests/known_coords_sizes/blobs_within.jpg"
+    region_dfs = []
+    rp.process_image(imfile, fs, str(tmp_path), pixels_per_cm=100, min_lesion_area=0.5, region_dfs=region_dfs)
+    pd.concat(region_dfs).to_csv(str(tmp_path / rp.REGION_TABLE), index=False)
+    rp.refilter(str(tmp_path), min_lesion_area=min_lesion_area, output_folder=str(tmp_path / "refiltered"))
+
+    full = tmp_path / "full"
+    full.mkdir()
+    raw_dfs, match_dfs = rp.process_image(imfile, fs, str(full), pixels_per_cm=100, min_lesion_area=min_lesion_area)
+    rp.write_results(raw_dfs, match_dfs, str(full))
+    for name in ("raw_results.csv", "matched_results.csv"):
+        assert (full / name).exists() == (tmp_path / "refiltered" / name).exists()
+        if (full / name).exists():
+            assert (full / name).read_text() == (tmp_path / "refiltered" / name).read_text()
@@ -0,0 +1,54 @@
+import numpy as np
+import yaml
+import greypatch as rp
+
+
+def _calibration_image():
+    rng = np.random.RandomState(1)
+    img = np.zeros((60, 60, 3))
+    img[..., 0] = rng.uniform(0.6, 0.9, (60, 60))
+    img[..., 1] = rng.uniform(0.0, 1.0, (60, 60))
+    img[..., 2] = rng.uniform(0.0, 1.0, (60, 60))
+    leaf = np.zeros((60, 60), dtype=np.bool_)
+    leaf[10:50, 10:50] = True
+    img[leaf, 0] = rng.uniform(0.26, 0.49, leaf.sum())
+    img[leaf, 1] = rng.uniform(0.51, 0.74, leaf.sum())
+    lesion = np.zeros((60, 60), dtype=np.bool_)
+    lesion[20:30, 20:30] = True
+    img[lesion, 0] = rng.uniform(0.01, 0.12, lesion.sum())
+    return img, leaf | lesion, lesion
+
+
+def test_calibrate_filter_settings():
+    img, leaf, lesion = _calibration_image()
+    base = rp.FilterSettings()
+    base.add_setting("scale_card", h=(0.6, 1.0), s=(0.2, 1.0), v=(0.2, 0.8))
+    fs, scores = rp.calibrate_filter_settings([(img, {'leaf_area': leaf | lesion, 'outer_lesion_area': lesion})],
+                                              tags=['leaf_area', 'outer_lesion_area'], bins=32, n_jobs=2,
+                                              base_settings=base)
+    assert scores['outer_lesion_area'] == 1.0
+    assert fs['scale_card']['h'] == (0.6, 1.0)
+    m = rp.threshold_hsv_img(img, **fs['outer_lesion_area']) & leaf
+    assert np.array_equal(m, lesion)
+    m = rp.threshold_hsv_img(img, **fs['leaf_area'])
+    assert np.sum(m & leaf) / np.sum(m | leaf) == scores['leaf_area']
+    assert scores['leaf_area'] > 0.9
+
+
+def test_lesion_tags_scored_within_leaf():
+    img, leaf, lesion = _calibration_image()
+    # background the colour of the lesion, which a threshold can't tell from it
+    img[50:, 50:] = img[20:30, 20:30]
+    masks = {'leaf_area': leaf, 'outer_lesion_area': lesion, 'inner_lesion_area': lesion}
+    _, scores = rp.calibrate_filter_settings([(img, masks)], tags=['outer_lesion_area', 'inner_lesion_area'],
+                                             bins=32)
+    assert scores == {'outer_lesion_area': 1.0, 'inner_lesion_area': 1.0}
+    _, scores = rp.calibrate_filter_settings([(img, masks)], tags=['outer_lesion_area'], bins=32, within={})
+    assert scores['outer_lesion_area'] <= 0.5
+
+
+def test_read_calibration_manifest(tmp_path):
+    f = str(tmp_path / "manifest.yml")
+    with open(f, "w") as out:
+        yaml.safe_dump([{'image': "a.jpg", 'masks': {'leaf_area': "a_leaf.png"}}], out)
+    assert rp.read_calibration_manifest(f) == [("a.jpg", {'leaf_area': "a_leaf.png"})]
@@ -126,6 +126,65 @@ def test_load_as_hsv(sample_hsv, sample_hsv2):
     assert img.shape == sample_hsv.shape
     img = rp.load_as_hsv('tests/nine_pixel_white_ground_black_cross.png')
     assert np.array_equal(img, sample_hsv2)
+    hsv, rgb = rp.load_as_hsv('tests/cross_plus_alpha.png', return_rgb=True)
+    assert rgb.shape == hsv.shape and rgb.dtype == np.uint8
+    assert np.array_equal(hsv, rp.load_as_hsv('tests/cross_plus_alpha.png'))
+    imfile = 'tests/known_coords_sizes/blobs_within.jpg'
+    assert np.array_equal(rp.load_as_hsv(imfile, n_jobs=3), rp.load_as_hsv(imfile))
+
+
+def test_rgb_to_hsv_matches_skimage():
+    from skimage import color
+    rng = np.random.default_rng(0)
+    rgb = rng.integers(0, 256, size=(300, 200, 3), dtype=np.uint8)
+    # greys, primaries and ties between channels
+    rgb[0, :8] = [[0, 0, 0], [255, 255, 255], [7, 7, 7], [255, 0, 0], [0, 255, 0], [0, 0, 255], [9, 9, 3], [3, 9, 9]]
+    rgb[1, :4] = [[200, 10, 200], [10, 200, 200], [200, 200, 10], [1, 0, 1]]
+    expected = color.rgb2hsv(rgb)
+
+    assert np.array_equal(rp.rgb_to_hsv(rgb), expected)
+    assert np.array_equal(rp.rgb_to_hsv(rgb, n_jobs=4), expected)
+    as_float32 = rp.rgb_to_hsv(rgb, dtype=np.float32)
+    assert as_float32.dtype == np.float32
+    assert np.abs(as_float32 - expected).max() <= rp.HSV_TOLERANCE[np.dtype(np.float32)]
+
+    out = np.full((400, 200, 3), -1.0)
+    assert rp.rgb_to_hsv(rgb[::-1, :, :], out=out[50:350]) is not None
+    assert np.array_equal(out[50:350], expected[::-1])
+    assert (out[:50] == -1).all() and (out[350:] == -1).all()
+
+    h, s, v = (0.1, 0.4), (0.2, 1.0), (0.3, 0.9)
+    hsv, mask = rp.rgb_to_hsv(rgb, threshold=(h, s, v), n_jobs=3)
+    assert np.array_equal(hsv, expected)
+    assert np.array_equal(mask, rp.threshold_hsv_img(expected, h=h, s=s, v=v))
+
+    as_uint16 = rgb.astype(np.uint16) * 257
+    hsv, mask = rp.rgb_to_hsv(as_uint16, threshold=(h, s, v))
+    assert np.allclose(hsv, color.rgb2hsv(as_uint16))
+    assert np.array_equal(mask, rp.threshold_hsv_img(color.rgb2hsv(as_uint16), h=h, s=s, v=v))
+
+    with pytest.raises(ValueError):
+        rp.rgb_to_hsv(rgb, dtype=np.float16)
+    with pytest.raises(ValueError):
+        rp.rgb_to_hsv(rgb, out=np.empty((2, 2, 3)))
+
+
+@pytest.mark.parametrize("reduce", [2, 4, 8])
+def test_load_as_hsv_reduced(reduce):
+    from PIL import Image
+    imfile = 'tests/known_coords_sizes/blobs_within.jpg'
+    full = rp.load_as_hsv(imfile)
+    reduced = rp.load_as_hsv(imfile, reduce=reduce)
+    assert reduced.shape[:2] == rp.reduced_size(full.shape[:2], reduce)
+    # the DCT scaled decode is close to a block average of the full decode
+    rows, cols = (n // reduce * reduce for n in full.shape[:2])
+    rgb = np.asarray(Image.open(imfile).convert("RGB"), dtype=np.float64)[:rows, :cols]
+    averaged = rgb.reshape(rows // reduce, reduce, cols // reduce, reduce, 3).mean(axis=(1, 3))
+    _, reduced_rgb = rp.load_as_hsv(imfile, reduce=reduce, return_rgb=True)
+    assert np.abs(reduced_rgb[:rows // reduce, :cols // reduce] - averaged).mean() < 3
+    assert rp.load_as_hsv('tests/cross_plus_alpha.png', reduce=reduce).shape[:2] == rp.reduced_size((3, 3), reduce)
+    with pytest.raises(ValueError):
+        rp.load_as_hsv(imfile, reduce=3)
 
 
 def test_is_long_and_large():
@@ -152,9 +211,96 @@ def test_clean_labelled_mask(mask_to_label):
     filtered = rp.clean_labelled_mask(label_array, objs)
     assert filtered.max() == 3
 
+def test_remap_labels(mask_to_label):
+    label_array, _ = rp.label_image(mask_to_label)
+    objs = [RP(label = i) for i in (2, 4, 9)]
+    remapped, count = rp.remap_labels(label_array, objs)
+    assert count == 2
+    assert remapped.dtype == label_array.dtype
+    relabelled, _ = rp.label_image(rp.clean_labelled_mask(label_array, objs))
+    assert np.array_equal(remapped, relabelled)
+
 def test_clear_background(sample_hsv, sample_threshold_bool, sample_threshold_hsv):
     assert np.array_equal( rp.clear_background(sample_hsv, sample_threshold_bool), sample_threshold_hsv)
 
 def test_pixel_volume_to_circular_area():
     assert math.isclose(rp.pixel_volume_to_circular_area(50, 10), 0.503, abs_tol=0.05)
 
+    def stepped(pixels, scale):
+        i = 1
+        r = 0
+        while i < pixels / 2.0:
+            i = i + (i + 2)
+            r += 1
+        return math.pi * ((r / scale) ** 2)
+
+    step_values = [3 * 2 ** k - 2 for k in range(40)]
+    pixels = np.array(sorted(set(list(range(0, 3000)) + [2 * v + d for v in step_values for d in (-1, 0, 1)])))
+    expected = [stepped(p, 412.0) for p in pixels]
+    assert list(rp.pixel_volume_to_circular_area(pixels, 412.0)) == expected
+    assert rp.pixel_volume_to_circular_area(2 * step_values[20] + 1, 412.0) == stepped(2 * step_values[20] + 1, 412.0)
+
+
+def test_threshold_hsv_img_with_mask(sample_hsv, sample_threshold_bool):
+    cleared = rp.clear_background(sample_hsv, sample_threshold_bool)
+    for h, s, v in [((0., 0.5), (0., 0.5), (0.6, 1.0)), ((0., 0.5), (0., 0.5), (0.0, 0.6))]:
+        thr = rp.threshold_hsv_img(sample_hsv, h=h, s=s, v=v, mask=sample_threshold_bool)
+        assert np.array_equal(thr, rp.threshold_hsv_img(cleared, h=h, s=s, v=v))
+
+def test_clear_background_in_place(sample_hsv, sample_threshold_bool, sample_threshold_hsv):
+    rp.clear_background(sample_hsv, sample_threshold_bool, out=sample_hsv)
+    assert np.array_equal(sample_hsv, sample_threshold_hsv)
+
+def test_fill_holes():
+    from scipy import ndimage as ndi
+    rng = np.random.RandomState(42)
+    for _ in range(10):
+        m = rng.rand(40, 30) > 0.5
+        expected = ndi.binary_fill_holes(m)
+        assert np.array_equal(rp.fill_holes(m), expected)
+        assert np.array_equal(rp.fill_holes(m, method="propagate"), expected)
+    assert np.array_equal(rp.fill_holes(m, method="none"), m)
+    with pytest.raises(ValueError):
+        rp.fill_holes(m, method="flood")
+
+def test_griffin_lesion_centres_batch():
+    from skimage import color, feature
+    rng = np.random.RandomState(1)
+    hsv = np.zeros((60, 80, 3))
+    hsv[:, :, 2] = 0.2
+    for r, c in [(5, 5), (36, 40), (10, 55)]:
+        hsv[r:r + 20, c:c + 20, 2] = 0.9
+        hsv[r + 8:r + 12, c + 8:c + 12, 2] = 0.5
+    hsv += rng.rand(*hsv.shape) * 0.01
+    labels, _ = rp.label_image(hsv[:, :, 2] > 0.45)
+    regions = rp.get_object_properties(labels)
+    batched = rp.griffin_lesion_centres_batch(hsv, regions, sigma=1.0)
+    assert len(batched) == len(regions) == 3
+    grey = color.rgb2gray(color.hsv2rgb(hsv))
+    for region, centres in zip(regions, batched):
+        edges = feature.canny(rp.get_region_subimage(region, grey), sigma=1.0)
+        expected, _ = rp.label_image(rp.fill_holes(edges))
+        assert [c.area for c in centres] == [e.area for e in rp.get_object_properties(expected)]
+        assert [c.area for c in rp.griffin_lesion_centres(hsv, region, sigma=1.0)] == [c.area for c in centres]
+    assert rp.griffin_lesion_centres_batch(hsv, []) == []
+    from_rgb = rp.griffin_lesion_centres_batch(hsv, regions, sigma=1.0, rgb_img=color.hsv2rgb(hsv))
+    assert [[c.area for c in cs] for cs in from_rgb] == [[c.area for c in cs] for cs in batched]
+
+def test_griffin_scale_card():
+    hsv = np.zeros((300, 400, 3))
+    hsv[50:150, 200:300] = (0.7, 0.5, 0.5)  # card, 100 x 100 pixels
+    hsv[200:210, 20:30] = (0.7, 0.5, 0.5)
+    args = dict(h=rp.SCALE_CARD_HUE, s=rp.SCALE_CARD_SAT, v=rp.SCALE_CARD_VAL, side_length=5)
+    assert rp.griffin_scale_card(hsv, downsample=1, **args) == 20.0
+    assert rp.griffin_scale_card(hsv, **args) == 20.0
+    assert rp.griffin_scale_card(np.zeros((30, 30, 3)), **args) is None
+    from skimage import color, img_as_ubyte
+    rgb = img_as_ubyte(color.hsv2rgb(hsv))
+    assert rp.griffin_scale_card(None, rgb_img=rgb, **args) == rp.griffin_scale_card(rp.rgb_to_hsv(rgb), **args) == 20.0
+
+
+def test_any_pixels_pass(sample_hsv, sample_threshold_bool):
+    boxes = [((0., 0.5), (0., 0.5), (0.6, 1.0)), ((0., 0.5), (0., 0.5), (0.0, 0.6)), ((0.9, 1.0), (0.9, 1.0), (0.9, 1.0))]
+    for mask in (None, sample_threshold_bool):
+        expected = [rp.threshold_hsv_img(sample_hsv, h=h, s=s, v=v, mask=mask).any() for h, s, v in boxes]
+        assert list(rp.any_pixels_pass(sample_hsv, boxes, mask=mask)) == expected
@@ -0,0 +1,37 @@
+import numpy as np
+import greypatch as rp
+
+IMFILE = "tests/known_coords_sizes/blobs_within.jpg"
+
+
+def test_count_matches_threshold():
+    img = rp.load_as_hsv(IMFILE)
+    hist = rp.HSVHistogram(img, bins=16)
+    assert hist.total == img.shape[0] * img.shape[1]
+    for h, s, v in [((0.0, 1.0), (0.0, 1.0), (0.0, 1.0)),
+                    ((0.0, 0.5), (0.25, 0.75), (0.5, 1.0)),
+                    ((0.13, 0.41), (0.07, 0.93), (0.2, 0.35)),
+                    ((0.3, 0.31), (0.0, 0.02), (0.9, 0.91)),
+                    ((0.5, 0.4), (0.0, 1.0), (0.0, 1.0))]:
+        expected = np.sum(rp.threshold_hsv_img(img, h=h, s=s, v=v)) if h[0] <= h[1] else 0
+        assert hist.count(h=h, s=s, v=v) == expected
+
+
+def test_count_with_mask_and_bin_edges():
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 9, size=(40, 30, 3)) / 8.0
+    mask = rng.rand(40, 30) > 0.5
+    hist = rp.HSVHistogram(img, bins=8, mask=mask)
+    h, s, v = (0.25, 0.75), (0.0, 0.5), (0.125, 1.0)
+    expected = np.sum(rp.threshold_hsv_img(img, h=h, s=s, v=v) & mask)
+    assert hist.count(h=h, s=s, v=v) == expected
+    assert hist.box_counts([0, 0, 0], [8, 8, 8]) == mask.sum()
+    assert list(hist.box_counts([[0, 0, 0], [2, 2, 2]], [[8, 8, 8], [2, 8, 8]])) == [mask.sum(), 0]
+
+
+def test_whole_bin_counts_on_bin_edges():
+    # the threshold preview counts whole bins, one per slider step
+    img = np.random.RandomState(1).rand(50, 60, 3)
+    hist = rp.HSVHistogram(img, bins=round(1 / rp.PREVIEW_SLIDER_STEP), exact=False)
+    for h, s, v in [((0.2, 0.4), (0.2, 0.4), (0.2, 0.4)), ((0.0, 0.16), (0.15, 1.0), (0.07, 0.93))]:
+        assert hist.count(h=h, s=s, v=v) == np.sum(rp.threshold_hsv_img(img, h=h, s=s, v=v))
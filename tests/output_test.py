@@ -0,0 +1,70 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+import greypatch as rp
+
+IMAGE = "tests/known_coords_sizes/blobs_within.jpg"
+
+
+@pytest.fixture(scope="module")
+def fs():
+    return rp.FilterSettings().read("tests/known_coords_sizes/within_cartoon_filter.yaml")
+
+
+def sub_images(fs, folder):
+    return rp.get_sub_images(IMAGE, file_settings=fs, dest_folder=str(folder), min_lesion_area=40)
+
+
+def test_full_jpg_writes_as_before(tmp_path, fs):
+    before, after = tmp_path / "before", tmp_path / "after"
+    before.mkdir()
+    after.mkdir()
+    for s in sub_images(fs, before):
+        s.write_sub_image()
+        s.write_annotated_sub_image()
+    ims = sub_images(fs, after)
+    files = rp.OutputProfile().write(ims, IMAGE, str(after))
+    assert len(files) == 2 * len(ims)
+    assert sorted(os.listdir(before)) == sorted(os.listdir(after))
+    for name in os.listdir(before):
+        assert (before / name).read_bytes() == (after / name).read_bytes()
+
+
+@pytest.mark.parametrize("profile,per_sub_image", [("annotated-only", 1), ("thumbnails", 2), ("none", 0)])
+def test_profiles_write_their_images(tmp_path, fs, profile, per_sub_image):
+    ims = sub_images(fs, tmp_path)
+    files = rp.OutputProfile(profile, image_format="png", max_side=64).write(ims, IMAGE, str(tmp_path))
+    assert len(files) == per_sub_image * len(ims)
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(f) for f in files)
+    assert all(f.endswith(".png") for f in files)
+    if profile == "thumbnails":
+        for f in files:
+            with Image.open(f) as img:
+                assert max(img.size) <= 64
+
+
+def test_contact_sheet(tmp_path, fs):
+    ims = sub_images(fs, tmp_path)
+    files = rp.OutputProfile("thumbnails", image_format="webp", max_side=50, quality=60,
+                             contact_sheet=True).write(ims, IMAGE, str(tmp_path))
+    assert [os.path.basename(f) for f in files] == ["blobs_within.jpg_sub_images.webp",
+                                                    "blobs_within.jpg_annotated.webp"]
+    with Image.open(files[0]) as img:
+        assert img.format == "WEBP"
+
+
+def test_contact_sheet_layout():
+    images = [np.zeros((10, 20, 3), dtype=np.uint8), np.zeros((5, 5, 3), dtype=np.uint8),
+              np.zeros((8, 8, 3), dtype=np.uint8)]
+    sheet = rp.contact_sheet(images, gap=2)
+    assert sheet.shape == (10 * 2 + 2, 20 * 2 + 2, 3)
+    assert sheet[12:17, 0:5].max() == 0
+    assert sheet[12:22, 22:].min() == 255
+
+
+def test_bad_profile():
+    with pytest.raises(ValueError):
+        rp.OutputProfile("small")
+    with pytest.raises(ValueError):
+        rp.OutputProfile(image_format="tiff")
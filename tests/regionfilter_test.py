@@ -0,0 +1,60 @@
+import pytest
+import numpy as np
+import greypatch as rp
+
+
+@pytest.fixture
+def label_array():
+    a = np.zeros((60, 60), dtype=np.int32)
+    a[0:10, 0:10] = 1
+    a[20:22, 0:40] = 2
+    a[30:50, 30:50] = 3
+    a[55, 55] = 4
+    return a
+
+
+@pytest.mark.parametrize("expression", ["area >= 50", "major/minor >= 2 & area >= 60", "area < 10 | area > 300",
+                                        "~(area >= 50)", "50 <= area <= 100"])
+def test_matches_predicates(label_array, expression):
+    props = rp.get_object_properties(label_array)
+    namespace = {'area': None, 'major': None, 'minor': None}
+    python = expression.replace("&", " and ").replace("|", " or ").replace("~", " not ")
+
+    def predicate(r):
+        namespace.update(area=r.area, major=r.major_axis_length, minor=r.minor_axis_length)
+        try:
+            return bool(eval(python, {}, namespace))
+        except ZeroDivisionError:
+            return False
+
+    expected = [r.label for r in props if predicate(r)]
+    assert list(rp.RegionFilter(expression).select(label_array)) == expected
+    assert [r.label for r in rp.filter_region_property_list(props, expression)] == expected
+
+
+def test_is_not_small_default():
+    rng = np.random.default_rng(0)
+    labels, _ = rp.label_image(rng.random((300, 300)) > 0.4)
+    props = rp.get_object_properties(labels)
+    expected = [r.label for r in rp.filter_region_property_list(props, rp.is_not_small)]
+    assert list(rp.RegionFilter(rp.LEAF_AREA_FILTER).select(labels)) == expected
+
+
+def test_division_by_zero_fails(label_array):
+    # the single pixel region has a minor axis of 0
+    assert 4 not in rp.RegionFilter("major/minor >= 0").select(label_array)
+
+
+@pytest.mark.parametrize("expression", ["area >=", "__import__('os')", "area.real > 1", "'a' == area", "True"])
+def test_rejects_bad_expressions(expression):
+    with pytest.raises(ValueError):
+        rp.RegionFilter(expression)
+
+
+def test_filter_setting(tmp_path):
+    fs = rp.FilterSettings()
+    fs.add_setting("leaf_area", h=(0.1, 1.0), s=(0.3, 0.6), v=(0.4, 0.6), filter="area >= 10000")
+    fs.write(str(tmp_path / "settings.yaml"))
+    assert rp.FilterSettings().read(str(tmp_path / "settings.yaml"))["leaf_area"]["filter"] == "area >= 10000"
+    with pytest.raises(ValueError):
+        fs.add_setting("leaf_area", filter="area >=")
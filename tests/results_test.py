@@ -0,0 +1,63 @@
+import pytest
+import pandas as pd
+import greypatch as rp
+
+
+class Lesion(object):
+    def __init__(self, label, area, passed, centroid):
+        self.label = label
+        self.area = float(area)
+        self.passed = passed
+        self.scale = 100.0
+        self.size = area / 100.0 ** 2
+        self.centroid = centroid
+        self.matches_with = None
+
+
+@pytest.fixture
+def sub_images():
+    fs = rp.FilterSettings().read("tests/known_coords_sizes/within_cartoon_filter.yaml")
+    return rp.get_sub_images("tests/known_coords_sizes/blobs_within.jpg", file_settings=fs, dest_folder="",
+                             min_lesion_area=40)
+
+
+@pytest.mark.parametrize("passed_only", [True, False])
+def test_matches_dataframe_results(sub_images, passed_only):
+    s, = sub_images
+    records = rp.ResultRecords(capacity=1)
+    records.add_sub_image(s.inner_lesion_area_props, s.outer_lesion_area_props, image_file=s.parent_image_file,
+                          sub_image_index=s.index, passed_only=passed_only)
+    raw_dfs, match_dfs = records.results_dataframes()
+
+    inner_df, outer_df = s.get_results_dataframes(passed_only=passed_only)
+    raw = pd.concat([outer_df, inner_df])
+    matched = rp.subimage._make_match_dataframe(raw)
+    assert raw_dfs[0].to_csv(index=False) == raw.to_csv(index=False)
+    assert match_dfs[0].to_csv(index=False) == matched.to_csv(index=False)
+
+
+def test_unpaired_sub_image_keeps_types():
+    inners = [Lesion(1, 300, True, (1, 1))]
+    rp.match_inner_outer(inners, [])
+    records = rp.ResultRecords()
+    records.add_sub_image(inners, [], image_file="a.jpg", sub_image_index=1)
+    records.add_sub_image([Lesion(1, 300, True, (1, 1))], [Lesion(1, 600, False, (1, 1))], image_file="a.jpg",
+                          sub_image_index=2, passed_only=True)
+    raw_dfs, match_dfs = records.results_dataframes()
+    assert match_dfs == []
+    raw = raw_dfs[0]
+    assert list(raw.label) == [1, 1] and raw.label.dtype == "int64"
+    assert list(raw.passed) == [True, True]
+    assert list(raw.matched_with) == [None, None]
+
+
+def test_add():
+    a, b = rp.ResultRecords(), rp.ResultRecords()
+    inners, outers = [Lesion(1, 300, True, (1, 1))], [Lesion(2, 600, True, (1, 2))]
+    rp.match_inner_outer(inners, outers)
+    b.add_sub_image(inners, outers, image_file="b.jpg", sub_image_index=1)
+    a.add(b)
+    assert a.sub_images == 1 and a.has_matched
+    assert list(a.matched['outer_inner_ratio_pixels']) == [0.5]
+    assert list(a.raw['area_type']) == ["outer_lesion_area", "inner_lesion_area"]
+    assert rp.ResultRecords().results_dataframes() == ([], [])
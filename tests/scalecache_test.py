@@ -0,0 +1,47 @@
+import pytest
+import greypatch as rp
+
+IMFILE = "tests/known_coords_sizes/blobs_within.jpg"
+
+
+def test_rig_key():
+    key = rp.ScaleCache.rig_key(IMFILE)
+    assert key.endswith("x".join(str(i) for i in reversed(rp.load_as_hsv(IMFILE).shape[:2])))
+
+
+def test_record_and_lookup():
+    cache = rp.ScaleCache(min_observations=3, tolerance=0.02)
+    cache.record(IMFILE, 100.0)
+    cache.record(IMFILE, 101.0)
+    assert cache.lookup(IMFILE) is None
+    cache.record(IMFILE, 120.0)
+    assert cache.lookup(IMFILE) is None
+    cache.record(IMFILE, 120.5)
+    cache.record(IMFILE, 119.9)
+    assert cache.lookup(IMFILE) == 120.0
+    assert IMFILE in cache
+
+
+def test_write_and_read(tmp_path):
+    f = str(tmp_path / "scale_cache.yml")
+    cache = rp.ScaleCache(f, min_observations=1)
+    cache.record(IMFILE, 42.0)
+    cache.write()
+    assert rp.ScaleCache(f).lookup(IMFILE) == 42.0
+
+
+def test_shared_between_threads(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    import pickle
+    cache = rp.ScaleCache(str(tmp_path / "scale_cache.yml"), min_observations=3)
+
+    def record(value):
+        for _ in range(50):
+            cache.record(IMFILE, value)
+            cache.write()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(record, [100.0, 100.5, 101.0, 100.2]))
+    entry, = rp.ScaleCache(cache.file).entries.values()
+    assert len(entry['observations']) == 200
+    assert pickle.loads(pickle.dumps(cache)).lookup(IMFILE) == cache.lookup(IMFILE)
@@ -0,0 +1,49 @@
+import pytest
+import greypatch as rp
+
+IMAGE = "tests/known_coords_sizes/blobs_within.jpg"
+SETTINGS = "tests/known_coords_sizes/within_cartoon_filter.yaml"
+
+
+def areas(sub_images):
+    return [[(a.label, a.area, a.passed) for a in areas]
+            for s in sub_images
+            for areas in (s.healthy_obj_props, s.outer_lesion_area_props, s.inner_lesion_area_props)]
+
+
+@pytest.fixture
+def fs():
+    return rp.FilterSettings().read(SETTINGS)
+
+
+def test_key_depends_on_stage_settings(tmp_path, fs):
+    cache = rp.StageCache(str(tmp_path))
+    image_hash = cache.image_hash(IMAGE)
+    keys = {stage: cache.key(stage, image_hash, fs) for stage in rp.STAGE_SETTINGS}
+    fs.settings['inner_lesion_area']['h'] = [0.2, 0.45]
+    changed = [stage for stage in rp.STAGE_SETTINGS if cache.key(stage, image_hash, fs) != keys[stage]]
+    assert changed == ['inner_lesion_area']
+    fs.settings['leaf_area']['h'] = [0, 1]
+    assert all(cache.key(stage, image_hash, fs) != keys[stage] for stage in rp.STAGE_SETTINGS)
+    # the same values written differently
+    key = cache.key('leaf_area', image_hash, fs)
+    fs.settings['leaf_area']['h'] = (0.0, 1.0)
+    assert cache.key('leaf_area', image_hash, fs) == key
+
+
+def test_only_changed_band_is_run_again(tmp_path, fs):
+    cache = rp.StageCache(str(tmp_path / "cache"))
+    first = rp.get_sub_images(IMAGE, file_settings=fs, dest_folder="", min_lesion_area=40, stage_cache=cache)
+    assert cache.hits == {}
+    assert cache.misses == {stage: 1 for stage in rp.STAGE_SETTINGS}
+
+    again = rp.get_sub_images(IMAGE, file_settings=fs, dest_folder="", min_lesion_area=40, stage_cache=cache)
+    assert cache.hits == {stage: 1 for stage in rp.STAGE_SETTINGS}
+    assert areas(again) == areas(first)
+
+    fs.settings['inner_lesion_area']['h'] = (0.2, 0.45)
+    tuned = rp.get_sub_images(IMAGE, file_settings=fs, dest_folder="", min_lesion_area=40, n_jobs=2,
+                              stage_cache=cache)
+    assert cache.misses['inner_lesion_area'] == 2
+    assert all(cache.misses[stage] == 1 for stage in ('leaf_area', 'healthy_area', 'outer_lesion_area'))
+    assert areas(tuned) == areas(rp.get_sub_images(IMAGE, file_settings=fs, dest_folder="", min_lesion_area=40))
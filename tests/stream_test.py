@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+import greypatch as rp
+
+IMAGE = "tests/known_coords_sizes/blobs_within.jpg"
+
+
+@pytest.fixture
+def fs():
+    return rp.FilterSettings().read("tests/known_coords_sizes/within_cartoon_filter.yaml")
+
+
+def test_stream_matches_process_image(tmp_path, fs):
+    with open(IMAGE, "rb") as file:
+        data = file.read()
+    images = [("as_bytes", data), ("as_array", rp.load_rgb(IMAGE))]
+    results = list(rp.stream_images(iter(images), fs, pixels_per_cm=100, min_lesion_area=0.5, masks=True))
+    assert list(tmp_path.iterdir()) == []
+
+    raw_dfs, match_dfs = rp.process_image(IMAGE, fs, str(tmp_path), pixels_per_cm=100, min_lesion_area=0.5)
+    expected_raw = raw_dfs[0].drop(columns='image_file')
+    expected_matched = match_dfs[0].drop(columns=['image_file_x', 'image_file_y'])
+    for result, (image_id, _) in zip(results, images):
+        assert result.image_id == image_id
+        assert list(result.raw_results['image_file'].unique()) == [image_id]
+        pd.testing.assert_frame_equal(result.raw_results.drop(columns='image_file'), expected_raw)
+        pd.testing.assert_frame_equal(result.matched_results.drop(columns=['image_file_x', 'image_file_y']),
+                                      expected_matched)
+        assert set(result.region_table['area_type']) >= {"leaf_area", "outer_lesion_area"}
+        labels = result.masks[1]['outer_lesion_area']
+        assert sorted(np.unique(labels[labels > 0])) == sorted(
+            result.region_table.query("area_type == 'outer_lesion_area'")['label'])
+
+
+def test_stream_is_lazy(fs):
+    taken = []
+
+    def images():
+        for i in range(3):
+            taken.append(i)
+            yield i, rp.load_rgb(IMAGE)
+
+    stream = rp.stream_images(images(), fs)
+    assert taken == []
+    next(stream)
+    assert taken == [0]
+
+
+def test_sub_image_without_dest_folder_cannot_write(fs):
+    s = rp.get_sub_images_from_array(rp.load_rgb(IMAGE), "in_memory", file_settings=fs, min_lesion_area=40)[0]
+    assert s.imtag is None
+    with pytest.raises(ValueError):
+        s.write_sub_image()
@@ -1,5 +1,6 @@
 import pytest
 
+import numpy as np
 import greypatch as rp
 
 @pytest.fixture
@@ -30,3 +31,65 @@ def test_inner_lesion_area_props(si):
 def test_inner_outer_match(si):
     assert si.matched_innerouter == [[0,1]]
 
+
+def test_threaded_sub_images_match_serial():
+    fs = rp.FilterSettings()
+    fs.read("tests/known_coords_sizes/within_cartoon_filter.yaml")
+    kwargs = dict(file_settings=fs, dest_folder="", min_lesion_area=40)
+    serial = rp.get_sub_images("tests/known_coords_sizes/blobs_within.jpg", **kwargs)
+    threaded = rp.get_sub_images("tests/known_coords_sizes/blobs_within.jpg", n_jobs=3, **kwargs)
+    assert len(serial) == len(threaded)
+    for s, t in zip(serial, threaded):
+        for band in ("healthy_obj_props", "outer_lesion_area_props", "inner_lesion_area_props"):
+            assert [(o.label, o.area) for o in getattr(s, band)] == [(o.label, o.area) for o in getattr(t, band)]
+
+
+def test_low_memory_sub_images_match():
+    fs = rp.FilterSettings()
+    fs.read("tests/known_coords_sizes/within_cartoon_filter.yaml")
+    kwargs = dict(file_settings=fs, dest_folder="", min_lesion_area=40)
+    full = rp.get_sub_images("tests/known_coords_sizes/blobs_within.jpg", **kwargs)
+    low = rp.get_sub_images("tests/known_coords_sizes/blobs_within.jpg", low_memory=True, **kwargs)
+    assert [s.bbox for s in full] == [s.bbox for s in low]
+    for f, l in zip(full, low):
+        assert np.array_equal(f.sub_i, l.sub_i)
+        for band in rp.BAND_STAGES:
+            assert np.array_equal(f.label_image(band), l.label_image(band))
+
+
+@pytest.mark.parametrize("fmt", ["npz", "npy"])
+def test_write_and_load_label_masks(tmp_path, fmt):
+    fs = rp.FilterSettings()
+    fs.read("tests/known_coords_sizes/within_cartoon_filter.yaml")
+    s = rp.get_sub_images("tests/known_coords_sizes/blobs_within.jpg", file_settings=fs, dest_folder=str(tmp_path),
+                          min_lesion_area=40)[0]
+    masks = rp.load_label_masks(s.write_label_masks(fmt=fmt))
+    assert tuple(masks['bbox']) == tuple(s.bbox)
+    assert masks['leaf_mask'].shape == s.sub_view.shape[:2]
+    for area_type, areas in (("healthy_area", s.healthy_obj_props), ("outer_lesion_area", s.outer_lesion_area_props),
+                             ("inner_lesion_area", s.inner_lesion_area_props)):
+        labels = masks[area_type]
+        assert sorted(set(labels[labels > 0].tolist())) == sorted(a.label for a in areas)
+        for a in areas:
+            assert (labels == a.label).sum() == a.area
+
+
+def test_sub_rgb_matches_hsv_round_trip():
+    from skimage import color, img_as_ubyte
+    fs = rp.FilterSettings()
+    fs.read("tests/known_coords_sizes/within_cartoon_filter.yaml")
+    for s in rp.get_sub_images("tests/known_coords_sizes/blobs_within.jpg", file_settings=fs, dest_folder="",
+                               min_lesion_area=40):
+        assert s.rgb_view is not None
+        assert np.array_equal(s.sub_rgb, img_as_ubyte(color.hsv2rgb(s.sub_i)))
+
+
+def test_empty_bands_are_skipped():
+    fs = rp.FilterSettings()
+    fs.read("tests/known_coords_sizes/within_cartoon_filter.yaml")
+    fs.settings['inner_lesion_area'] = {'h': (0.9, 1.0), 's': (0.9, 1.0), 'v': (0.9, 1.0)}
+    s, = rp.get_sub_images("tests/known_coords_sizes/blobs_within.jpg", file_settings=fs, dest_folder="",
+                           min_lesion_area=40)
+    assert s.skipped_bands == ["inner_lesion_area"]
+    assert s.inner_lesion_area_props == []
+    assert len(s.outer_lesion_area_props) > 0
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pytest
+from skimage import io
+import greypatch as rp
+
+
+def _shifted(rgb, rows, cols):
+    """the image of a tray moved rows down and cols left"""
+    return np.pad(rgb, ((rows, 0), (0, cols), (0, 0)), mode="edge")[:rgb.shape[0], cols:]
+
+
+@pytest.fixture
+def tray_images(tmp_path):
+    rgb = rp.load_rgb("tests/known_coords_sizes/blobs_within.jpg")
+    source = tmp_path / "in"
+    source.mkdir()
+    io.imsave(str(source / "day_1.png"), rgb, check_contrast=False)
+    io.imsave(str(source / "day_2.png"), _shifted(rgb, 12, 20), check_contrast=False)
+    return source
+
+
+def test_register_images():
+    rng = np.random.default_rng(0)
+    scene = np.cumsum(np.cumsum(rng.random((140, 170)), axis=0), axis=1)
+    previous = scene[20:120, 30:150]
+    current = scene[13:113, 39:159]
+    offset, correlation = rp.register_images(previous, current)
+    assert offset == (7, -9)
+    assert correlation == pytest.approx(1.0)
+    # on a coarser grid, as the time series registers, a shift between grid points is found to within a pixel
+    step = rp.REGISTRATION_STEP
+    offset, _ = rp.register_images(previous[::step, ::step], scene[14:114, 33:153][::step, ::step], subpixel=True)
+    assert offset[0] * step == pytest.approx(6, abs=1)
+    assert offset[1] * step == pytest.approx(-3, abs=1)
+
+
+def test_link_regions():
+    mask = np.ones((10, 10), dtype=np.bool_)
+    previous = [((0, 0, 10, 10), mask), ((50, 50, 60, 60), mask)]
+    current = [((52, 55, 62, 65), mask), ((100, 100, 110, 110), mask), ((1, 2, 11, 12), mask)]
+    assert rp.link_regions(previous, current) == [1, None, 0]
+    assert rp.link_regions(previous, current, min_overlap=0.6) == [None, None, 0]
+
+
+def test_time_series_links_lesions(tray_images):
+    fs = rp.FilterSettings().read("tests/known_coords_sizes/within_cartoon_filter.yaml")
+    series = rp.TimeSeries(fs, min_lesion_area=40)
+    first = series.add_image(str(tray_images / "day_1.png"))
+    second = series.add_image(str(tray_images / "day_2.png"))
+
+    registration = series.registration_table()
+    assert list(registration['leaf_detection']) == ["full", "windowed"]
+    assert (registration.loc[1, 'row_offset'], registration.loc[1, 'col_offset']) == (12, -20)
+    assert [s.index for s in first] == [s.index for s in second] == [1]
+    assert second[0].bbox == tuple(np.add(first[0].bbox, (12, -20, 12, -20)))
+
+    # a leaf found in its window has the same lesions as one found in the whole image
+    full, = rp.get_sub_images(str(tray_images / "day_2.png"), file_settings=fs, dest_folder="", min_lesion_area=40)
+    assert [a.area for a in second[0].outer_lesion_area_props] == [a.area for a in full.outer_lesion_area_props]
+
+    growth = series.growth_table()
+    passed = sum(a.passed for a in first[0].outer_lesion_area_props)
+    assert passed > 0
+    assert len(growth) == 2 * passed
+    assert list(growth['lesion_id']) == list(range(1, passed + 1)) * 2
+    assert list(growth['pixels_growth'][passed:]) == [0] * passed
+    assert all(growth['pixels_growth'][:passed] == "NA")
+
+
+def test_time_series_shift_between_registration_samples(tmp_path):
+    fs = rp.FilterSettings().read("tests/known_coords_sizes/within_cartoon_filter.yaml")
+    rgb = rp.load_rgb("tests/known_coords_sizes/blobs_within.jpg")
+    series = rp.TimeSeries(fs, min_lesion_area=40)
+    first, = series.add_image(_save(tmp_path, "day_1.png", rgb))
+    second, = series.add_image(_save(tmp_path, "day_2.png", _shifted(rgb, 7, 13)))
+    registration = series.registration_table()
+    assert list(registration['leaf_detection']) == ["full", "windowed"]
+    assert (registration.loc[1, 'row_offset'], registration.loc[1, 'col_offset']) == (7, -13)
+    assert second.bbox == tuple(np.add(first.bbox, (7, -13, 7, -13)))
+
+
+def test_time_series_drops_vanished_leaves(tmp_path):
+    fs = rp.FilterSettings().read("tests/known_coords_sizes/within_cartoon_filter.yaml")
+    rgb = rp.load_rgb("tests/known_coords_sizes/blobs_within.jpg")
+    two_leaves = np.concatenate([rgb, rgb], axis=1)
+    one_leaf = two_leaves.copy()
+    one_leaf[:, rgb.shape[1]:] = rgb[0, 0]
+    series = rp.TimeSeries(fs, min_lesion_area=40)
+    assert [s.index for s in series.add_image(_save(tmp_path, "day_1.png", two_leaves))] == [1, 2]
+    for day in (2, 3, 4):
+        assert [s.index for s in series.add_image(_save(tmp_path, "day_{}.png".format(day), one_leaf))] == [1]
+    assert list(series.leaves) == [1]
+    assert set(lesion[0] for lesion in series.lesions.values()) == {1}
+    # once the leaf has gone, leaves are looked for in windows again
+    assert list(series.registration_table()['leaf_detection'][2:]) == ["windowed", "windowed"]
+
+
+def _save(folder, name, rgb):
+    file = str(folder / name)
+    io.imsave(file, rgb, check_contrast=False)
+    return file
+
+
+def test_process_time_series(tray_images, tmp_path):
+    dest = tmp_path / "out"
+    rp.process_time_series(folder=str(tray_images), settings="tests/known_coords_sizes/within_cartoon_filter.yaml",
+                           destination_folder=str(dest), pixels_per_cm=100, min_lesion_area=0.004)
+    growth = pd.read_csv(str(dest / rp.GROWTH_RESULTS))
+    raw = pd.read_csv(str(dest / "raw_results.csv"))
+    assert list(growth.columns) == rp.GROWTH_COLUMNS
+    assert len(growth) == sum(raw['area_type'] == "outer_lesion_area")
+    assert list(pd.read_csv(str(dest / rp.REGISTRATION_RESULTS))['frame']) == [0, 1]
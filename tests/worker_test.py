@@ -0,0 +1,110 @@
+import pytest
+import json
+import os
+import shutil
+import time
+import threading
+import urllib.request
+import greypatch as rp
+
+SETTINGS = "tests/known_coords_sizes/within_cartoon_filter.yaml"
+
+
+@pytest.fixture
+def server():
+    server = rp.make_server(port=0, max_jobs=1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    server.worker.shutdown()
+
+
+def _wait(server, job_id):
+    for _ in range(600):
+        code, status = _request(server, "/jobs/" + job_id)
+        if status['status'] in ('done', 'failed'):
+            return status
+        time.sleep(0.05)
+    return status
+
+
+def _request(server, path, body=None):
+    url = "http://{}:{}{}".format(*server.server_address, path)
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    try:
+        with urllib.request.urlopen(url, data=data) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_settings_are_cached():
+    worker = rp.Worker()
+    assert worker.get_settings(SETTINGS) is worker.get_settings(SETTINGS)
+    worker.shutdown()
+
+
+def test_settings_cache_is_bounded(tmp_path):
+    worker = rp.Worker(max_settings=2)
+    files = []
+    for i in range(3):
+        files.append(str(tmp_path / "settings_{}.yml".format(i)))
+        shutil.copy(SETTINGS, files[-1])
+        worker.get_settings(files[-1])
+    assert list(worker._settings) == files[1:]
+    first = worker.get_settings(files[2])
+    os.utime(files[2], (time.time() + 10, time.time() + 10))
+    assert worker.get_settings(files[2]) is not first
+    assert len(worker._settings) == 2
+    worker.shutdown()
+
+
+def test_submit_rejects_bad_jobs():
+    worker = rp.Worker()
+    with pytest.raises(ValueError):
+        worker.submit({'source_folder': "in", 'destination_folder': "out"})
+    with pytest.raises(ValueError):
+        worker.submit({'source_folder': "in", 'destination_folder': "out", 'filter_settings': SETTINGS})
+    with pytest.raises(ValueError):
+        worker.submit({'source_folder': "in", 'destination_folder': "out", 'filter_settings': SETTINGS,
+                       'pixels_per_cm': 100, 'colour': "red"})
+    worker.shutdown()
+
+
+def test_jobs_over_http(server, tmp_path):
+    assert _request(server, "/health")[0] == 200
+    assert _request(server, "/jobs", {'source_folder': "in"})[0] == 400
+    code, body = _request(server, "/jobs", {'source_folder': str(tmp_path / "missing"),
+                                            'destination_folder': str(tmp_path / "out"),
+                                            'filter_settings': SETTINGS, 'pixels_per_cm': 100})
+    assert code == 202
+    assert _wait(server, body['job_id'])['status'] == 'failed'
+    assert _request(server, "/jobs/nosuchjob")[0] == 404
+
+
+def test_job_writes_results(server, tmp_path):
+    source = tmp_path / "in"
+    source.mkdir()
+    shutil.copy("tests/known_coords_sizes/blobs_within.jpg", str(source))
+    dest = tmp_path / "out"
+    code, body = _request(server, "/jobs", {'source_folder': str(source), 'destination_folder': str(dest),
+                                            'filter_settings': SETTINGS, 'pixels_per_cm': 100,
+                                            'min_lesion_area': 0.004})
+    assert code == 202
+    status = _wait(server, body['job_id'])
+    assert status['status'] == 'done', status['error']
+    assert status['started'] <= status['finished']
+    for name in ("raw_results.csv", "matched_results.csv", "blobs_within.jpg_sub_image_1.jpg",
+                 "blobs_within.jpg_sub_image_1_annotated.jpg"):
+        assert os.path.exists(str(dest / name))
+
+
+def test_finished_jobs_are_forgotten(tmp_path):
+    worker = rp.Worker(max_jobs=1, max_finished_jobs=2)
+    job_ids = [worker.submit({'source_folder': str(tmp_path / "missing"), 'destination_folder': str(tmp_path),
+                              'filter_settings': SETTINGS, 'pixels_per_cm': 100}) for _ in range(4)]
+    worker.shutdown()
+    assert list(worker.jobs) == job_ids[2:]
+    assert worker.job_counts()['failed'] == 2